@@ -118,14 +118,37 @@ cent_fam = Table('centroid_family', DB_META,
                  Column('distinct_id_members', Integer),  # Number of members w/distinct IDs
                  Column('distinct_members_updated', DateTime(True)),
 
+                 # Candidates are matched with the families that have (about) the same number of files
+                 Index('idx_ttl_files', 'ttl_files'),
+
                  # Other settings
                  extend_existing=True,
                  mysql_engine='InnoDB',
                  mysql_default_charset='utf8mb4',
                  )
 
+# Create the crx_store table, the index of the content-addressed CRX store (see crawl.crx_store)
+crx_store = Table('crx_store', DB_META,
+                  Column('pk', Integer, primary_key=True),
+                  Column('ext_id', VARCHAR(32, charset='utf8mb4', collation='utf8mb4_unicode_ci')),
+                  Column('version', VARCHAR(23, charset='utf8mb4', collation='utf8mb4_unicode_ci')),
+                  Column('digest', VARCHAR(64, charset='ascii')),  # Hex SHA-256 of the CRX's bytes
+                  Column('size', Integer),
+                  Column('stored', DateTime(True)),
+
+                  # Each version is stored once, but several versions may have the same bytes
+                  Index('idx_store_id_ver', 'ext_id', 'version', unique=True),
+                  Index('idx_store_digest', 'digest'),
+
+                  # Other settings
+                  extend_existing=True,
+                  mysql_engine='InnoDB',
+                  mysql_default_charset='utf8mb4',
+                  )
+
 
 def init_db():
     extension.create(checkfirst=True)
     id_list.create(checkfirst=True)
     cent_fam.create(checkfirst=True)
+    crx_store.create(checkfirst=True)
@@ -16,6 +16,7 @@ conf = Munch({
   "version": "57.0",
   "release_date": [2017, 3, 9],  # See https://en.wikipedia.org/wiki/Google_Chrome_version_history
   "url": "https://clients2.google.com/service/update2/crx?response=redirect&prodversion={}&x=id%3D{}%26installsource%3Dondemand%26uc",
+  "update_check_url": "https://clients2.google.com/service/update2/crx?prodversion={}&acceptformat=crx2,crx3",
   "extension_list_url": "https://chrome.google.com/webstore/sitemap?shard=0&numshards=1",
   "save_path": crx_save_path,
   "extract_dir": crx_extract_path,
@@ -8,7 +8,9 @@ from hashlib import sha256
 from os import path
 
 import graph_tool.all as gt
-from graph_tool.all import graph_draw  # Import this so others have access to it
+import numpy as np
+# Import these so others have access to them
+from graph_tool.all import graph_draw, GraphView, label_components, ungroup_vector_property
 
 from common.const import EVAL_NONE, IN_PAT_VAULT, ENC_PAT, MIN_DEPTH, SLICE_PAT, ISO_TIME, TYPE_TO_NAME
 from common.util import separate_mode_type, byte_len
@@ -71,7 +73,7 @@ class DblingGraph(gt.Graph):
             self.vp['alloc'] = self.new_vertex_property('bool')
             self.vp['used'] = self.new_vertex_property('bool')
             self.vp['fs_offset'] = self.new_vertex_property('string')
-            self.vp['src_files'] = self.new_vertex_property('vector<short>')
+            self.vp['member_row'] = self.new_vertex_property('int')  # Row in the diff's image membership table
             self.vp['crtime'] = self.new_vertex_property('string')
             self.vp['color'] = self.new_vertex_property('vector<float>')
             self.vp['shape'] = self.new_vertex_property('string')
@@ -225,3 +227,79 @@ def get_dir_depth(filename, slice_path=False):
         if len(_head) == 0:
             break
     return dir_depth
+
+
+def get_child_arrays(digr):
+    """Return the parent/child structure of the graph as flat arrays.
+
+    The children of the vertex with index ``i`` are
+    ``children[offsets[i]:offsets[i+1]]``, which makes it possible to walk a
+    tree level by level without recursing or touching the vertex objects.
+    Indexes are those of the underlying (unfiltered) graph, so the arrays can
+    be used directly with the ``a`` attribute of any vertex property map.
+
+    :param DblingGraph digr: The graph to index.
+    :return: Tuple of the form ``(offsets, children, parents)``, where
+        ``parents`` holds the index of each vertex's parent, or -1 for vertices
+        that have no parent.
+    :rtype: tuple(numpy.ndarray, numpy.ndarray, numpy.ndarray)
+    """
+    num_v = digr.num_vertices(ignore_filter=True)
+    edges = np.asarray(digr.get_edges())
+    if edges.size:
+        src = edges[:, 0].astype(np.int64)
+        tgt = edges[:, 1].astype(np.int64)
+    else:
+        src = tgt = np.empty(0, dtype=np.int64)
+
+    parents = np.full(num_v, -1, dtype=np.int64)
+    parents[tgt] = src
+
+    children = tgt[np.argsort(src, kind='stable')]
+    offsets = np.zeros(num_v + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=num_v), out=offsets[1:])
+    return offsets, children, parents
+
+
+def gather_children(offsets, children, vertices):
+    """Return the children of all the given vertices as a single array.
+
+    :param numpy.ndarray offsets: Offsets from :func:`get_child_arrays`.
+    :param numpy.ndarray children: Children from :func:`get_child_arrays`.
+    :param numpy.ndarray vertices: Indexes of the parent vertices.
+    :return: Indexes of the children, grouped by parent in the same order as
+        ``vertices``.
+    :rtype: numpy.ndarray
+    """
+    starts = offsets[vertices]
+    counts = offsets[vertices + 1] - starts
+    total = int(counts.sum())
+    if not total:
+        return np.empty(0, dtype=np.int64)
+    # Each child's position in `children` is its parent's start plus its rank among its siblings
+    return children[np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)]
+
+
+def get_bfs_levels(offsets, children, roots):
+    """Split the subtrees under ``roots`` into levels of increasing depth.
+
+    Level 0 holds the roots themselves, level 1 their children, and so on.
+    Iterating over the levels in reverse order visits every vertex after all
+    of its descendants, which is what a post-order traversal needs.
+
+    :param numpy.ndarray offsets: Offsets from :func:`get_child_arrays`.
+    :param numpy.ndarray children: Children from :func:`get_child_arrays`.
+    :param roots: Indexes of the vertices at the top of the subtrees.
+    :type roots: list or numpy.ndarray
+    :return: List of vertex index arrays, one per level.
+    :rtype: list(numpy.ndarray)
+    """
+    seen = np.zeros(len(offsets) - 1, dtype=bool)
+    frontier = np.unique(np.asarray(roots, dtype=np.int64))
+    levels = []
+    while frontier.size:
+        levels.append(frontier)
+        seen[frontier] = True
+        frontier = np.unique(gather_children(offsets, children, frontier))
+        frontier = frontier[~seen[frontier]]  # Guard against cycles in a malformed tree
+    return levels
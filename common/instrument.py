@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Measure where the time and memory go during a run.
+
+Typical usage:
+
+>>> report = RunReport()
+>>> with report.phase('ingest'):
+...     graph.add_from_file(dfxml_file)
+>>> report.count('vertices', graph.digr.num_vertices())
+>>> report.save('profile.merl.report.json')
+
+Phases can be entered many times (and from several threads at once); the
+times of each are added up. Database queries are counted and timed by
+listening to the SQLAlchemy engine's cursor events, see
+:meth:`RunReport.watch_db`.
+"""
+
+import json
+import logging
+import resource
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from sys import argv as sys_argv
+
+from sqlalchemy import event
+
+from common.const import ISO_TIME
+
+__all__ = ['RunReport', 'phase']
+
+#: Extension added to an output file's path to get the path of its report
+REPORT_EXT = '.report.json'
+
+
+class RunReport(object):
+    """Collect the wall and CPU time of each phase of a run, plus counts.
+
+    CPU time is for the whole process, so phases that run at the same time
+    (e.g. in a pipeline) each include the CPU time used by the others.
+    """
+
+    def __init__(self, name=None):
+        """
+        :param str name: What the run is of, e.g. the input's path. Included
+            in the report.
+        """
+        self.name = name
+        self.started = datetime.now(timezone.utc)
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+        self._lock = threading.Lock()
+        self.phases = OrderedDict()
+        self.counts = OrderedDict()
+        self.db = OrderedDict([('queries', 0), ('total_sec', 0.0), ('max_sec', 0.0)])
+        self._engine = None
+
+    @contextmanager
+    def phase(self, name):
+        """Time the code run in the ``with`` block as part of the phase ``name``.
+
+        :param str name: Name of the phase.
+        """
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            with self._lock:
+                p = self.phases.setdefault(name, OrderedDict([('calls', 0), ('wall_sec', 0.0), ('cpu_sec', 0.0)]))
+                p['calls'] += 1
+                p['wall_sec'] += wall
+                p['cpu_sec'] += cpu
+            logging.debug('Phase %s took %.3f s (%.3f s CPU)' % (name, wall, cpu))
+
+    def count(self, name, value=1, add=True):
+        """Record a count, e.g. of vertices or candidates.
+
+        :param str name: Name of the count.
+        :param int value: The value to add to the count, or to set it to.
+        :param bool add: When `False`, the count is set to ``value`` instead of
+            having ``value`` added to it.
+        :rtype: None
+        """
+        with self._lock:
+            self.counts[name] = (self.counts.get(name, 0) if add else 0) + value
+
+    def watch_db(self, engine):
+        """Count and time the queries run on ``engine`` until :meth:`close`.
+
+        Queries run by any thread on the engine are included, so when several
+        runs share an engine at once, each run's report includes the queries
+        of the others.
+
+        :param engine: The database engine.
+        :type engine: sqlalchemy.engine.Engine
+        :rtype: None
+        """
+        self._engine = engine
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        with self._lock:
+            self.db['queries'] += 1
+            self.db['total_sec'] += elapsed
+            self.db['max_sec'] = max(self.db['max_sec'], elapsed)
+
+    def close(self):
+        """Stop listening to the database engine, if any.
+
+        :rtype: None
+        """
+        if self._engine is not None:
+            event.remove(self._engine, 'before_cursor_execute', self._before_execute)
+            event.remove(self._engine, 'after_cursor_execute', self._after_execute)
+            self._engine = None
+
+    @property
+    def rusage(self):
+        """Resource usage of the process so far, as reported by :func:`resource.getrusage`.
+
+        :rtype: resource.struct_rusage
+        """
+        return resource.getrusage(resource.RUSAGE_SELF)
+
+    def to_dict(self):
+        """Return the report as a dict that can be saved as JSON.
+
+        :rtype: dict
+        """
+        usage = self.rusage
+        with self._lock:
+            report = OrderedDict([
+                ('name', self.name),
+                ('start_time', self.started.strftime(ISO_TIME)),
+                ('command_line', ' '.join(sys_argv)),
+                ('wall_sec', time.perf_counter() - self._start_wall),
+                ('cpu_sec', time.process_time() - self._start_cpu),
+                # On Linux, ru_maxrss is in kilobytes
+                ('peak_rss_kb', usage.ru_maxrss),
+                ('phases', OrderedDict((k, OrderedDict(v)) for k, v in self.phases.items())),
+                ('counts', OrderedDict(self.counts)),
+            ])
+            if self.db['queries']:
+                report['db'] = OrderedDict(self.db)
+                report['db']['mean_sec'] = self.db['total_sec'] / self.db['queries']
+        return report
+
+    def save(self, file_path):
+        """Save the report to a JSON file.
+
+        :param str file_path: Path to the file to create.
+        :rtype: None
+        """
+        with open(file_path, 'w') as fout:
+            json.dump(self.to_dict(), fout, indent=2)
+        logging.info('Saved run report to %s' % file_path)
+
+
+@contextmanager
+def phase(report, name):
+    """Time a phase with ``report`` when there is one. Otherwise, do nothing.
+
+    :param report: The report to add the phase to, or `None`.
+    :type report: RunReport or None
+    :param str name: Name of the phase.
+    """
+    if report is None:
+        yield
+    else:
+        with report.phase(name):
+            yield
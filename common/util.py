@@ -2,9 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import stat
+import threading
 from datetime import datetime, date, timedelta
 from itertools import islice, chain
 from os import path
+from queue import Queue, Full
 from subprocess import check_output
 
 from munch import *
@@ -14,6 +16,10 @@ from common.const import mode_to_unix, USED_TO_DB, USED_FIELDS
 
 
 PROGRESS_PERIOD = 100
+#: Default number of batches :func:`prefetch` generates ahead of the consumer
+PREFETCH_DEPTH = 8
+#: Default number of items in each batch passed between threads by :func:`prefetch`
+PREFETCH_BATCH = 256
 
 
 def validate_crx_id(crx_id):
@@ -297,3 +303,66 @@ def chunkify(iterable, chunk_size):
     while True:
         batch = islice(_it, chunk_size)
         yield chain([batch.__next__()], batch)
+
+
+def prefetch(iterable, depth=PREFETCH_DEPTH, batch_size=PREFETCH_BATCH):
+    """Generate the items of an iterable, which is iterated in a separate thread.
+
+    This lets a slow producer (e.g. a parser reading from disk) run at the
+    same time as the code consuming its items. The items are passed between
+    the threads in batches through a bounded queue, so the producer blocks
+    when it gets more than ``depth`` batches ahead of the consumer instead of
+    filling up memory. Any exception raised by the producer is raised again in
+    the consumer's thread, after the items generated before it.
+
+    >>> for rec in prefetch(iter_dfxml_records('image.xml')):
+    ...     process(rec)
+
+    :param iterable: The iterable to iterate in the background.
+    :param int depth: Maximum number of batches waiting in the queue.
+    :param int batch_size: Number of items in each batch.
+    :return: Generator of the items of ``iterable``, in the same order.
+    :rtype: generator
+    """
+    q = Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Check for the consumer stopping early periodically, so the thread doesn't block forever on a full queue
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+            except Full:
+                continue
+            return True
+        return False
+
+    def produce():
+        try:
+            batch = []
+            for item in iterable:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    if not put(batch):
+                        return
+                    batch = []
+            if batch and not put(batch):
+                return
+            put(done)
+        except BaseException as err:
+            put(err)
+
+    thread = threading.Thread(target=produce, name='prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch = q.get()
+            if batch is done:
+                break
+            if isinstance(batch, BaseException):
+                raise batch
+            yield from batch
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,223 @@
+# *-* coding: utf-8 *-*
+"""Content-addressed storage of downloaded CRXs.
+
+CRXs used to be saved as ``<id>_<version>.crx`` in one flat directory, which
+stored the same bytes again whenever an extension was re-published under a
+new version, and which got slow to list over ``sshfs`` with hundreds of
+thousands of entries. A :class:`CrxStore` instead names each CRX by the
+SHA-256 digest of its bytes, in subdirectories sharded by the first bytes of
+the digest::
+
+    <root>/objects/3f/a2/3fa2...e1.crx   # One file per distinct CRX
+    <root>/incoming/<id>_<version>.crx.part.<token>   # Downloads in progress
+    <root>/incoming/<id>_<version>.crx.part   # Interrupted downloads
+
+and keeps an index of which digest each ``(id, version)`` has in the
+``crx_store`` table (see :func:`crawl.db_iface.db_store_lookup`). A CRX whose
+bytes are already in the store isn't written again, and listing the CRXs
+reads the index instead of the directories.
+
+Each download is written to its own file (see :meth:`CrxStore.claim_part`),
+so two workers downloading the same version never write to the same file.
+A download that's interrupted is released under a name without the token, so
+the next download of that version can claim it and resume it.
+
+>>> store = CrxStore(_conf.save_path)
+>>> full_path = store.put(part_path, crx_id, version)
+>>> store.lookup(crx_id, version) == full_path
+True
+>>> for crx_id, version, full_path in store:
+...     pass
+
+CRXs saved in the root directory by older versions of dbling are moved into
+the store by :meth:`CrxStore.import_flat`, which only needs to be run once,
+with the :func:`crawl.tasks.start_import_crx_store` task.
+"""
+
+import logging
+import os
+from hashlib import sha256
+from os import path
+from uuid import uuid4
+
+from common.util import dt_dict_now, get_id_version
+from crawl.db_iface import db_store_lookup, db_store_add, db_store_count, db_store_entries
+
+__all__ = ['CrxStore', 'InvalidCrx', 'file_digest']
+
+#: Subdirectories of the store's root for the stored CRXs and the downloads in progress
+OBJECTS_DIR = 'objects'
+INCOMING_DIR = 'incoming'
+#: Extension of the stored CRXs
+CRX_EXT = '.crx'
+#: Extension of the file a CRX is downloaded to, before it is put in the store
+PART_EXT = '.part'
+#: The first bytes of every CRX
+CRX_MAGIC = b'Cr24'
+#: Number of bytes read at a time when hashing a CRX
+READ_CHUNK_SIZE = 256 * 1024
+
+
+class InvalidCrx(Exception):
+    """Raised when a file put in the store isn't a CRX."""
+
+
+def file_digest(file_path, magic=None):
+    """Hash a file with SHA-256.
+
+    :param str file_path: Path of the file.
+    :param bytes magic: When given, the bytes the file must start with.
+    :return: The hex digest of the file and its size in bytes.
+    :rtype: tuple(str, int)
+    :raises InvalidCrx: If the file doesn't start with ``magic``.
+    """
+    digest = sha256()
+    size = 0
+    with open(file_path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(READ_CHUNK_SIZE), b''):
+            if not size and magic is not None and not chunk.startswith(magic):
+                raise InvalidCrx('{} does not start with {!r}'.format(file_path, magic))
+            digest.update(chunk)
+            size += len(chunk)
+    if not size and magic:
+        raise InvalidCrx('{} is empty'.format(file_path))
+    return digest.hexdigest(), size
+
+
+class CrxStore(object):
+    """CRXs stored by the SHA-256 digest of their bytes, with an index of the digest of each version.
+
+    Iterating over the store gives an ``(id, version, full_path)`` tuple for
+    each version in the index.
+    """
+
+    def __init__(self, root):
+        """
+        :param str root: Directory the store is in.
+        """
+        self.root = path.abspath(root)
+        self.objects_dir = path.join(self.root, OBJECTS_DIR)
+        self.incoming_dir = path.join(self.root, INCOMING_DIR)
+
+    def object_path(self, digest):
+        """Return the path of the CRX with the given digest.
+
+        :param str digest: Hex SHA-256 digest of the CRX.
+        :rtype: str
+        """
+        return path.join(self.objects_dir, digest[:2], digest[2:4], digest + CRX_EXT)
+
+    def incoming_path(self, crx_id, version):
+        """Return the path of an interrupted download of a CRX, which can be resumed.
+
+        The directory is created if it doesn't exist yet. It's in the same
+        file system as the stored CRXs, so moving a download into the store
+        is a rename.
+
+        :param str crx_id: The extension's ID.
+        :param str version: The extension's version.
+        :rtype: str
+        """
+        os.makedirs(self.incoming_dir, exist_ok=True)
+        return path.join(self.incoming_dir, '{}_{}{}{}'.format(crx_id, version, CRX_EXT, PART_EXT))
+
+    def claim_part(self, crx_id, version):
+        """Return a path to download a CRX to before it's :meth:`put` in the store.
+
+        Only the caller writes to the path. If there's an interrupted
+        download of the CRX at :meth:`incoming_path`, it's moved to the path,
+        so the download can be resumed. Renaming is atomic, so only one
+        caller gets it.
+
+        :param str crx_id: The extension's ID.
+        :param str version: The extension's version.
+        :rtype: str
+        """
+        shared_path = self.incoming_path(crx_id, version)
+        part_path = '{}.{}'.format(shared_path, uuid4().hex)
+        try:
+            os.rename(shared_path, part_path)
+        except FileNotFoundError:
+            pass
+        return part_path
+
+    @staticmethod
+    def release_part(part_path):
+        """Make an interrupted download from :meth:`claim_part` available to be resumed.
+
+        :param str part_path: The path from :meth:`claim_part`.
+        :rtype: None
+        """
+        if path.exists(part_path):
+            os.replace(part_path, path.splitext(part_path)[0])
+
+    def lookup(self, crx_id, version):
+        """Return the path of a version of an extension, if it's in the store.
+
+        :param str crx_id: The extension's ID.
+        :param str version: The extension's version.
+        :return: Full path of the CRX, or `None` if that version isn't in
+            the store.
+        :rtype: str or None
+        """
+        digest = db_store_lookup(crx_id, version)
+        return digest and self.object_path(digest)
+
+    def put(self, src_path, crx_id, version):
+        """Move a CRX into the store, and add it to the index.
+
+        If a CRX with the same bytes is already stored, ``src_path`` is just
+        removed.
+
+        :param str src_path: Path of the CRX to store, e.g. a finished
+            download at a path from :meth:`claim_part`.
+        :param str crx_id: The extension's ID.
+        :param str version: The extension's version.
+        :return: Full path of the stored CRX.
+        :rtype: str
+        :raises InvalidCrx: If the file doesn't start with the CRX header.
+            It isn't stored.
+        """
+        digest, size = file_digest(src_path, CRX_MAGIC)
+        obj_path = self.object_path(digest)
+        if path.exists(obj_path):
+            os.remove(src_path)
+            logging.debug('{}  Version {} has the same bytes as an already stored CRX'.format(crx_id, version))
+        else:
+            os.makedirs(path.dirname(obj_path), exist_ok=True)
+            # Renaming is atomic, so there's never a partial CRX in the store
+            os.replace(src_path, obj_path)
+        db_store_add(crx_id, version, digest, size, dt_dict_now())
+        return obj_path
+
+    def import_flat(self, limit=float('inf')):
+        """Move the ``<id>_<version>.crx`` files in the store's root directory into the store.
+
+        :param limit: Maximum number of CRXs to move.
+        :type limit: int or float
+        :return: The number of CRXs moved.
+        :rtype: int
+        """
+        num = 0
+        for entry in os.scandir(self.root):
+            if num >= limit:
+                break
+            if not entry.name.endswith(CRX_EXT) or not entry.is_file():
+                continue
+            crx_id, version = get_id_version(entry.name)
+            try:
+                self.put(entry.path, crx_id, version)
+            except InvalidCrx as err:
+                logging.warning('Left {} out of the store: {}'.format(entry.name, err))
+                continue
+            num += 1
+            if not num % 1000:
+                logging.info('Moved {} CRXs into the store'.format(num))
+        return num
+
+    def __len__(self):
+        return db_store_count()
+
+    def __iter__(self):
+        for crx_id, version, digest in db_store_entries():
+            yield crx_id, version, self.object_path(digest)
@@ -5,16 +5,17 @@ import logging
 from time import sleep
 
 from celery import Task
-from sqlalchemy import select, and_
+from sqlalchemy import select, and_, func
 from sqlalchemy.exc import IntegrityError, InvalidRequestError, DBAPIError
 from sqlalchemy.orm import scoped_session, sessionmaker
 
-from common.chrome_db import DB_ENGINE, extension, id_list
+from common.chrome_db import DB_ENGINE, extension, id_list, crx_store
 from common.util import MunchyMunch, dict_to_dt
 from crawl.celery import app
 
 __all__ = ['READ_ONLY', 'DuplicateDownload', 'SqlAlchemyTask', 'DbActionFailed',
-           'add_new_crx_to_db', 'db_download_complete', 'db_extract_complete', 'db_profile_complete']
+           'add_new_crx_to_db', 'db_processed_versions', 'db_download_complete', 'db_extract_complete',
+           'db_profile_complete', 'db_store_lookup', 'db_store_add', 'db_store_count', 'db_store_entries']
 
 DB_SESSION = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=DB_ENGINE))
 MAX_EXECUTE_RETRIES = 20
@@ -71,6 +72,112 @@ def add_new_crx_to_db(crx_obj, log_progress=False):
         log('{}  Added ID to list of CRXs'.format(crx_obj['id']))
 
 
+def db_processed_versions(versions, dt_avail):
+    """Find the extensions whose current version has already been processed.
+
+    Those extensions' entries get their last known available datetime
+    updated, just like :func:`db_download_complete` does when it finds that a
+    download is a duplicate, so they don't need to be downloaded at all.
+
+    :param versions: The current version of each extension, keyed by ID, as
+        generated by :func:`crawl.webstore_iface.probe_versions`. Extensions
+        with a version of `None` are ignored.
+    :type versions: dict
+    :param dt_avail: Date and time the list of extensions was downloaded.
+    :type dt_avail: dict
+    :return: IDs of the extensions that don't need to be processed.
+    :rtype: set
+    """
+    current = {crx_id: ver for crx_id, ver in versions.items() if ver is not None}
+    if not current:
+        return set()
+    db_session = DB_SESSION()
+
+    s = select([extension.c.pk, extension.c.ext_id, extension.c.version,
+                extension.c.downloaded, extension.c.extracted, extension.c.profiled]).\
+        where(extension.c.ext_id.in_(list(current)))
+    processed = {}
+    for row in db_session.execute(s):
+        # Same check as db_download_complete(): the version needs processing if any of the dates are missing
+        if current[row[1]] == row[2] and None not in list(row[3:]):
+            processed[row[1]] = row[0]
+
+    if processed:
+        u = extension.update().where(extension.c.pk.in_(list(processed.values()))).\
+            values(last_known_available=dict_to_dt(dt_avail))
+        _execute_and_commit(db_session, u)
+    return set(processed)
+
+
+def db_store_lookup(crx_id, version):
+    """Look up the digest of a CRX in the index of the CRX store.
+
+    :param str crx_id: The extension's ID.
+    :param str version: The extension's version.
+    :return: The hex SHA-256 digest of the CRX, or `None` if that version
+        hasn't been stored.
+    :rtype: str or None
+    """
+    db_session = DB_SESSION()
+    s = select([crx_store.c.digest]).where(and_(crx_store.c.ext_id == crx_id, crx_store.c.version == version))
+    row = db_session.execute(s).fetchone()
+    # End the transaction so the next lookup sees the entries other workers have added since
+    _commit_it(db_session)
+    return row and row[0]
+
+
+def db_store_add(crx_id, version, digest, size, dt_stored):
+    """Add a CRX to the index of the CRX store.
+
+    :param str crx_id: The extension's ID.
+    :param str version: The extension's version.
+    :param str digest: The hex SHA-256 digest of the CRX.
+    :param int size: Size of the CRX in bytes.
+    :param dt_stored: Date and time the CRX was stored.
+    :type dt_stored: dict
+    :return: Whether the entry was added. It isn't when the version is
+        already in the index, e.g. because another worker stored it first.
+    :rtype: bool
+    """
+    db_session = DB_SESSION()
+    try:
+        db_session.execute(crx_store.insert().values(ext_id=crx_id, version=version, digest=digest, size=size,
+                                                     stored=dict_to_dt(dt_stored)))
+    except IntegrityError:
+        db_session.rollback()
+        logging.debug('{}  Version {} already in the CRX store'.format(crx_id, version))
+        return False
+    _commit_it(db_session)
+    return True
+
+
+def db_store_count():
+    """Count the CRXs in the index of the CRX store.
+
+    :rtype: int
+    """
+    db_session = DB_SESSION()
+    ttl = db_session.execute(select([func.count()]).select_from(crx_store)).scalar()
+    _commit_it(db_session)
+    return ttl
+
+
+def db_store_entries():
+    """Generate the entries in the index of the CRX store.
+
+    The rows are streamed from the database instead of being fetched all at
+    once.
+
+    :return: Generator of ``(id, version, digest)`` tuples.
+    :rtype: generator
+    """
+    s = select([crx_store.c.ext_id, crx_store.c.version, crx_store.c.digest]).\
+        execution_options(stream_results=True)
+    with DB_ENGINE.connect() as conn:
+        for row in conn.execute(s):
+            yield tuple(row)
+
+
 @app.task(base=SqlAlchemyTask)
 @MunchyMunch
 def db_download_complete(crx_obj, log_progress=False):
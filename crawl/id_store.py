@@ -0,0 +1,200 @@
+# *-* coding: utf-8 *-*
+"""Compact, sorted storage of extension IDs.
+
+Extension IDs are 32 characters from ``a`` to ``p``, i.e. 32 hexadecimal
+nibbles written with different digits, so each one packs into 16 bytes.
+:class:`IdStore` keeps the packed IDs of a crawl in a sorted numpy array,
+which takes 16 MB per million IDs instead of the ~100 MB of a set of strings,
+and can be saved to disk and memory mapped when it's loaded again.
+
+Since both stores are sorted, finding the IDs that were added and removed
+since the previous crawl is a vectorized set difference:
+
+>>> current = IdStore.from_ids(crx_list)
+>>> added, removed = current.diff(IdStore.load(ID_STORE_PATH))
+>>> current.save(ID_STORE_PATH)
+"""
+
+import logging
+import os
+from os import path
+
+import numpy as np
+
+__all__ = ['IdStore', 'pack_ids', 'unpack_ids', 'ID_STORE_PATH']
+
+#: Where the IDs of the last crawl are saved
+ID_STORE_PATH = path.join(path.dirname(path.realpath(__file__)), '..', 'cache', 'crx_ids.npy')
+
+#: Length of an extension ID, and of a packed one
+CRX_ID_LEN = 32
+PACKED_LEN = CRX_ID_LEN // 2
+
+#: Data type of the packed IDs. Byte strings sort the same way as the IDs they were packed from.
+PACKED_DTYPE = np.dtype('S%d' % PACKED_LEN)
+
+_A = ord('a')
+# Translates the hex digits of a packed ID back to the letters of an extension ID
+_HEX_TO_CRX = str.maketrans('0123456789abcdef', 'abcdefghijklmnop')
+
+
+def pack_ids(ids):
+    """Pack extension IDs into 16 bytes each.
+
+    :param ids: The extension IDs.
+    :type ids: list or set
+    :return: Array of the packed IDs, in the same order as ``ids``.
+    :rtype: numpy.ndarray
+    :raises ValueError: If any of the IDs isn't 32 characters from ``a`` to
+        ``p``.
+    """
+    ids = list(ids)
+    if not ids:
+        return np.empty(0, dtype=PACKED_DTYPE)
+    try:
+        nibbles = np.frombuffer(''.join(ids).encode('ascii'), dtype=np.uint8) - _A
+    except UnicodeEncodeError:
+        raise ValueError('Extension IDs must be ASCII')
+    if len(nibbles) != len(ids) * CRX_ID_LEN or np.any(nibbles > 15):
+        raise ValueError('Extension IDs must be {} characters from a to p'.format(CRX_ID_LEN))
+    nibbles = nibbles.reshape(-1, PACKED_LEN, 2)
+    return ((nibbles[:, :, 0] << 4) | nibbles[:, :, 1]).view(PACKED_DTYPE).ravel()
+
+
+def unpack_ids(packed):
+    """Unpack IDs packed by :func:`pack_ids`.
+
+    :param numpy.ndarray packed: The packed IDs.
+    :return: List of the extension IDs.
+    :rtype: list
+    """
+    raw = _as_bytes(packed)
+    nibbles = np.empty((len(raw), CRX_ID_LEN), dtype=np.uint8)
+    nibbles[:, 0::2] = raw >> 4
+    nibbles[:, 1::2] = raw & 15
+    nibbles += _A
+    return nibbles.view('S%d' % CRX_ID_LEN).ravel().astype('U%d' % CRX_ID_LEN).tolist()
+
+
+def _as_bytes(packed):
+    # Viewing the packed IDs as bytes keeps any trailing zero bytes, which numpy drops from the byte string scalars
+    return np.ascontiguousarray(packed).view(np.uint8).reshape(-1, PACKED_LEN)
+
+
+class IdStore(object):
+    """A sorted set of extension IDs, packed into 16 bytes each.
+
+    Indexing and iterating over the store give the IDs as strings, in order.
+    Membership tests are binary searches.
+    """
+
+    #: Number of IDs unpacked at a time when iterating
+    ITER_BATCH = 64 * 1024
+
+    def __init__(self, packed=None):
+        """
+        :param numpy.ndarray packed: Packed IDs that are already sorted and
+            unique, e.g. from another store. Use :meth:`from_ids` or
+            :meth:`from_packed` for anything else.
+        """
+        self._packed = np.empty(0, dtype=PACKED_DTYPE) if packed is None else packed
+        self._bytes = _as_bytes(self._packed)
+
+    @classmethod
+    def from_ids(cls, ids):
+        """Create a store of the given extension IDs.
+
+        :param ids: The extension IDs. Duplicates are dropped.
+        :type ids: list or set
+        :rtype: IdStore
+        """
+        return cls.from_packed(pack_ids(ids))
+
+    @classmethod
+    def from_packed(cls, packed):
+        """Create a store of IDs packed by :func:`pack_ids`.
+
+        :param packed: Array of packed IDs, in any order and with any
+            duplicates, or a list of such arrays.
+        :type packed: numpy.ndarray or list
+        :rtype: IdStore
+        """
+        if isinstance(packed, (list, tuple)):
+            packed = np.concatenate(packed) if packed else np.empty(0, dtype=PACKED_DTYPE)
+        return cls(np.unique(packed))
+
+    @classmethod
+    def load(cls, file_path=ID_STORE_PATH, mmap=True):
+        """Load a store saved by :meth:`save`.
+
+        :param str file_path: Path of the saved store.
+        :param bool mmap: Memory map the file instead of reading it into
+            memory.
+        :return: The store, or an empty store if the file doesn't exist.
+        :rtype: IdStore
+        """
+        if not path.isfile(file_path):
+            logging.debug('No saved extension IDs at {}'.format(file_path))
+            return cls()
+        packed = np.load(file_path, mmap_mode='r' if mmap else None)
+        if packed.dtype != PACKED_DTYPE or packed.ndim != 1:
+            raise ValueError('Not a file of packed extension IDs: {}'.format(file_path))
+        return cls(packed)
+
+    def save(self, file_path=ID_STORE_PATH):
+        """Save the store to a ``.npy`` file.
+
+        The file is replaced atomically, so a store being read by another
+        process is never left half written.
+
+        :param str file_path: Path of the file to create.
+        :rtype: None
+        """
+        os.makedirs(path.dirname(path.abspath(file_path)), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(file_path, os.getpid())
+        with open(tmp_path, 'wb') as fout:
+            np.save(fout, np.ascontiguousarray(self._packed))
+        os.replace(tmp_path, file_path)
+        logging.debug('Saved {} extension IDs to {}'.format(len(self), file_path))
+
+    @property
+    def packed(self):
+        """The sorted array of packed IDs."""
+        return self._packed
+
+    @property
+    def nbytes(self):
+        """Number of bytes used by the packed IDs."""
+        return self._packed.nbytes
+
+    def __len__(self):
+        return len(self._packed)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return IdStore(self._packed[item])
+        return self._bytes[item].tobytes().hex().translate(_HEX_TO_CRX)
+
+    def __iter__(self):
+        for i in range(0, len(self), self.ITER_BATCH):
+            yield from unpack_ids(self._packed[i:i+self.ITER_BATCH])
+
+    def __contains__(self, crx_id):
+        try:
+            key = pack_ids([crx_id])
+        except ValueError:
+            return False
+        i = np.searchsorted(self._packed, key)[0]
+        return i < len(self) and self._bytes[i].tobytes() == _as_bytes(key)[0].tobytes()
+
+    def diff(self, previous):
+        """Compare this store with the one from a previous crawl.
+
+        :param IdStore previous: The IDs from the previous crawl.
+        :return: Stores of the IDs that are new in this one, and the IDs that
+            were in ``previous`` but aren't in this one.
+        :rtype: tuple(IdStore, IdStore)
+        """
+        added = np.setdiff1d(self._packed, previous.packed, assume_unique=True)
+        removed = np.setdiff1d(previous.packed, self._packed, assume_unique=True)
+        return IdStore(added), IdStore(removed)
@@ -0,0 +1,241 @@
+# *-* coding: utf-8 *-*
+"""Limit the rate of requests to each host across all of the crawler's workers.
+
+Every request made through :func:`crawl.webstore_iface._http_get` or a
+:class:`~crawl.webstore_iface.CrxDownloader` first takes a token from the
+bucket for its host and *request class* (:data:`SITEMAP`,
+:data:`UPDATE_CHECK`, :data:`DETAIL`, or :data:`CRX`). The sizes and rates of
+the buckets are set in :data:`RATE_LIMITS`.
+
+The buckets are kept in memcached (see :mod:`common.sync`), so the limits
+hold for all the workers together. Each bucket is a single value: the time
+at which it would be full again, sometimes called the "theoretical arrival
+time". Taking a token moves that time forward by one interval, which is
+done with memcached's compare-and-set so concurrent workers don't lose each
+other's updates. :class:`MemoryBucketStore` keeps the buckets in the current
+process instead, for when memcached isn't available, and for testing.
+
+>>> LIMITER.wait('chrome.google.com', DETAIL)
+"""
+
+import logging
+import random
+import threading
+import time
+
+from pymemcache.client.base import PooledClient
+from pymemcache.exceptions import MemcacheError
+
+from crawl.throttle import HostThrottled, MAX_INLINE_WAIT
+
+__all__ = ['RateLimiter', 'MemcacheBucketStore', 'MemoryBucketStore', 'LIMITER', 'RATE_LIMITS',
+           'SITEMAP', 'UPDATE_CHECK', 'DETAIL', 'CRX']
+
+#: Request classes
+SITEMAP = 'sitemap'
+UPDATE_CHECK = 'update_check'
+DETAIL = 'detail'
+CRX = 'crx'
+
+#: Rate (requests per second) and burst size (bucket capacity) for each host
+#: and request class. A host or class of `None` matches any host or class.
+#: When a request matches more than one entry, the most specific one is used.
+RATE_LIMITS = {
+    (None, SITEMAP): (5, 10),
+    (None, UPDATE_CHECK): (5, 10),
+    (None, DETAIL): (20, 40),
+    (None, CRX): (20, 40),
+    (None, None): (10, 20),
+}
+
+#: Prefix of the memcached keys of the buckets
+KEY_PREFIX = 'dbling-rate'
+#: Number of times to try updating a bucket in memcached before giving up on the request's limit
+MAX_CAS_TRIES = 20
+#: Seconds to use the limits of just the current process after memcached couldn't be reached
+FALLBACK_PERIOD = 60.0
+
+
+def _take(tat, now, interval, burst, max_wait):
+    """Take a token from a bucket.
+
+    :param tat: Time at which the bucket would be full, or `None` for a new
+        bucket.
+    :type tat: float or None
+    :param float now: The current time.
+    :param float interval: Seconds it takes to add a token to the bucket.
+    :param int burst: Capacity of the bucket.
+    :param float max_wait: Don't take a token that isn't available within
+        this many seconds.
+    :return: The bucket's new full time (`None` if no token was taken), and
+        the number of seconds to wait for the token.
+    :rtype: tuple
+    """
+    tat = max(tat or 0.0, now)
+    wait = max(0.0, tat - now - (burst - 1) * interval)
+    if wait > max_wait:
+        return None, wait
+    return tat + interval, wait
+
+
+class MemoryBucketStore:
+    """Keep the buckets in the current process."""
+
+    def __init__(self, clock=time.monotonic):
+        """
+        :param clock: Function that returns the current time in seconds.
+        """
+        self._clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, interval, burst, max_wait):
+        """Take a token from a bucket, see :meth:`RateLimiter.reserve`.
+
+        :param str key: The bucket's key.
+        :param float interval: Seconds it takes to add a token to the bucket.
+        :param int burst: Capacity of the bucket.
+        :param float max_wait: Don't take a token that isn't available within
+            this many seconds.
+        :return: Seconds to wait for the token.
+        :rtype: float
+        """
+        with self._lock:
+            tat, wait = _take(self._buckets.get(key), self._clock(), interval, burst, max_wait)
+            if tat is not None:
+                self._buckets[key] = tat
+        return wait
+
+
+class MemcacheBucketStore:
+    """Keep the buckets in memcached, so they're shared by every worker that uses the same memcached server.
+
+    Since the buckets store times, the clocks of the workers' machines should
+    be kept in sync (e.g. with NTP).
+    """
+
+    def __init__(self, server=('localhost', 11211), client=None):
+        """
+        :param tuple server: Host and port of the memcached server.
+        :param client: The memcached client to use instead of connecting to
+            ``server``. It must be safe to share between threads.
+        :type client: pymemcache.client.base.PooledClient
+        """
+        self._client = client if client is not None else PooledClient(server, connect_timeout=1, timeout=1)
+
+    def take(self, key, interval, burst, max_wait):
+        """Take a token from a bucket, see :meth:`MemoryBucketStore.take`.
+
+        :rtype: float
+        :raises RuntimeError: If memcached can't be reached, or the bucket
+            couldn't be updated because other workers kept updating it at the
+            same time.
+        """
+        try:
+            return self._take(key, interval, burst, max_wait)
+        except (MemcacheError, OSError) as err:
+            raise RuntimeError('Unable to update the rate limit bucket {} in memcached: {}'.format(key, err)) from err
+
+    def _take(self, key, interval, burst, max_wait):
+        key = '{}:{}'.format(KEY_PREFIX, key)
+        # Buckets can be forgotten once they would be full again
+        expire = int(burst * interval) + 60
+        for _ in range(MAX_CAS_TRIES):
+            value, cas = self._client.gets(key)
+            now = time.time()
+            tat, wait = _take(None if value is None else float(value), now, interval, burst, max_wait)
+            if tat is None:
+                return wait
+            tat = repr(tat)
+            if value is None:
+                stored = self._client.add(key, tat, expire=expire, noreply=False)
+            else:
+                stored = self._client.cas(key, tat, cas, expire=expire, noreply=False)
+            if stored:
+                return wait
+            # Another worker took a token first. Spread out the retries so the same workers don't keep colliding.
+            time.sleep(random.uniform(0, 0.005))
+        raise RuntimeError('Too much contention on the rate limit bucket {}'.format(key))
+
+
+class RateLimiter:
+    """Take tokens from the buckets of a :class:`MemcacheBucketStore` or :class:`MemoryBucketStore`."""
+
+    def __init__(self, store, limits=None):
+        """
+        :param store: Where the buckets are kept.
+        :type store: MemcacheBucketStore or MemoryBucketStore
+        :param dict limits: The limits, like :data:`RATE_LIMITS`, which is
+            used when this is `None`.
+        """
+        self.store = store
+        self.limits = RATE_LIMITS if limits is None else limits
+        self._fallback = MemoryBucketStore()
+        self._fallback_until = 0.0
+
+    def limit(self, host, request_class=None):
+        """Return the rate and burst size of the bucket for a host and request class.
+
+        :param str host: The host the request is to.
+        :param str request_class: The request class.
+        :return: The rate and burst size, or `None` if requests aren't
+            limited.
+        :rtype: tuple(float, int)
+        """
+        for key in ((host, request_class), (host, None), (None, request_class), (None, None)):
+            if key in self.limits:
+                return self.limits[key]
+        return None
+
+    def reserve(self, host, request_class=None, max_wait=MAX_INLINE_WAIT):
+        """Take a token for a request, and return how long to wait before making it.
+
+        If the buckets can't be reached, the process keeps its own buckets in
+        a :class:`MemoryBucketStore` for :data:`FALLBACK_PERIOD` seconds.
+
+        :param str host: The host the request is to.
+        :param str request_class: The request class.
+        :param float max_wait: Longest time the caller will wait.
+        :return: Seconds to wait.
+        :rtype: float
+        :raises crawl.throttle.HostThrottled: If there won't be a token for
+            more than ``max_wait`` seconds. No token is taken.
+        """
+        limit = self.limit(host, request_class)
+        if limit is None:
+            return 0.0
+        rate, burst = limit
+        key = '{}:{}'.format(host, request_class)
+
+        wait = None
+        if time.monotonic() >= self._fallback_until:
+            try:
+                wait = self.store.take(key, 1.0 / rate, burst, max_wait)
+            except RuntimeError as err:
+                logging.warning('Using rate limits for this process only for {:.0f} seconds. {}'.
+                                format(FALLBACK_PERIOD, err))
+                self._fallback_until = time.monotonic() + FALLBACK_PERIOD
+        if wait is None:
+            wait = self._fallback.take(key, 1.0 / rate, burst, max_wait)
+
+        if wait > max_wait:
+            raise HostThrottled(host, wait)
+        return wait
+
+    def wait(self, host, request_class=None, max_wait=MAX_INLINE_WAIT):
+        """Take a token for a request, sleeping until it's available.
+
+        :param str host: The host the request is to.
+        :param str request_class: The request class.
+        :param float max_wait: Longest time to sleep.
+        :rtype: None
+        :raises crawl.throttle.HostThrottled: If there won't be a token for
+            more than ``max_wait`` seconds.
+        """
+        wait = self.reserve(host, request_class, max_wait)
+        if wait > 0:
+            time.sleep(wait)
+
+
+#: The rate limiter used by all of the crawler's requests
+LIMITER = RateLimiter(MemcacheBucketStore())
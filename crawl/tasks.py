@@ -5,7 +5,7 @@ from datetime import timedelta, datetime
 from json import dumps, load
 from json.decoder import JSONDecodeError
 from math import ceil
-from os import path, listdir, remove
+from os import path, remove
 from tempfile import TemporaryDirectory
 from time import perf_counter, sleep
 
@@ -19,21 +19,29 @@ from common.const import EXT_NAME_LEN_MAX
 from common.crx_conf import conf as _conf
 from common.graph import make_graph_from_dir
 from common.sync import acquire_lock
-from common.util import calc_chrome_version, dt_dict_now, MalformedExtId, get_crx_version, cent_vals_to_dict, \
-    MunchyMunch, PROGRESS_PERIOD, ttl_files_in_dir, get_id_version, chunkify
+from common.util import calc_chrome_version, dt_dict_now, MalformedExtId, cent_vals_to_dict, MunchyMunch, \
+    PROGRESS_PERIOD, chunkify
 from crawl.celery import app
+from crawl.crx_store import CrxStore
 from crawl.db_iface import *
+from crawl.id_store import IdStore, ID_STORE_PATH, pack_ids
+from crawl.throttle import HostThrottled
 from crawl.webstore_iface import *
 
 CHROME_VERSION = calc_chrome_version(_conf.version, _conf.release_date)
 DOWNLOAD_URL = _conf.url.format(CHROME_VERSION, '{}')
+UPDATE_CHECK_URL = _conf.update_check_url.format(CHROME_VERSION)
 RETRY_DELAY = 5  # Delay for 5 seconds before retrying tasks
+#: Maximum number of times a CRX is put back in the queue because the Web Store is throttling us
+MAX_THROTTLED_RETRIES = 10
 JOB_ID_FMT = '%Y-%m-%d_%H-%M-%S'
 
 TESTING = READ_ONLY
 
 CHUNK_SIZE = 10 * 1000
 TEST_LIMIT = float('inf')  # 5000  # Set to float('inf') when not testing
+#: Whether to ask the update server for the current versions first, and skip the extensions already processed
+PROBE_VERSIONS = True
 
 ##################
 #
@@ -66,20 +74,32 @@ def start_list_download():
       users apprised of progress without too many log entries.
     - ``job_ttl``: Total number of CRXs that will be processed; equal to the
       number of IDs in the downloaded list of extensions.
+    - ``checked_version``: The current version the update server gave for
+      the extension, or `None` if it wasn't checked. When it's set,
+      :func:`~crawl.webstore_iface.save_crx` doesn't check the extension's
+      Web Store page again.
+
+    Only the IDs that weren't in the previous crawl's list (saved at
+    :data:`crawl.id_store.ID_STORE_PATH`) are added to the DB. When
+    :data:`PROBE_VERSIONS` is set, the current version of every extension is
+    then checked in batches (see :func:`_skip_processed_versions`), and only
+    the extensions with a version that hasn't been processed are processed.
     """
 
     logging.info('Beginning list download...')
 
     dt_avail = dt_dict_now()  # All CRXs get the same value because we download the list at one specific time
-    crx_list = DownloadCRXList(_conf.extension_list_url, return_count=True)
+    crx_list = DownloadCRXList(_conf.extension_list_url, return_count=True, cache=SitemapShardCache())
 
     if TESTING:
         logging.warning('TESTING MODE: All DB transactions will be rolled back, NOT COMMITTED.')
 
-    # Download the list, add each CRX to DB, and keep track of how long it all takes
+    # Download the list, add each new CRX to DB, and keep track of how long it all takes
     t1 = perf_counter()
+    added, removed = crx_list.ids.diff(IdStore.load(ID_STORE_PATH))
+    logging.info('{} IDs are new since the previous list, {} are no longer listed.'.format(len(added), len(removed)))
     list_count = 0
-    for crx, num in crx_list:
+    for num, crx in enumerate(added, 1):
         # We're doing this part synchronously because creating separate tasks for every CRX ID just to add it to the DB
         # create way more overhead than is necessary. Each DB transaction doesn't really incur enough of a performance
         # penalty to justify all the extra time spent sending and managing the messages. The only down sides are that
@@ -89,11 +109,14 @@ def start_list_download():
         add_new_crx_to_db({'id': crx, 'dt_avail': dt_avail}, TESTING and not num % PROGRESS_PERIOD)
     ttl_time = str(timedelta(seconds=(perf_counter() - t1)))
 
-    if list_count != len(crx_list):
-        msg = 'Counts of CRXs don\'t match. Downloader reported {} but processed {}.'.format(len(crx_list), list_count)
+    if list_count != len(added):
+        msg = 'Counts of CRXs don\'t match. Downloader reported {} new but processed {}.'.format(len(added), list_count)
         logging.critical(msg)
         app.mail_admins('dbling: Problem encountered while downloading lists', msg)
         return
+    if not TESTING:
+        # Only remember the IDs once they're in the DB, since the DB isn't changed when testing
+        crx_list.ids.save(ID_STORE_PATH)
 
     # Notify the admins that the download is complete and the list of CRX IDs has been updated
     email_list_update_summary.delay(len(crx_list), ttl_time)
@@ -102,20 +125,63 @@ def start_list_download():
     # callback the summarize() function, which keeps track of how many chunks to expect, which ones have completed,
     # and a summary of their statistics. When all chunks have completed, summarize() will send an email with the final
     # stats tally.
-    logging.info('Starting extension download/extract/profile process. There are {} total IDs.'.format(len(crx_list)))
+    to_process = crx_list.ids
+    checked = {}
+    if PROBE_VERSIONS:
+        to_process, checked = _skip_processed_versions(to_process, dt_avail)
+    logging.info('Starting extension download/extract/profile process. There are {} total IDs, {} of which need to be '
+                 'processed.'.format(len(crx_list), len(to_process)))
 
     job_id = datetime.now().strftime(JOB_ID_FMT)
-    ttl_files = len(crx_list)
+    ttl_files = len(to_process)
     # The code below needs to handle floats because TEST_LIMIT might be infinity
     ttl_chunks = ceil(min(float(ttl_files), TEST_LIMIT) / CHUNK_SIZE)
 
-    for chunk_num, sub_list in enumerate(chunkify(crx_list, CHUNK_SIZE)):
-        chord((process_crx.s(make_crx_obj(crx, dt_avail, num, ttl_files)) for crx, num in sub_list))(
+    for chunk_num, sub_list in enumerate(chunkify(enumerate(to_process, 1), CHUNK_SIZE)):
+        chord((process_crx.s(make_crx_obj(crx, dt_avail, num, ttl_files, checked.get(crx)))
+               for num, crx in sub_list))(
             summarize.s(job_id=job_id, chunk_num=chunk_num, ttl_chunks=ttl_chunks))
 
 
-def make_crx_obj(id_, dt_avail, job_num, job_ttl):
-    return {'id': id_, 'dt_avail': dt_avail, 'msgs': [], 'job_num': job_num, 'job_ttl': job_ttl}
+def _skip_processed_versions(ids, dt_avail):
+    """Return the IDs of the extensions that need to be processed.
+
+    The current versions of the extensions are checked in batches with
+    :func:`~crawl.webstore_iface.probe_versions`. Extensions whose current
+    version has already been processed (see
+    :func:`~crawl.db_iface.db_processed_versions`) and extensions the update
+    server has no version for are left out. Extensions whose version couldn't
+    be checked are kept.
+
+    :param crawl.id_store.IdStore ids: IDs of all the listed extensions.
+    :param dict dt_avail: Date and time the list was downloaded.
+    :return: The IDs to process, and the current version of each of them
+        whose version was checked.
+    :rtype: tuple(crawl.id_store.IdStore, dict)
+    """
+    logging.info('Checking the current versions of {} extensions.'.format(len(ids)))
+    skip = []
+    checked = {}
+    num_processed = 0
+    num_unavailable = 0
+    for versions in probe_versions(ids, UPDATE_CHECK_URL):
+        unavailable = [crx_id for crx_id, ver in versions.items() if ver is None]
+        processed = db_processed_versions(versions, dt_avail)
+        skip.append(pack_ids(unavailable))
+        skip.append(pack_ids(processed))
+        num_unavailable += len(unavailable)
+        num_processed += len(processed)
+        checked.update((crx_id, ver) for crx_id, ver in versions.items() if ver is not None and crx_id not in processed)
+    logging.info('{} extensions already have their current version in the DB, {} have no version available.'.
+                 format(num_processed, num_unavailable))
+
+    to_process, _ = ids.diff(IdStore.from_packed(skip))
+    return to_process, checked
+
+
+def make_crx_obj(id_, dt_avail, job_num, job_ttl, checked_version=None):
+    return {'id': id_, 'dt_avail': dt_avail, 'msgs': [], 'job_num': job_num, 'job_ttl': job_ttl,
+            'checked_version': checked_version}
 
 
 @app.task(send_error_emails=True, base=SqlAlchemyTask)
@@ -145,7 +211,7 @@ def start_redo_extract_profile():
     logging.info('Beginning re-profiling process of all CRXs already downloaded.')
 
     job_id = datetime.now().strftime(JOB_ID_FMT)
-    ttl_files = ttl_files_in_dir(_conf.save_path, pat='crx')
+    ttl_files = len(CrxStore(_conf.save_path))
     # The code below needs to handle floats because TEST_LIMIT might be infinity
     ttl_chunks = ceil(min(float(ttl_files), TEST_LIMIT) / CHUNK_SIZE)
 
@@ -154,6 +220,25 @@ def start_redo_extract_profile():
             summarize.s(job_id=job_id, chunk_num=chunk_num, ttl_chunks=ttl_chunks))
 
 
+@app.task(send_error_emails=True, base=SqlAlchemyTask)
+def start_import_crx_store():
+    """Move the CRXs saved by older versions of dbling into the CRX store.
+
+    CRXs used to be saved as ``<id>_<version>.crx`` directly in
+    ``_conf.save_path``. Those aren't in the store's index, so
+    :func:`start_redo_extract_profile` doesn't see them until they're moved
+    into the store by :meth:`~crawl.crx_store.CrxStore.import_flat`. This
+    only needs to be run once, after upgrading, and it's safe to run again
+    if it's interrupted. It isn't scheduled, so start it by hand::
+
+        celery -A crawl call crawl.tasks.start_import_crx_store
+    """
+    logging.info('Moving the CRXs in {} into the CRX store.'.format(_conf.save_path))
+    t1 = perf_counter()
+    num = CrxStore(_conf.save_path).import_flat(limit=TEST_LIMIT)
+    logging.info('Moved {} CRXs into the CRX store in {}.'.format(num, timedelta(seconds=(perf_counter() - t1))))
+
+
 #####################
 #
 #   Entry Points
@@ -190,6 +275,12 @@ def process_crx(crx_obj):
       profiling the extension.
     - ``stop_processing``: Flag indicating an error during processing.
 
+    If the download is throttled (see :mod:`crawl.throttle`), the task is
+    retried once the host is expected to be ready again, instead of having
+    the worker wait for it. After :data:`MAX_THROTTLED_RETRIES` retries, the
+    CRX is given up on like any other failed download, so the chord still
+    completes.
+
     :param crx_obj: Details of a single CRX, which gets updated at every step.
     :type crx_obj: Munch
     :return: Error or success message describing status. These messages from
@@ -200,17 +291,29 @@ def process_crx(crx_obj):
     # This flag tells us if any error occur that are bad enough we should stop processing the CRX
     crx_obj.stop_processing = False
 
-    with TemporaryDirectory(dir=_conf.extract_dir) as extracted_path, \
-            EncryptedTempDirectory(dir=_conf.extract_dir, upper_dir=extracted_path) as enc_extracted_path:
-        # These temporary directories will only exist within this "with" clause
-        crx_obj.extracted_path = extracted_path
-        crx_obj.enc_extracted_path = enc_extracted_path
-
-        # The three steps
-        for step in (download_crx, extract_crx, profile_crx):
-            crx_obj = step(crx_obj)
-            if crx_obj.stop_processing:
-                break
+    try:
+        with TemporaryDirectory(dir=_conf.extract_dir) as extracted_path, \
+                EncryptedTempDirectory(dir=_conf.extract_dir, upper_dir=extracted_path) as enc_extracted_path:
+            # These temporary directories will only exist within this "with" clause
+            crx_obj.extracted_path = extracted_path
+            crx_obj.enc_extracted_path = enc_extracted_path
+
+            # The three steps
+            for step in (download_crx, extract_crx, profile_crx):
+                crx_obj = step(crx_obj)
+                if crx_obj.stop_processing:
+                    break
+    except HostThrottled as err:
+        # Once the retries run out, retry() would raise the error, which would fail the whole chord
+        if process_crx.request.retries >= MAX_THROTTLED_RETRIES:
+            logging.warning('{} [{}/{}]  {}, giving up after {} retries'.
+                            format(crx_obj.id, crx_obj.job_num, crx_obj.job_ttl, err, MAX_THROTTLED_RETRIES))
+            crx_obj.msgs.append('-Download throttled')
+            crx_obj.stop_processing = True
+            return crx_obj.msgs
+        logging.debug('{} [{}/{}]  {}, retrying the CRX later'.format(crx_obj.id, crx_obj.job_num, crx_obj.job_ttl,
+                                                                      err))
+        raise process_crx.retry(exc=err, countdown=err.retry_after, max_retries=MAX_THROTTLED_RETRIES)
 
     log = logging.info if not (crx_obj.job_num % PROGRESS_PERIOD) else logging.debug
     log('{} [{}/{}]  Completed processing CRX'.format(crx_obj.id, crx_obj.job_num, crx_obj.job_ttl))
@@ -328,11 +431,10 @@ def download_crx(crx_obj):
         crx_obj.stop_processing = True
 
     except FileExistsError as err:
-        # Only happens when the versions match and we've chosen not to overwrite the previous file. In such a case,
-        # there's no guarantee that the other file made it through the whole profiling process, so we need to
-        # extract the crx_path from the error message so we can still profile it.
+        # Only happens when this version is already in the CRX store. In such a case, there's no guarantee that the
+        # other file made it through the whole profiling process, so we need to get the stored CRX's path from the
+        # error so we can still profile it. The version was already set by save_crx().
         crx_obj.full_path = err.filename
-        crx_obj.version = get_crx_version(crx_obj.full_path)
         crx_obj.msgs.append('+CRX download completed, but version matched previously downloaded file. '
                             'Profiling old file.')
 
@@ -362,6 +464,10 @@ def download_crx(crx_obj):
     except DbActionFailed:
         crx_obj.msgs.append('-DB action failed while saving download information')
 
+    except HostThrottled:
+        # Not an error, process_crx() will retry the CRX later
+        raise
+
     except:
         logging.critical('{} [{}/{}]  An unknown error occurred while downloading'.
                          format(crx_obj.id, crx_obj.job_num, crx_obj.job_ttl), exc_info=1)
@@ -644,9 +750,13 @@ def summarize(self, jobs, *, job_id, chunk_num, ttl_chunks):
 
 
 def crxs_on_disk(crx_dir=_conf.save_path, limit=float('inf')):
-    """Generate crx_obj dicts for CRXs already downloaded to ``crx_dir``.
+    """Generate crx_obj dicts for CRXs already downloaded to the store in ``crx_dir``.
+
+    The CRXs are listed from the store's index, so the directory itself isn't
+    listed.
 
-    :param str crx_dir: Directory where the CRXs are saved when downloaded.
+    :param str crx_dir: Directory of the :class:`~crawl.crx_store.CrxStore`
+        where the CRXs are saved when downloaded.
     :param limit: When testing, this can be set to a number, and only that
         many CRXs will be returned. If the value of limit is a `float` instead
         of an `int` it should be infinity (e.g. ``float('inf')``).
@@ -662,20 +772,17 @@ def crxs_on_disk(crx_dir=_conf.save_path, limit=float('inf')):
         - ``full_path``
     :rtype: dict
     """
-    ttl = ttl_files_in_dir(crx_dir, pat='crx')
+    store = CrxStore(crx_dir)
+    ttl = len(store)
     logging.info('Total number of CRXs on disk: {}'.format(ttl))
     if limit != float('inf'):
         logging.info('... but ony {} will be processed while testing.'.format(limit))
     num = 0
 
-    for filename in listdir(crx_dir):
-        if filename == '0' or filename.rfind('.crx', -4) == -1:
-            continue
-
+    for crx, version, full_path in store:
         num += 1
-        crx, version = get_id_version(filename)
         if num > limit:
-            raise StopIteration
+            return
 
         yield {
             'id': crx,
@@ -683,6 +790,6 @@ def crxs_on_disk(crx_dir=_conf.save_path, limit=float('inf')):
             'msgs': [],
             'job_num': num,
             'job_ttl': ttl,
-            'filename': filename,
-            'full_path': path.join(crx_dir, filename),
+            'filename': '{}_{}.crx'.format(crx, version),
+            'full_path': full_path,
         }
@@ -0,0 +1,199 @@
+# *-* coding: utf-8 *-*
+"""Back off from hosts that are failing or throttling us, without tying up workers.
+
+Every HTTP request the crawler makes goes through :data:`HOSTS`, the
+:class:`HostThrottle` of the current process, which keeps the state of each
+host:
+
+- After a failed request, the next attempt waits a jittered, exponentially
+  growing delay (:func:`backoff_delay`), or as long as the server asked for
+  in a ``Retry-After`` header (:func:`parse_retry_after`).
+- Each ``429 Too Many Requests`` response doubles the time kept between
+  requests to the host, and each success shrinks it again.
+- After :data:`BREAKER_THRESHOLD` failures in a row, the host's circuit
+  breaker opens, and no requests are made to it for
+  :data:`BREAKER_COOLDOWN` seconds.
+
+A worker only waits inline for short delays. When a host won't be ready for
+more than :data:`MAX_INLINE_WAIT` seconds, :exc:`HostThrottled` is raised
+instead, so the Celery task can be retried later and the worker slot used
+for something else.
+"""
+
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+__all__ = ['HostThrottled', 'HostThrottle', 'HOSTS', 'backoff_delay', 'parse_retry_after', 'RETRY_STATUSES']
+
+#: HTTP status codes that mean the request should be tried again later
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+#: Delay before the first retry, in seconds, before jitter
+BACKOFF_BASE = 2.0
+#: Longest delay between retries, in seconds, before jitter
+BACKOFF_MAX = 120.0
+#: Number of failures in a row after which no requests are made to a host for a while
+BREAKER_THRESHOLD = 5
+#: Seconds a host is paused for once its circuit breaker opens
+BREAKER_COOLDOWN = 60.0
+#: Smallest and largest number of seconds kept between requests to a host that has sent 429 responses
+MIN_INTERVAL = 0.1
+MAX_INTERVAL = 30.0
+#: Longest delay, in seconds, a worker waits for a host before raising HostThrottled
+MAX_INLINE_WAIT = 10.0
+
+
+class HostThrottled(Exception):
+    """Raised when a host won't be ready for another request for a while."""
+
+    def __init__(self, host, retry_after):
+        """
+        :param str host: The host that is throttled.
+        :param float retry_after: Seconds until the host is expected to be
+            ready again.
+        """
+        super().__init__('{} is throttled for another {:.1f} seconds'.format(host, retry_after))
+        self.host = host
+        self.retry_after = retry_after
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    """Return how long to wait before retrying, with "full jitter".
+
+    The delay is random, between zero and ``base * 2**attempt`` (but no more
+    than ``cap``), so workers that failed at the same time don't all retry at
+    the same time.
+
+    :param int attempt: Number of attempts that have failed so far, minus 1.
+    :param float base: Delay before the first retry, before jitter.
+    :param float cap: Longest delay, before jitter.
+    :rtype: float
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def parse_retry_after(value):
+    """Return the number of seconds a ``Retry-After`` header asks to wait.
+
+    :param value: The header's value, which is either a number of seconds or
+        an HTTP date. May be `None`.
+    :type value: str or None
+    :return: The number of seconds, or `None` if there is no (valid) value.
+    :rtype: float or None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class _HostState:
+    __slots__ = ('failures', 'paused_until', 'interval', 'next_slot')
+
+    def __init__(self):
+        self.failures = 0
+        self.paused_until = 0.0
+        self.interval = 0.0
+        self.next_slot = 0.0
+
+
+class HostThrottle:
+    """Keep track of when each host is ready for another request.
+
+    The methods are thread safe, so one instance is shared by all the threads
+    (and the :class:`~crawl.webstore_iface.CrxDownloader` event loop) of a
+    process.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN, clock=time.monotonic):
+        """
+        :param int threshold: Number of failures in a row after which the
+            host's circuit breaker opens.
+        :param float cooldown: Seconds a host is paused for once its circuit
+            breaker opens.
+        :param clock: Function that returns the current time in seconds.
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._clock = clock
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _state(self, host):
+        try:
+            return self._hosts[host]
+        except KeyError:
+            return self._hosts.setdefault(host, _HostState())
+
+    def reserve(self, host):
+        """Reserve the next request to ``host`` and return how long to wait before making it.
+
+        :param str host: The host the request is to.
+        :return: Seconds to wait. Zero when the request can be made now.
+        :rtype: float
+        """
+        now = self._clock()
+        with self._lock:
+            state = self._state(host)
+            if state.paused_until > now:
+                return state.paused_until - now
+            slot = max(now, state.next_slot)
+            state.next_slot = slot + state.interval
+        return slot - now
+
+    def success(self, host):
+        """Record a successful request to ``host``.
+
+        :param str host: The host the request was to.
+        :rtype: None
+        """
+        with self._lock:
+            state = self._state(host)
+            state.failures = 0
+            if state.interval:
+                state.interval = state.interval * 0.9 if state.interval > MIN_INTERVAL else 0.0
+
+    def failure(self, host, attempt, status=None, retry_after=None):
+        """Record a failed request to ``host``, and return how long to wait before retrying it.
+
+        :param str host: The host the request was to.
+        :param int attempt: Number of attempts that have failed so far for
+            this request, minus 1.
+        :param int status: The HTTP status code of the response, or `None` if
+            the request didn't get a response.
+        :param float retry_after: Seconds the response's ``Retry-After``
+            header asked to wait, if any.
+        :return: Seconds to wait before the next attempt.
+        :rtype: float
+        """
+        now = self._clock()
+        delay = max(backoff_delay(attempt), retry_after or 0.0)
+        with self._lock:
+            state = self._state(host)
+            state.failures += 1
+            if status == 429:
+                state.interval = min(MAX_INTERVAL, max(MIN_INTERVAL, state.interval * 2))
+            if state.failures >= self.threshold:
+                delay = max(delay, self.cooldown)
+                if state.paused_until <= now:
+                    logging.warning('Pausing requests to {} for {:.0f} seconds after {} failures in a row.'.
+                                    format(host, delay, state.failures))
+            if retry_after or state.failures >= self.threshold:
+                # Everyone else waits for the host too
+                state.paused_until = max(state.paused_until, now + delay)
+        return delay
+
+
+#: The throttle shared by everything in this process that makes HTTP requests
+HOSTS = HostThrottle()
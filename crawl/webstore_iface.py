@@ -3,34 +3,71 @@
 """Chrome Web Store interface for dbling."""
 
 import asyncio
+import atexit
+import json
 import logging
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from itertools import islice
 from os import path
-from tempfile import TemporaryDirectory, TemporaryFile
 from time import sleep
 from urllib.parse import urlparse, parse_qs
 
+import aiohttp
 import requests
 import uvloop
 from lxml import etree
 from requests import ConnectionError
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ChunkedEncodingError, HTTPError
 
 from common.util import validate_crx_id, get_crx_version, make_download_headers
 from common.const import CRX_URL
+from crawl.crx_store import CrxStore, InvalidCrx
+from crawl.id_store import IdStore, pack_ids
+from crawl.rate_limit import LIMITER, SITEMAP, UPDATE_CHECK, DETAIL, CRX
+from crawl.throttle import HOSTS, HostThrottled, MAX_INLINE_WAIT, RETRY_STATUSES, parse_retry_after
 
-__all__ = ['DownloadCRXList', 'save_crx', 'ListDownloadFailedError', 'ExtensionUnavailable', 'BadDownloadURL',
+__all__ = ['DownloadCRXList', 'SitemapShardCache', 'probe_versions', 'save_crx', 'CrxDownloader', 'get_crx_downloader',
+           'ListDownloadFailedError', 'ExtensionUnavailable', 'BadDownloadURL', 'IncompleteDownload',
            'VersionExtractError']
 
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 LOG_PATH = path.join(path.dirname(path.realpath(__file__)), '../log', 'crx.log')
 DBLING_DIR = path.abspath(path.join(path.dirname(path.realpath(__file__)), '..'))
+SITEMAP_CACHE_DIR = path.join(DBLING_DIR, 'cache', 'sitemaps')
 DONT_OVERWRITE_DOWNLOADED_CRX = False
 CHUNK_SIZE = 512
+#: Number of bytes of a CRX read from the response and written to disk at a time
+CRX_CHUNK_SIZE = 256 * 1024
+#: Maximum number of connections each process's CrxDownloader keeps open
+MAX_CRX_CONNECTIONS = 16
+#: Matches the first byte and total size in a Content-Range header
+CONTENT_RANGE_PAT = re.compile(r'bytes\s+(\d+)-\d+/(\d+|\*)')
+#: Timeouts for CRX downloads. There's no limit on the whole download, only on connecting and each read.
+CRX_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
 NUM_HTTP_RETIRES = 5
+#: Maximum number of sitemap shards downloaded at once, which is also the maximum number of connections to the host
+MAX_CONCURRENT_SHARDS = 16
+#: Number of bytes of a sitemap read from the response at a time
+SITEMAP_CHUNK_SIZE = 64 * 1024
+#: Matches the extension ID at the end of the path of a Web Store URL
+CRX_ID_PAT = re.compile(r'/([a-p]{32})/?(?:[?#]|$)')
+#: Number of extensions whose versions are asked for in each update check request
+UPDATE_CHECK_BATCH = 250
+#: Parameter added to an update check URL for each extension
+UPDATE_CHECK_PARAM = '&x=id%3D{}%26uc'
 
 TESTING = False  # 1000  # Set to an int when not False
 
+# Namespace tag used by update check responses
+_update_ns = '{http://www.google.com/update2/response}'
+
 
 logging.getLogger('requests').setLevel(logging.WARNING)
 
@@ -47,6 +84,10 @@ class BadDownloadURL(Exception):
     """Raised when the ID is valid but we can't download the extension."""
 
 
+class IncompleteDownload(Exception):
+    """Raised when a CRX download ends before the whole file was received."""
+
+
 class VersionExtractError(Exception):
     """Raised when extracting the version number from the URL fails."""
 
@@ -64,13 +105,17 @@ class DownloadCRXList:
     generated. In other words, instantiating this class doesn't start the
     download, iterating over the instance starts the download. This is
     significant given that downloading the list is quite time consuming.
+
+    The IDs are kept packed in an :class:`~crawl.id_store.IdStore`, see
+    :attr:`ids`.
     """
 
     # Namespace tag used by the downloaded list (XML file)
     _ns = '{http://www.sitemaps.org/schemas/sitemap/0.9}'
     list_list_url = 'https://chrome.google.com/webstore/sitemap'
 
-    def __init__(self, ext_url, *, return_count=False, session=None):
+    def __init__(self, ext_url, *, return_count=False, session=None, max_concurrent=MAX_CONCURRENT_SHARDS,
+                 cache=None):
         """
         :param str ext_url: Specially crafted URL that will let us download the
             list of extensions.
@@ -80,15 +125,26 @@ class DownloadCRXList:
             the same as ``len(DownloadCRXList)``.
         :param requests.Session session: Session object to use when downloading
             the list. If None, a new :class:`requests.Session` object is
-            created.
+            created, with a connection pool big enough for
+            ``max_concurrent`` connections.
+        :param int max_concurrent: Maximum number of extension lists
+            (sitemap shards) downloaded at once.
+        :param SitemapShardCache cache: When given, extension lists are only
+            downloaded when they have changed since they were cached.
         """
         self.ext_url = ext_url
-        self.session = session if isinstance(session, requests.Session) else requests.Session()
+        self.max_concurrent = max_concurrent
+        self.cache = cache
+        self._num_cached = 0
+        self._num_cached_lock = threading.Lock()
+        if isinstance(session, requests.Session):
+            self.session = session
+        else:
+            self.session = _pooled_session(max_concurrent)
         self._downloaded_list = False
         self.ret_tup = return_count  # Return a tuple (CRX ID, num)
-        self._id_list = []
+        self._id_list = IdStore()
         self._next_id_index = 0
-        self.sitemap_dir = None
 
     def __iter__(self):
         if not self._downloaded_list:
@@ -110,70 +166,106 @@ class DownloadCRXList:
         """Starting point for downloading all CRX IDs.
 
         This function actually creates an event loop and starts the downloads
-        asynchronously.
+        asynchronously. Since :mod:`requests` blocks, each download is run in
+        a pool of ``max_concurrent`` threads.
 
         :rtype: None
         """
         loop = asyncio.get_event_loop_policy().new_event_loop()
-        with TemporaryDirectory() as self.sitemap_dir:
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix='sitemap')
+        loop.set_default_executor(executor)
+        try:
             loop.run_until_complete(self._async_download_lists())
+        finally:
+            loop.close()
+            executor.shutdown()
         self._downloaded_list = True
 
+    @property
+    def ids(self):
+        """The downloaded IDs, which are downloaded first if they haven't been yet.
+
+        :rtype: crawl.id_store.IdStore
+        """
+        if not self._downloaded_list:
+            self.download_ids()
+        return self._id_list
+
     async def _async_download_lists(self):
         """Download, loop through the list of lists, combine IDs from each.
 
         :rtype: None
         """
         logging.info('Downloading the list of extension lists from Google.')
+        loop = asyncio.get_event_loop()
 
-        # Download the first list
-        resp = _http_get(self.list_list_url, self.session, stream=False, headers=make_download_headers())
-        if resp is None:
+        # Download the first list, extracting list URLs
+        try:
+            list_urls, _ = await loop.run_in_executor(None, self._get_locs, self.list_list_url)
+        except ListDownloadFailedError:
             logging.critical('Failed to download list of extensions.')
             raise ListDownloadFailedError('Unable to download list of extensions.')
 
-        # Save the list
-        local_sitemap = TemporaryFile(dir=self.sitemap_dir)
-        for chunk in resp.iter_content(chunk_size=None):
-            local_sitemap.write(chunk)
-        resp.close()
-
-        # Go through the list, extracting list URLs
-        ids = set()
-        local_sitemap.seek(0)
-        xml_tree = etree.parse(local_sitemap)
+        # The IDs from each list are packed as soon as the list is done, so the strings aren't kept for the whole run
+        packed = []
+        num_ids = 0
         num_lists = 0
-        duplicate_count = 0
-        for url_tag in xml_tree.iterfind('*/' + self._ns + 'loc'):
-            # Download the URL, get the IDs from it and add them to the set of IDs
-            try:
-                _ids = await self._dl_parse_id_list(url_tag.text)
-            except ListDownloadFailedError:
-                # TODO: How to handle this?
-                raise
-            else:
-                x = len(_ids)
-                y = len(ids)
-                ids |= _ids
-                duplicate_count += (y + x) - len(ids)
-            num_lists += 1
+        semaphore = asyncio.Semaphore(self.max_concurrent)
 
-        logging.info('Done downloading. Doing some cleanup...')
+        async def dl_list(list_url):
+            async with semaphore:
+                return await self._dl_parse_id_list(list_url)
 
-        # Close (and delete) the temporary file where the list was stored
-        local_sitemap.close()
+        # Start downloading all the lists, but only max_concurrent are actually downloaded at once
+        tasks = [loop.create_task(dl_list(url)) for url in list_urls]
+        try:
+            for task in asyncio.as_completed(tasks):
+                # Get the IDs from each list as it finishes and pack them
+                try:
+                    _ids = await task
+                except ListDownloadFailedError:
+                    # TODO: How to handle this?
+                    raise
+                else:
+                    packed.append(pack_ids(_ids))
+                    num_ids += len(_ids)
+                num_lists += 1
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
 
-        # Convert IDs to a list, then sort it
-        self._id_list = list(ids)
-        self._id_list.sort()
+        logging.info('Done downloading. Doing some cleanup...')
+        if self.cache is not None:
+            logging.info('{} of the {} lists were unchanged since they were cached.'.format(self._num_cached,
+                                                                                            num_lists))
+            self.cache.prune(list_urls)
+
+        # Combine the IDs into one sorted array, dropping duplicates
+        self._id_list = IdStore.from_packed(packed)
+        del packed
+        logging.warning('There were {} duplicate IDs from the {} lists.'.format(num_ids - len(self), num_lists))
         if TESTING:  # Truncate the list
             self._id_list = self._id_list[:TESTING]
 
-        logging.warning('There were {} duplicate IDs from the {} lists.'.format(duplicate_count - len(self), num_lists))
-
     async def _dl_parse_id_list(self, list_url):
         """Download the extension list at the given URL, return set of IDs.
 
+        The download is done in the event loop's executor, so other lists can
+        be downloaded at the same time.
+
+        :param str list_url: URL of an individual extension list.
+        :return: Set of CRX IDs.
+        :rtype: set
+        """
+        return await asyncio.get_event_loop().run_in_executor(None, self._get_id_list, list_url)
+
+    def _get_id_list(self, list_url):
+        """Download the extension list at the given URL, return set of IDs.
+
+        This blocks until the list has been downloaded and parsed.
+
         :param str list_url: URL of an individual extension list.
         :return: Set of CRX IDs.
         :rtype: set
@@ -184,60 +276,325 @@ class DownloadCRXList:
         shard = int(url_data['shard'][0]) + 1
         log = logging.info if not shard % 100 or shard == int(numshards) else logging.debug
         shard = ('{:0' + str(len(numshards)) + '}').format(shard)
-        _hl = hl = url_data.get('hl', '')
-        if isinstance(_hl, list):
-            hl = ' (language: {})'.format(_hl[0])
-            _hl = '_{}'.format(_hl[0])
+        hl = url_data.get('hl', '')
+        if isinstance(hl, list):
+            hl = ' (language: {})'.format(hl[0])
         list_id = '{} of {}{}'.format(shard, numshards, hl)
-        sitemap = TemporaryFile(prefix='sitemap{}_{}_{}'.format(_hl, shard, numshards), suffix='.xml',
-                                dir=self.sitemap_dir)
 
-        # Download the IDs list
-        resp = _http_get(list_url, self.session, stream=False, headers=make_download_headers())
-        if resp is None:
-            msg = 'Failed to download extension list {}.'.format(list_id)
-            logging.critical(msg)
-            raise ListDownloadFailedError(msg)
-
-        # Save the list
-        for chunk in resp.iter_content(chunk_size=None):
-            sitemap.write(chunk)
-        resp.close()
-
-        # Extract the IDs
-        ids = set()
-        sitemap.seek(0)
-        xml_tree = etree.parse(sitemap)
-        for url_tag in xml_tree.iterfind('*/' + self._ns + 'loc'):
-            # Get just the URL path (strips the scheme, netloc, params, query, and fragment segments)
-            crx_id = urlparse(url_tag.text).path
-            # Get the ID (strips everything from the path except the last part)
-            crx_id = path.basename(crx_id)
-            ids.add(crx_id)
+        def get_id(loc):
+            m = CRX_ID_PAT.search(loc)
+            if m is None:
+                logging.debug('No extension ID in URL from extension list {}: {}'.format(list_id, loc))
+                return None
+            return m.group(1)
+
+        # Download the IDs list, extracting the IDs as it's downloaded, unless it hasn't changed since it was cached
+        cached = None if self.cache is None else self.cache.get(list_url)
+        headers = None if cached is None else SitemapShardCache.conditional_headers(cached)
+        new_ids, resp_headers = self._get_locs(list_url, list_id, get_id, headers)
+        if new_ids is None:
+            ids = set(cached['ids'])
+            with self._num_cached_lock:
+                self._num_cached += 1
+            logging.debug('Extension list {} is unchanged since it was cached.'.format(list_id))
+        else:
+            ids = set(new_ids)
+            if self.cache is not None:
+                self.cache.put(list_url, ids, resp_headers)
         log('Downloaded extension list {}. Qty: {}'.format(list_id, len(ids)))
-        sitemap.close()
 
         return ids
 
+    def _get_locs(self, url, list_id=None, extract=None, headers=None):
+        """Download the sitemap at the given URL, return the URLs in its ``<loc>`` tags.
+
+        The sitemap is parsed as it's downloaded, and each ``<url>`` or
+        ``<sitemap>`` tag is freed once its location has been read, so memory
+        use doesn't depend on the size of the sitemap. If the connection fails
+        part way through, the sitemap is downloaded again, up to
+        :data:`NUM_HTTP_RETIRES` times.
+
+        :param str url: URL of the sitemap.
+        :param str list_id: Description of the sitemap for log messages.
+        :param extract: Function that is given each location, and returns
+            what should be kept from it, or `None` to skip it.
+        :param dict headers: Extra headers for the request, e.g. the ones from
+            :meth:`SitemapShardCache.conditional_headers`.
+        :return: Tuple of the list of the locations in the sitemap (or what
+            ``extract`` returned for them) and the headers of the response.
+            The list is `None` when the server responds that the sitemap is
+            unchanged (``304 Not Modified``).
+        :rtype: tuple
+        :raises ListDownloadFailedError: When the sitemap can't be downloaded,
+            including when the server responds with an error.
+        """
+        list_id = list_id or url
+        host = urlparse(url).hostname
+        for i in range(NUM_HTTP_RETIRES):
+            req_headers = make_download_headers()
+            if headers:
+                req_headers.update(headers)
+            # Only the beat task downloads the lists, so it can wait as long as it takes for the host
+            resp = _http_get(url, self.session, stream=True, headers=req_headers, max_wait=float('inf'),
+                             request_class=SITEMAP)
+            if resp is None:
+                break
+            if not resp.ok:
+                # Errors that are worth retrying have already been retried by _http_get()
+                resp.close()
+                msg = 'Failed to download extension list {} ({} {}).'.format(list_id, resp.status_code, resp.reason)
+                logging.critical(msg)
+                raise ListDownloadFailedError(msg)
+            try:
+                if resp.status_code == requests.codes.not_modified:
+                    return None, resp.headers
+                if extract is None:
+                    return list(self._iter_locs(resp)), resp.headers
+                return [x for x in map(extract, self._iter_locs(resp)) if x is not None], resp.headers
+            except (ChunkedEncodingError, ConnectionError):
+                delay = HOSTS.failure(host, i)
+                logging.debug('Connection failed while downloading extension list {}. Attempting to sleep and retry '
+                              '({} of {} retries)'.format(list_id, i+1, NUM_HTTP_RETIRES))
+                sleep(delay)
+            finally:
+                resp.close()
+
+        msg = 'Failed to download extension list {}.'.format(list_id)
+        logging.critical(msg)
+        raise ListDownloadFailedError(msg)
+
+    def _iter_locs(self, resp):
+        """Generate the text of each ``<loc>`` tag in a sitemap response, as it is read.
+
+        :param requests.Response resp: A streamed response containing the
+            sitemap.
+        :return: Generator of locations.
+        :rtype: generator
+        """
+        parser = etree.XMLPullParser(events=('end',), tag=self._ns + 'loc')
+        for chunk in resp.iter_content(chunk_size=SITEMAP_CHUNK_SIZE):
+            parser.feed(chunk)
+            for _, loc_tag in parser.read_events():
+                yield loc_tag.text
+                # Free the <url> tag containing the location, and the ones before it
+                entry = loc_tag.getparent()
+                entry.clear()
+                while entry.getprevious() is not None:
+                    del entry.getparent()[0]
+        parser.close()
+
     def __len__(self):
         return len(self._id_list)
 
 
+class SitemapShardCache:
+    """Keep the IDs from each extension list (sitemap shard) on disk.
+
+    Along with the IDs, the cache keeps the ``ETag`` and ``Last-Modified``
+    headers of the response they came from, so the next request for the
+    shard can be conditional. When the server responds with ``304 Not
+    Modified``, the cached IDs are used instead of downloading and parsing
+    the shard again.
+
+    Each shard is saved to its own JSON file, named by the hash of its URL.
+    Files are replaced atomically, so an interrupted crawl never leaves a
+    partially written entry behind.
+    """
+
+    def __init__(self, cache_dir=SITEMAP_CACHE_DIR):
+        """
+        :param str cache_dir: Directory where the cached shards are saved.
+            Created if it doesn't exist.
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, url):
+        return path.join(self.cache_dir, sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, url):
+        """Return the cached entry for the shard at the given URL.
+
+        :param str url: URL of the shard.
+        :return: Dict with the keys ``url``, ``etag``, ``last_modified``, and
+            ``ids``, or `None` if the shard isn't cached (or the cache file
+            can't be read).
+        :rtype: dict or None
+        """
+        try:
+            with open(self._path(url)) as fin:
+                entry = json.load(fin)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logging.warning('Ignoring unreadable cache entry for extension list: {}'.format(url), exc_info=1)
+            return None
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    @staticmethod
+    def conditional_headers(entry):
+        """Return the headers that make a request for a shard conditional on it having changed.
+
+        :param dict entry: The shard's cache entry, from :meth:`get`.
+        :rtype: dict
+        """
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def put(self, url, ids, resp_headers):
+        """Save the IDs from a shard along with the validators from its response.
+
+        Nothing is saved when the response had neither an ``ETag`` nor a
+        ``Last-Modified`` header, since the request for the shard couldn't be
+        made conditional anyway.
+
+        :param str url: URL of the shard.
+        :param ids: The IDs in the shard.
+        :type ids: set or list
+        :param resp_headers: The headers of the response the IDs came from.
+        :type resp_headers: requests.structures.CaseInsensitiveDict
+        :rtype: None
+        """
+        etag = resp_headers.get('ETag')
+        last_modified = resp_headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            return
+        entry = {'url': url, 'etag': etag, 'last_modified': last_modified, 'ids': sorted(ids)}
+        file_path = self._path(url)
+        tmp_path = '{}.{}.tmp'.format(file_path, threading.get_ident())
+        with open(tmp_path, 'w') as fout:
+            json.dump(entry, fout)
+        os.replace(tmp_path, file_path)
+
+    def prune(self, urls):
+        """Delete the cached shards that aren't in the given list of URLs.
+
+        :param urls: URLs of the current shards.
+        :type urls: list
+        :rtype: None
+        """
+        keep = {path.basename(self._path(url)) for url in urls}
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.json') and name not in keep:
+                os.remove(path.join(self.cache_dir, name))
+
+
+def probe_versions(ids, check_url, *, session=None, batch_size=UPDATE_CHECK_BATCH,
+                   max_concurrent=MAX_CONCURRENT_SHARDS):
+    """Ask the update server for the current version of many extensions at once.
+
+    This is the same update check Chrome does for installed extensions: each
+    request lists ``batch_size`` extension IDs, and the response gives the
+    current version of each one. That is far fewer requests than checking
+    each extension's Web Store page.
+
+    >>> for versions in probe_versions(crx_ids, update_check_url):
+    ...     for crx_id, version in versions.items():
+    ...         print(crx_id, version)
+
+    :param ids: The extension IDs to check.
+    :type ids: list or crawl.id_store.IdStore
+    :param str check_url: The update check URL, which already contains the
+        Chrome version information. The IDs are appended to it.
+    :param requests.Session session: Session object to use for the requests.
+        If None, a new :class:`requests.Session` object is created, with a
+        connection pool big enough for ``max_concurrent`` connections.
+    :param int batch_size: Number of IDs checked in each request.
+    :param int max_concurrent: Maximum number of requests made at once.
+    :return: Generator of a dict per batch, with the current version of each
+        extension keyed by its ID. Extensions the update server has no
+        version for have a version of `None`. Extensions in a batch that
+        couldn't be checked are left out.
+    :rtype: generator
+    """
+    if not isinstance(session, requests.Session):
+        session = _pooled_session(max_concurrent)
+    ids = iter(ids)
+    batches = iter(lambda: list(islice(ids, batch_size)), [])
+
+    with ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='update-check') as executor:
+        # Keep a few batches waiting for each thread, without queuing up every batch at once
+        window = deque()
+        for batch in batches:
+            window.append(executor.submit(_check_versions, batch, check_url, session))
+            if len(window) >= 2 * max_concurrent:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+
+def _check_versions(batch, check_url, session):
+    """Make one update check request for a batch of IDs. See :func:`probe_versions`.
+
+    :param list batch: The extension IDs to check.
+    :param str check_url: The update check URL.
+    :param requests.Session session: Session object to use for the request.
+    :return: The current version of each extension, keyed by its ID.
+    :rtype: dict
+    """
+    url = check_url + ''.join(UPDATE_CHECK_PARAM.format(crx_id) for crx_id in batch)
+    resp = _http_get(url, session, stream=False, max_wait=float('inf'), request_class=UPDATE_CHECK)
+    if resp is None or not resp.ok:
+        logging.warning('Update check failed for a batch of {} extensions, starting with {}.'.format(len(batch),
+                                                                                                   batch[0]))
+        return {}
+    try:
+        root = etree.fromstring(resp.content)
+    except etree.XMLSyntaxError:
+        logging.warning('Update check returned invalid XML for a batch starting with {}.'.format(batch[0]))
+        return {}
+
+    requested = set(batch)
+    versions = {}
+    for app_tag in root.iter(_update_ns + 'app'):
+        crx_id = app_tag.get('appid')
+        if crx_id not in requested:
+            continue
+        check = app_tag.find(_update_ns + 'updatecheck')
+        ok = app_tag.get('status') == 'ok' and check is not None and check.get('status') == 'ok'
+        versions[crx_id] = check.get('version') if ok else None
+    return versions
+
+
 def save_crx(crx_obj, download_url, save_path=None, session=None):
-    """Download the CRX, save in the ``save_path`` directory.
+    """Download the CRX, save it in the :class:`~crawl.crx_store.CrxStore` in the ``save_path`` directory.
 
-    The saved file will have the format: ``<extension ID>_<version>.crx``
+    The CRX is saved under the digest of its bytes, so if the same bytes are
+    already in the store, they aren't saved again.
 
     If ``save_path`` isn't given, this will default to a directory called
     "downloads" in the CWD.
 
+    Unless a ``session`` is given, the download is done by this process's
+    :class:`CrxDownloader`, which keeps its connections open between
+    downloads and checks that the extension is still available while the
+    download is starting.
+
+    If ``crx_obj`` has a ``checked_version``, the update server has just
+    given a version of the extension (see :func:`probe_versions`), so the
+    extension's Web Store page isn't checked, and an interrupted download of
+    that version is resumed.
+
+    If the download is throttled or the connection keeps failing, the partial
+    CRX is kept, so the next download of this version can resume it. It's
+    only removed when it can't be used, e.g. when it's the wrong size.
+
     Adds the following keys to ``crx_obj``:
 
     - ``version``: Version number of the extension, as obtained from the final
       URL of the download. This may differ from the version listed in the
       extension's manifest.
-    - ``filename``: The basename of the CRX file (not the full path)
-    - ``full_path``: The location (full path) of the downloaded CRX file
+    - ``filename``: Name of the CRX in the format ``<extension ID>_<version>.crx``
+    - ``part_path``: The location of the download while it's in progress. Only
+      this download writes to it (see :meth:`~crawl.crx_store.CrxStore.claim_part`).
+    - ``full_path``: The location (full path) of the downloaded CRX file in
+      the store
 
     :param crx_obj: Previously collected information about the extension.
     :type crx_obj: munch.Munch
@@ -246,55 +603,533 @@ def save_crx(crx_obj, download_url, save_path=None, session=None):
     :type download_url: str
     :param save_path: Directory where the CRX should be saved.
     :type save_path: str or None
-    :param session: Optional :class:`~requests.Session` object to use for HTTP requests.
+    :param session: Optional :class:`~requests.Session` object to use for HTTP
+        requests instead of the process's :class:`CrxDownloader`.
     :type session: requests.Session or None
     :return: Updated version of ``crx_obj`` with ``version``, ``filename``, and
         ``full_path`` information added. If the download wasn't successful, not
         all of these may have been added, depending on when it failed.
     :rtype: munch.Munch
+    :raises FileExistsError: If this version of the CRX is already in the
+        store. Its ``filename`` is the path of the stored CRX.
     """
+    if not isinstance(session, requests.Session):
+        return get_crx_downloader().save_crx(crx_obj, download_url, save_path)
+    store = _crx_store(save_path)
 
     # Check that the ID has a valid form
     validate_crx_id(crx_obj.id)
 
-    # Ensure the extension is still available in the Web Store
-    url = CRX_URL % crx_obj.id
-    resp = _http_get(url, session)
-    _ensure_redirect(resp)
-    resp.close()
+    # Ensure the extension is still available in the Web Store, unless the update server just said it is
+    if not crx_obj.get('checked_version'):
+        url = CRX_URL % crx_obj.id
+        resp = _http_get(url, session, request_class=DETAIL)
+        if resp is None:
+            raise ConnectionError('Failed to check that {} is available'.format(crx_obj.id))
+        resp.close()
+        resp.raise_for_status()
+        _ensure_redirect(resp)
 
-    # If the URL we got back was the same one we requested, the download failed
-    if url == resp.url:
-        raise BadDownloadURL
+        # If the URL we got back was the same one we requested, the download failed
+        if url == resp.url:
+            raise BadDownloadURL
+
+    # Make the new request to actually download the extension, resuming it if the connection fails part way through
+    try:
+        for i in range(NUM_HTTP_RETIRES):
+            resp = _http_get(download_url.format(crx_obj.id), session, stream=True, request_class=CRX,
+                             headers=_resume_headers(crx_obj, store))
+            if resp is None:
+                raise ConnectionError('Failed to download {}'.format(crx_obj.id))
+            try:
+                resp.raise_for_status()
+                _set_crx_path(crx_obj, resp.url, store)
+                mode, total = _open_part(crx_obj, resp.status_code, resp.headers)
+                with open(crx_obj.part_path, mode, buffering=CRX_CHUNK_SIZE) as fout:
+                    for chunk in resp.iter_content(chunk_size=CRX_CHUNK_SIZE):
+                        fout.write(chunk)
+                _finish_part(crx_obj, total, store)
+                return crx_obj
+            except (ChunkedEncodingError, ConnectionError, IncompleteDownload) as err:
+                if i + 1 == NUM_HTTP_RETIRES:
+                    raise ConnectionError('Failed to download {}: {!r}'.format(crx_obj.id, err))
+                logging.debug('{}  Download interrupted, resuming it ({} of {} retries)'.
+                              format(crx_obj.id, i+1, NUM_HTTP_RETIRES))
+            finally:
+                resp.close()
+    except (HostThrottled, ConnectionError, ChunkedEncodingError):
+        # The next download of this version can pick up where this one stopped
+        _release_part(crx_obj)
+        raise
+    except BaseException:
+        _remove_part(crx_obj)
+        raise
+
+
+def _crx_store(save_path=None):
+    if save_path is None:
+        save_path = path.join('.', 'downloads')
+    return CrxStore(save_path)
 
-    # Make the new request to actually download the extension
-    resp = _http_get(download_url.format(crx_obj.id), session, stream=True)
 
+def _set_crx_path(crx_obj, final_url, store):
+    """Set the version and download path of a CRX from the final URL of its download.
+
+    :param crx_obj: Previously collected information about the extension.
+    :type crx_obj: munch.Munch
+    :param str final_url: The URL the download was redirected to.
+    :param CrxStore store: The store the CRX should be saved in.
+    :rtype: None
+    :raises VersionExtractError: If the URL doesn't contain the version.
+    :raises FileExistsError: If the CRX has already been saved. The CRX's
+        ``full_path`` is set to the stored CRX.
+    """
     try:
-        crx_obj.version = get_crx_version(resp.url.rsplit('extension', 1)[-1])
+        crx_obj.version = get_crx_version(final_url.rsplit('extension', 1)[-1])
     except IndexError:
         raise VersionExtractError('{}  Problem with extracting CRX version from URL\n  URL: {}\n  Split URL: {}'.
-                                  format(crx_obj.id, resp.url, resp.url.rsplit('extension', 1)[-1]))
+                                  format(crx_obj.id, final_url, final_url.rsplit('extension', 1)[-1]))
     crx_obj.filename = '{}_{}.crx'.format(crx_obj.id, crx_obj.version)  # <ID>_<version>
 
-    if save_path is None:
-        save_path = path.join('.', 'downloads')
-    crx_obj.full_path = path.abspath(path.join(save_path, crx_obj.filename))
-
-    if path.exists(crx_obj.full_path):
+    full_path = store.lookup(crx_obj.id, crx_obj.version)
+    if full_path is None:
+        # The part claimed for the checked version (or by an earlier attempt) is only right if the version matches
+        part_path = crx_obj.get('part_path')
+        if part_path is None or not part_path.startswith(store.incoming_path(crx_obj.id, crx_obj.version) + '.'):
+            _release_part(crx_obj)
+            crx_obj.part_path = store.claim_part(crx_obj.id, crx_obj.version)
+    else:
+        crx_obj.full_path = full_path
         err = FileExistsError()
         err.errno = ''
         err.strerror = 'Cannot save CRX to path that already exists'
         err.filename = crx_obj.full_path
         raise err
 
-    with open(crx_obj.full_path, 'wb') as fout:
-        # Write the binary response to the file 512 bytes at a time
-        for chunk in resp.iter_content(chunk_size=512):
-            fout.write(chunk)
-    resp.close()
 
-    return crx_obj
+def _resume_headers(crx_obj, store):
+    """Return the headers for a CRX download, asking for the rest of the partial download if there is one.
+
+    :param crx_obj: Previously collected information about the extension.
+        When ``part_path`` has been set by an earlier attempt, the download
+        resumes from the end of that attempt's partial file. Otherwise, when
+        ``checked_version`` is set, an interrupted download of that version
+        is claimed and resumed.
+    :type crx_obj: munch.Munch
+    :param CrxStore store: The store the CRX should be saved in.
+    :rtype: dict
+    """
+    # Sizes are only comparable if the content isn't compressed
+    headers = {'Accept-Encoding': 'identity'}
+    part_path = crx_obj.get('part_path')
+    if part_path is None and crx_obj.get('checked_version'):
+        part_path = crx_obj.part_path = store.claim_part(crx_obj.id, crx_obj.checked_version)
+    if part_path and path.exists(part_path) and path.getsize(part_path):
+        headers['Range'] = 'bytes={}-'.format(path.getsize(part_path))
+    return headers
+
+
+def _open_part(crx_obj, status, resp_headers):
+    """Decide how to write a CRX download response to the partial file.
+
+    :param crx_obj: Previously collected information about the extension,
+        including ``part_path``.
+    :type crx_obj: munch.Munch
+    :param int status: Status code of the response.
+    :param resp_headers: Headers of the response.
+    :type resp_headers: dict
+    :return: The mode to open the partial file with (``'ab'`` to append the
+        response to the file, ``'wb'`` to replace the file with it), and the
+        total size of the CRX, or `None` if it's unknown.
+    :rtype: tuple
+    :raises IncompleteDownload: If the response is a different part of the
+        CRX than the one requested. The partial file is removed, so the next
+        attempt starts over.
+    """
+    part_path = crx_obj.part_path
+    if status == 206:
+        m = CONTENT_RANGE_PAT.match(resp_headers.get('Content-Range', ''))
+        if m is None or not path.exists(part_path) or int(m.group(1)) != path.getsize(part_path):
+            _remove_part(crx_obj)
+            raise IncompleteDownload('{}  Got the wrong part of the CRX ({})'.
+                                     format(crx_obj.id, resp_headers.get('Content-Range')))
+        return 'ab', None if m.group(2) == '*' else int(m.group(2))
+
+    length = resp_headers.get('Content-Length')
+    if length is None or resp_headers.get('Content-Encoding', 'identity') != 'identity':
+        return 'wb', None
+    return 'wb', int(length)
+
+
+def _finish_part(crx_obj, total, store):
+    """Check the size of a finished download, and move it into the store.
+
+    Sets the CRX's ``full_path`` to its path in the store.
+
+    :param crx_obj: Previously collected information about the extension,
+        including ``part_path``.
+    :type crx_obj: munch.Munch
+    :param total: The expected size of the CRX, or `None` if it's unknown.
+    :type total: int or None
+    :param CrxStore store: The store the CRX should be saved in.
+    :rtype: None
+    :raises IncompleteDownload: If the partial file isn't the size of the
+        CRX, or isn't a CRX. The partial file is removed, so the next attempt
+        starts over.
+    """
+    size = path.getsize(crx_obj.part_path)
+    if total is not None and size != total:
+        _remove_part(crx_obj)
+        raise IncompleteDownload('{}  Downloaded {} of {} bytes'.format(crx_obj.id, size, total))
+    try:
+        crx_obj.full_path = store.put(crx_obj.part_path, crx_obj.id, crx_obj.version)
+    except InvalidCrx as err:
+        _remove_part(crx_obj)
+        raise IncompleteDownload('{}  {}'.format(crx_obj.id, err))
+
+
+def _remove_part(crx_obj):
+    part_path = crx_obj.get('part_path')
+    if part_path and path.exists(part_path):
+        os.remove(part_path)
+
+
+def _release_part(crx_obj):
+    part_path = crx_obj.pop('part_path', None)
+    if part_path:
+        CrxStore.release_part(part_path)
+
+
+def _real_threading():
+    """Return the :mod:`threading` module and a function that waits on it from the current thread.
+
+    When Celery runs the worker with the eventlet pool, :mod:`threading` is
+    monkey patched to make green threads. The event loop of a
+    :class:`CrxDownloader` needs a real thread, and green threads have to
+    wait on it through eventlet's thread pool so the others can keep running.
+
+    :rtype: tuple
+    """
+    try:
+        from eventlet import patcher, tpool
+    except ImportError:
+        return threading, lambda f: f()
+    if not patcher.is_monkey_patched('thread'):
+        return threading, lambda f: f()
+    return patcher.original('threading'), tpool.execute
+
+
+class _IoThreads:
+    """Run the blocking calls of an event loop (file and database access) in a few real threads.
+
+    The CRXs are usually saved over ``sshfs``, so a single slow write made in
+    the event loop's thread would hold up every download. This is used
+    instead of :meth:`asyncio.AbstractEventLoop.run_in_executor` because the
+    default executor makes green threads when the worker runs with the
+    eventlet pool (see :func:`_real_threading`).
+    """
+
+    def __init__(self, loop, threading_mod, num_threads):
+        """
+        :param loop: The event loop that waits on the calls.
+        :param threading_mod: The (real) :mod:`threading` module to make the
+            threads with.
+        :param int num_threads: Number of threads.
+        """
+        self._loop = loop
+        self._calls = deque()
+        self._ready = threading_mod.Semaphore(0)
+        self._threads = [threading_mod.Thread(target=self._work, name='crx-io', daemon=True)
+                         for _ in range(num_threads)]
+        for t in self._threads:
+            t.start()
+
+    def _work(self):
+        while True:
+            self._ready.acquire()
+            call = self._calls.popleft()
+            if call is None:
+                return
+            fut, func, args = call
+            try:
+                result = func(*args)
+            except BaseException as err:
+                self._loop.call_soon_threadsafe(_settle, fut, None, err)
+            else:
+                self._loop.call_soon_threadsafe(_settle, fut, result, None)
+
+    def run(self, func, *args):
+        """Call ``func(*args)`` in one of the threads.
+
+        Must be called from the event loop.
+
+        :return: Future of what the function returns.
+        :rtype: asyncio.Future
+        """
+        fut = self._loop.create_future()
+        self._calls.append((fut, func, args))
+        self._ready.release()
+        return fut
+
+    def close(self):
+        """Stop the threads once the calls already made are done.
+
+        :rtype: None
+        """
+        for _ in self._threads:
+            self._calls.append(None)
+            self._ready.release()
+
+
+def _settle(fut, result, err):
+    # The task waiting on the call may have been cancelled in the meantime
+    if fut.cancelled():
+        return
+    if err is not None:
+        fut.set_exception(err)
+    else:
+        fut.set_result(result)
+
+
+class CrxDownloader:
+    """Download CRXs with :mod:`aiohttp` over a pool of persistent connections.
+
+    Each process has one downloader (see :func:`get_crx_downloader`), whose
+    event loop runs in its own thread, so every task in the process shares
+    its connections. For each CRX whose version hasn't been checked, the Web
+    Store detail page is checked at the same time as the download starts,
+    and nothing is written until the check passes. Files are written, and the CRX store's index queried, in
+    the downloader's I/O threads, so the event loop never waits on the disk.
+
+    >>> downloader = get_crx_downloader()
+    >>> crx_obj = downloader.save_crx(crx_obj, download_url, save_path)
+    """
+
+    def __init__(self, connections=MAX_CRX_CONNECTIONS):
+        """
+        :param int connections: Maximum number of connections kept open.
+        """
+        self.connections = connections
+        self._threading, self._wait = _real_threading()
+        self._start_lock = self._threading.Lock()
+        self._loop = None
+        self._session = None
+        self._io = None
+        self._pid = None
+
+    def _start(self):
+        # A forked worker process doesn't have the parent's thread, so it needs its own event loop
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._loop = asyncio.get_event_loop_policy().new_event_loop()
+            self._io = _IoThreads(self._loop, self._threading, self.connections)
+            started = self._threading.Event()
+            self._threading.Thread(target=self._run_loop, args=(started,), name='crx-download', daemon=True).start()
+            started.wait()
+            self._pid = os.getpid()
+
+    def _run_loop(self, started):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._open_session())
+        started.set()
+        self._loop.run_forever()
+
+    async def _open_session(self):
+        connector = aiohttp.TCPConnector(limit=self.connections, limit_per_host=self.connections)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=CRX_TIMEOUT)
+
+    def run(self, coro):
+        """Run a coroutine in the downloader's event loop and return its result.
+
+        :param coro: The coroutine, e.g. from :meth:`async_save_crx`.
+        :return: Whatever the coroutine returns.
+        """
+        self._start()
+        done = self._threading.Event()
+        outcome = {}
+
+        def finished(task):
+            try:
+                outcome['result'] = task.result()
+            except BaseException as err:
+                outcome['error'] = err
+            done.set()
+
+        self._loop.call_soon_threadsafe(lambda: self._loop.create_task(coro).add_done_callback(finished))
+        self._wait(done.wait)
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['result']
+
+    def save_crx(self, crx_obj, download_url, save_path=None):
+        """Download the CRX and save it, blocking until it's done. See :func:`save_crx`.
+
+        :rtype: munch.Munch
+        """
+        return self.run(self.async_save_crx(crx_obj, download_url, save_path))
+
+    async def async_save_crx(self, crx_obj, download_url, save_path=None):
+        """Download the CRX and save it. See :func:`save_crx`.
+
+        Must be run in the downloader's event loop, e.g. with :meth:`run`.
+
+        :rtype: munch.Munch
+        """
+        validate_crx_id(crx_obj.id)
+        store = _crx_store(save_path)
+        io = self._io.run
+
+        # Start checking the extension is still available in the Web Store, but don't wait for it
+        probe = None
+        if not crx_obj.get('checked_version'):
+            probe = asyncio.ensure_future(self._fetch(CRX_URL % crx_obj.id, self._check_available, DETAIL))
+
+        async def save(resp):
+            if probe is not None:
+                await probe
+            await io(_set_crx_path, crx_obj, str(resp.url), store)
+            mode, total = await io(_open_part, crx_obj, resp.status, resp.headers)
+            fout = await io(open, crx_obj.part_path, mode)
+            # Write whole buffers at a time, so there's only one trip to an I/O thread per CRX_CHUNK_SIZE bytes
+            buf = bytearray()
+            try:
+                async for chunk in resp.content.iter_any():
+                    buf += chunk
+                    if len(buf) >= CRX_CHUNK_SIZE:
+                        data, buf = buf, bytearray()
+                        await io(fout.write, data)
+            finally:
+                # Even if the connection failed, what was received can be resumed from
+                try:
+                    if buf:
+                        await io(fout.write, buf)
+                finally:
+                    await io(fout.close)
+            await io(_finish_part, crx_obj, total, store)
+
+        # If the connection fails part way through, each retry resumes where the last one stopped
+        try:
+            await self._fetch(download_url.format(crx_obj.id), save, CRX, lambda: _resume_headers(crx_obj, store))
+        except (HostThrottled, ConnectionError):
+            # The next download of this version can pick up where this one stopped
+            await io(_release_part, crx_obj)
+            raise
+        except BaseException:
+            await io(_remove_part, crx_obj)
+            raise
+        finally:
+            if probe is not None:
+                if not probe.done():
+                    probe.cancel()
+                # Collect the probe's exception if the download failed first
+                await asyncio.gather(probe, return_exceptions=True)
+        return crx_obj
+
+    @staticmethod
+    async def _check_available(resp):
+        # Same checks as the blocking version in save_crx()
+        if not len(resp.history):
+            raise ExtensionUnavailable('No redirect occurred while fetching URL %s' % resp.url)
+        if resp.url == resp.history[0].url:
+            raise BadDownloadURL
+
+    async def _fetch(self, url, handle, request_class=None, headers=None):
+        """GET the URL and pass the response to ``handle``, retrying on failure.
+
+        Connection errors and the responses in
+        :data:`~crawl.throttle.RETRY_STATUSES` are retried up to
+        :data:`NUM_HTTP_RETIRES` times, as paced by
+        :data:`~crawl.throttle.HOSTS`. Other HTTP errors are not retried.
+
+        :param str url: The URL to GET.
+        :param handle: Coroutine function that is given the response.
+        :param str request_class: The request's class for
+            :data:`~crawl.rate_limit.LIMITER`.
+        :param headers: Function that returns the headers for each attempt.
+            It's called in one of the I/O threads, so it may access files.
+        :return: Whatever ``handle`` returns.
+        :raises requests.HTTPError: If the server responds with an error.
+        :raises requests.ConnectionError: If the request never succeeds.
+        :raises crawl.throttle.HostThrottled: If the host won't be ready for
+            another attempt for more than
+            :data:`~crawl.throttle.MAX_INLINE_WAIT` seconds.
+        """
+        host = urlparse(url).hostname
+        error = None
+        for i in range(NUM_HTTP_RETIRES):
+            # Reserving a request is a round trip to memcached, which may be retried, so it's done in an I/O thread
+            await asyncio.sleep(await self._io.run(_reserve_request, host, request_class, MAX_INLINE_WAIT))
+
+            status = retry_after = None
+            req_headers = None if headers is None else await self._io.run(headers)
+            try:
+                async with self._session.get(url, headers=req_headers) as resp:
+                    if resp.status not in RETRY_STATUSES:
+                        HOSTS.success(host)
+                        resp.raise_for_status()
+                        return await handle(resp)
+                    status = resp.status
+                    retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+                    error = aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status,
+                                                        message=resp.reason, headers=resp.headers)
+            except aiohttp.ClientResponseError as err:
+                raise _as_http_error(err)
+            except (aiohttp.ClientError, asyncio.TimeoutError, IncompleteDownload) as err:
+                error = err
+
+            delay = HOSTS.failure(host, i, status, retry_after)
+            if i + 1 == NUM_HTTP_RETIRES:
+                break
+            if delay > MAX_INLINE_WAIT:
+                raise HostThrottled(host, delay)
+            logging.debug('Encountered error while downloading. Attempting to sleep and retry ({} of {} retries)'.
+                          format(i+1, NUM_HTTP_RETIRES))
+            await asyncio.sleep(delay)
+
+        if isinstance(error, aiohttp.ClientResponseError):
+            raise _as_http_error(error)
+        raise ConnectionError('Failed to download {}: {!r}'.format(url, error))
+
+    def close(self):
+        """Close the connections and stop the event loop.
+
+        :rtype: None
+        """
+        if self._pid != os.getpid():
+            return
+        self.run(self._session.close())
+        self._io.close()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._pid = None
+
+
+def _as_http_error(err):
+    """Convert an :mod:`aiohttp` response error to the :class:`requests.HTTPError` callers expect.
+
+    :param aiohttp.ClientResponseError err: The error.
+    :rtype: requests.HTTPError
+    """
+    resp = requests.Response()
+    resp.status_code = err.status
+    resp.reason = err.message
+    resp.url = str(err.request_info.real_url)
+    return HTTPError('{} Error: {} for url: {}'.format(err.status, err.message, resp.url), response=resp)
+
+
+_crx_downloader = None
+
+
+def get_crx_downloader():
+    """Return this process's :class:`CrxDownloader`, creating it on first use.
+
+    :rtype: CrxDownloader
+    """
+    global _crx_downloader
+    if _crx_downloader is None:
+        _crx_downloader = CrxDownloader()
+        atexit.register(_crx_downloader.close)
+    return _crx_downloader
 
 
 def _ensure_redirect(resp):
@@ -310,32 +1145,98 @@ def _ensure_redirect(resp):
 
 
 class RetryRequest:
-    """Wraps functions that make HTTP requests, retries on failure."""
+    """Wraps functions that make HTTP requests, retries on failure.
+
+    The first argument of the wrapped function must be the URL. Connection
+    errors and the responses in :data:`~crawl.throttle.RETRY_STATUSES` are
+    retried up to :data:`NUM_HTTP_RETIRES` times, as paced by
+    :data:`~crawl.throttle.HOSTS`. Other responses, including other HTTP
+    errors, are returned as they are.
+
+    Each attempt also takes a token from :data:`~crawl.rate_limit.LIMITER`
+    for the request class given by the keyword argument ``request_class``.
+
+    The keyword argument ``max_wait`` sets the longest time the caller will
+    wait for the host, in seconds. When the host won't be ready for longer
+    than that, :exc:`~crawl.throttle.HostThrottled` is raised. After the last
+    attempt, the last response is returned, or `None` if there wasn't one.
+    """
 
     def __init__(self, f):
         self.f = f
 
-    def __call__(self, *args, **kwargs):
+    def __call__(self, url, *args, max_wait=MAX_INLINE_WAIT, request_class=None, **kwargs):
+        host = urlparse(url).hostname
         resp = None
         for i in range(NUM_HTTP_RETIRES):
+            sleep(_reserve_request(host, request_class, max_wait))
+            status = retry_after = None
             try:
-                resp = self.f(*args, **kwargs)
-                resp.raise_for_status()  # If there was an HTTP error, raise it
-            except (ChunkedEncodingError, ConnectionError, HTTPError):
-                # TODO: Are there other errors we could get that we want to retry after?
-                logging.debug('Encountered error while downloading. Attempting to sleep and retry ({} of {} retries)'.
-                              format(i+1, NUM_HTTP_RETIRES))
-                sleep(10 * (i+1))
+                resp = self.f(url, *args, **kwargs)
+            except (ChunkedEncodingError, ConnectionError):
+                resp = None
             else:
+                if resp.status_code not in RETRY_STATUSES:
+                    HOSTS.success(host)
+                    return resp
+                status = resp.status_code
+                retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+
+            delay = HOSTS.failure(host, i, status, retry_after)
+            if i + 1 == NUM_HTTP_RETIRES:
                 break
+            if resp is not None:
+                resp.close()
+            if delay > max_wait:
+                raise HostThrottled(host, delay)
+            logging.debug('Encountered error while downloading. Attempting to sleep and retry ({} of {} retries)'.
+                          format(i+1, NUM_HTTP_RETIRES))
+            sleep(delay)
         return resp
 
 
+def _reserve_request(host, request_class, max_wait):
+    """Reserve a request to a host, and return how long to wait before making it.
+
+    The request has to wait for both the host's throttle and a token from
+    the rate limiter.
+
+    :param str host: The host the request is to.
+    :param str request_class: The request's class for
+        :data:`~crawl.rate_limit.LIMITER`.
+    :param float max_wait: Longest time the caller will wait.
+    :return: Seconds to wait.
+    :rtype: float
+    :raises crawl.throttle.HostThrottled: If the request would have to wait
+        longer than ``max_wait``.
+    """
+    delay = HOSTS.reserve(host)
+    if delay > max_wait:
+        raise HostThrottled(host, delay)
+    return max(delay, LIMITER.reserve(host, request_class, max_wait))
+
+
+def _pooled_session(pool_size):
+    """Create a session that keeps up to ``pool_size`` connections open to each host.
+
+    :param int pool_size: Maximum number of connections to each host.
+    :rtype: requests.Session
+    """
+    session = requests.Session()
+    # Block instead of opening extra connections when all of them are in use
+    adapter = HTTPAdapter(pool_maxsize=pool_size, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
 @RetryRequest
 def _http_get(url, session=None, stream=True, **kwargs):
-    """Make a GET request with the URL.
+    """Make a GET request with the URL, retrying on failure as described in :class:`RetryRequest`.
 
-    Any errors from the HTTP request (non 200 codes) will raise an HTTPError.
+    HTTP errors aren't raised: the response is returned whatever its status,
+    so callers have to check it, e.g. with
+    :meth:`~requests.Response.raise_for_status`.
 
     :param url: The URL to GET.
     :type url: str
@@ -348,8 +1249,11 @@ def _http_get(url, session=None, stream=True, **kwargs):
     :param kwargs: Optional arguments that :func:`requests.get` takes.
     :type kwargs: dict
     :return: The :class:`~requests.Response` object containing the server's
-        response to the HTTP request.
-    :rtype: requests.Response
+        response to the HTTP request, or `None` if there wasn't a response
+        after the last attempt.
+    :rtype: requests.Response or None
+    :raises crawl.throttle.HostThrottled: If the host won't be ready for
+        another attempt for longer than the ``max_wait`` keyword argument.
     """
     if isinstance(session, requests.Session):
         return session.get(url, stream=stream, **kwargs)
@@ -12,32 +12,55 @@ import atexit
 import logging
 import os
 import pwd
+import re
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from heapq import heappush, heappushpop, heapreplace
+from itertools import islice
+from io import BytesIO, TextIOBase
 from math import e
-from operator import itemgetter
 from sys import argv as sys_argv
 
-from bs4 import BeautifulSoup
-from sqlalchemy import Table, select
+from lxml import etree
+from sqlalchemy import Table, select, case, func
 
 from common.centroid import CentroidCalc, get_normalizing_vector, centroid_difference, USED_FIELDS, USED_TO_DB, \
-    DB_META, get_tree_top
-
-
-#: The header for all new MERL files. This includes all references to XML namespaces necessary for validating the XML
-#: file's contents.
-STARTER = """<?xml version="1.0" encoding="UTF-8"?>
-<merl
-    xmlns="https://mikemabey.com/schema/merl"
-    xmlns:dfxml="http://www.forensicswiki.org/wiki/Category:Digital_Forensics_XML"
-    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
-    xsi:schemaLocation="
-        https://mikemabey.com/schema/merl https://mikemabey.com/schema/merl.xsd
-        http://www.forensicswiki.org/wiki/Category:Digital_Forensics_XML https://github.com/dfxml-working-group/dfxml_schema/raw/master/dfxml.xsd
-    "
-    version="0.1"
-/>"""
+    DB_META, ISO_TIME, get_tree_top
+from common.instrument import phase
+
+
+MERL_NS = 'https://mikemabey.com/schema/merl'
+DFXML_NS = 'http://www.forensicswiki.org/wiki/Category:Digital_Forensics_XML'
+XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
+
+#: The XML namespaces used in MERL files, keyed by their prefixes. MERL is the default namespace.
+NSMAP = {None: MERL_NS,
+         'dfxml': DFXML_NS,
+         'xsi': XSI_NS}
+#: Locations of the schemas for validating the XML file's contents
+SCHEMA_LOCATION = ' '.join((MERL_NS, 'https://mikemabey.com/schema/merl.xsd',
+                            DFXML_NS, 'https://github.com/dfxml-working-group/dfxml_schema/raw/master/dfxml.xsd'))
+MERL_VERSION = '0.1'
+#: Maximum number of centroid families (the most likely ones) that are considered matches for a candidate
 MAX_FAMILY_MATCHES = 1000
+#: Maximum number of extensions listed for each candidate in a MERL file
 MAX_CANDIDATE_TAGS = 5
+#: Maximum number of centroid families to look up in a single query
+HYDRATE_CHUNK_SIZE = 500
+#: The weight for how quickly confidence drops as distance increases (``δ`` in the paper)
+CONFIDENCE_DELTA = 3
+#: How much confidence drops for each file a family's ``ttl_files`` differs from the candidate's
+TTL_FILES_PENALTY = 0.5
+#: Number of candidates per worker thread that can be waiting to be scored or written at once
+PIPELINE_DEPTH = 2
+#: Number of candidates in each batch scored by a worker process
+SCORE_BATCH_SIZE = 16
+
+#: The matches found for a candidate: the inode of its top directory, its number of vertices, and the list of
+#: extensions that are the most likely matches, from most to least confident
+CandidateMatches = namedtuple('CandidateMatches', 'inode size hits')
 
 
 class Merl:
@@ -47,47 +70,81 @@ class Merl:
     passed a number of candidate graphs (using the
     :meth:`~Merl.match_candidates` method) that should be matched with potential
     extensions based on their centroids in the database. Finally, the
-    :meth:`~Merl.save_merl` method should be called so the contents of the MERL
-    file will be written to disk.
+    :meth:`~Merl.save_merl` method should be called so the MERL file will be
+    completed.
+
+    The MERL file is streamed to the output file: each ``<match>`` tag is
+    written (and flushed) as soon as its candidate has been matched, so only
+    the matches of the candidates currently being scored are held in memory.
     """
 
-    def __init__(self, *, src_image_filename=None, src_mount_point=None, out_fp=None, plain_output=False):
+    def __init__(self, *, src_image_filename=None, src_mount_point=None, out_fp=None, plain_output=False,
+                 top_k=None, snapshot=None, index=None, ttl_window=0, report=None, scorer=None):
         """
         :param str src_image_filename: The filename of the disk image that was
             scanned to find candidates.
         :param str src_mount_point:
         :param out_fp: File handle to the output file where the MERL file will
-            be saved. Should already be opened.
+            be saved. Should already be opened. When not given, the MERL file
+            is kept in memory and is available from :attr:`merl`.
         :param bool plain_output: When `True`, will not format the output as
             XML, but in a more human-readable format.
+        :param int top_k: When given, only this many of the most likely
+            extensions are retrieved from the database for each candidate.
+        :param str snapshot: Path to a snapshot file created by
+            :func:`merl.snapshot.export_snapshot`. When given, candidates are
+            matched against the snapshot instead of the database, so no
+            database connection is needed.
+        :param index: The centroid index to match candidates against. Takes
+            precedence over ``snapshot``. Defaults to a
+            :class:`DbCentroidIndex`.
+        :type index: DbCentroidIndex or merl.snapshot.SnapshotCentroidIndex
+        :param int ttl_window: Candidates are matched with the families whose
+            total number of files (``ttl_files``) is within this many files of
+            the candidate's, instead of only those with exactly the same
+            number. The confidence of a match is penalized by
+            :data:`TTL_FILES_PENALTY` for each file of difference.
+        :param report: When given, the time spent calculating centroids and
+            looking up and ranking families is added to the report, and its start time is
+            used in the ``<dfxml:creator>`` tag.
+        :type report: common.instrument.RunReport
+        :param scorer: When given, candidates are compared with the centroid
+            families in its processes, instead of in processes started for
+            this MERL. It should have been made from the same ``index``, and
+            it is not closed, so it can be shared with other MERLs.
+        :type scorer: merl.parallel.ParallelScorer
         """
-        self._soup = BeautifulSoup(STARTER, 'xml')
-        self._top = self._soup.merl
-
-        conn = DB_META.bind.connect()
-        self._db_conn = conn
-        self._extension = Table('extension', DB_META)
-        self._cent_fam = Table('centroid_family', DB_META)
-        self._norm_vec = get_normalizing_vector()
+        self._clark = validate_nsmap(NSMAP)
 
-        self._cent_cols = [getattr(self._cent_fam.c, USED_TO_DB[x]) for x in (USED_FIELDS + ('_c_size',))] + \
-                          [self._cent_fam.c.ttl_files]
-        self._centroid_select_fields = self._cent_cols + [self._cent_fam.c.pk]
+        if index is None:
+            index = open_index(snapshot)
+        self.index = index
         self._out_file = None
         self.output_file = out_fp
         self.plain_output = plain_output
-
-        self._make_source_tag(src_image_filename, src_mount_point)
-        self._make_creator_tag()
-
-        @atexit.register
-        def close_db():
-            conn.close()
+        self.top_k = top_k
+        self.ttl_window = ttl_window
+        self.report = report
+        self.scorer = scorer
+
+        self._buffer = None
+        self._xml = None
+        self._stack = ExitStack()
+        if not plain_output:
+            self._start_xml()
+            self._make_source_tag(src_image_filename, src_mount_point)
+            self._make_creator_tag()
 
     @property
     def merl(self):
-        """The contents of the MERL file."""
-        return self._soup.prettify()
+        """The contents of the MERL file, when it isn't saved to an output file.
+
+        Only the tags written so far are included, and the file isn't complete
+        until :meth:`save_merl` has been called.
+        """
+        if self._buffer is None:
+            return None
+        return self._buffer.getvalue().decode('utf-8')
 
     @property
     def output_file(self):
@@ -99,33 +156,181 @@ class Merl:
         if stream is None or hasattr(stream, 'write'):
             self._out_file = stream
 
-    def save_merl(self):
-        """Write the MERL file to disk."""
-        self.output_file.write(self.merl)
-        print(self.merl, file=self.output_file)
+    def _start_xml(self):
+        """Open the XML stream and write the opening ``<merl>`` tag.
+
+        Since lxml writes encoded bytes, they are decoded again before being
+        written to output files opened in text mode.
+
+        :rtype: None
+        """
+        stream = self.output_file
+        if stream is None:
+            stream = self._buffer = BytesIO()
+        elif isinstance(stream, TextIOBase):
+            stream = _TextWriter(stream)
+        self._xml = self._stack.enter_context(etree.xmlfile(stream, encoding='UTF-8'))
+        self._xml.write_declaration()
+        self._stack.enter_context(self._xml.element(
+            self._clark[None] + 'merl',
+            {'{%s}schemaLocation' % XSI_NS: SCHEMA_LOCATION, 'version': MERL_VERSION},
+            nsmap=NSMAP))
+        self._xml.write('\n')
+
+    def _write(self, element):
+        """Write a complete tag inside ``<merl>`` and flush the MERL file.
+
+        :param lxml.etree._Element element: The tag to write.
+        :rtype: None
+        """
+        self._xml.write('  ')
+        self._write_element(element, 1)
+        self._xml.write('\n')
+        self._xml.flush()
+
+    def _write_element(self, element, level):
+        """Write a tag and its contents, indented for readability.
+
+        The tag is written through the open ``<merl>`` element (instead of as
+        a separate tree) so it uses the namespace prefixes already declared
+        there, rather than declaring them again.
+
+        :param lxml.etree._Element element: The tag to write.
+        :param int level: How deeply nested the tag is in the MERL file.
+        :rtype: None
+        """
+        with self._xml.element(element.tag, element.attrib):
+            if element.text:
+                self._xml.write(element.text)
+            for child in element:
+                self._xml.write('\n' + '  ' * (level + 1))
+                self._write_element(child, level + 1)
+                if child.tail:
+                    self._xml.write(child.tail)
+            if len(element):
+                self._xml.write('\n' + '  ' * level)
+
+    def save_merl(self, rusage=False):
+        """Write the closing ``<merl>`` tag and flush the MERL file to disk.
+
+        :param bool rusage: When `True` and there is a :attr:`report`, the
+            resource usage of the run is written in a ``<dfxml:rusage>`` tag
+            first. (The ``<dfxml:creator>`` tag is written before matching
+            starts, so it can't include it.)
+        :rtype: None
+        """
+        if rusage and self.report is not None and self._xml is not None:
+            self._make_rusage_tag()
+        self._stack.close()
+        if self.output_file is not None:
+            self.output_file.flush()
 
     def close_db(self):
-        self._db_conn.close()
+        """Close the centroid index's connection to the database, if any."""
+        self.index.close()
 
-    def match_candidates(self, candidates_list):
+    def match_candidates(self, candidates_list, workers=None, processes=None):
         """Iterate through the list of candidates and find matches.
 
-        :param candidates_list: List of graphs that are candidates for being
-            extensions installed on the device.
+        When ``workers`` is given, candidates are scored by a pool of threads
+        while the next ones are still being generated. At most
+        :data:`PIPELINE_DEPTH` candidates per worker are in flight at once, so
+        a generator of candidates is only read as fast as they're matched.
+        Matches are still written in the order of the candidates, each as
+        soon as it and all the ones before it are done.
+
+        When ``processes`` is given, the centroid families are copied once to
+        shared memory, and batches of candidates are compared with them by a
+        pool of processes instead. See :mod:`merl.parallel`. If the MERL has
+        a :attr:`scorer`, its processes are used.
+
+        :param candidates_list: List (or other iterable) of graphs that are
+            candidates for being extensions installed on the device.
         :type candidates_list: list(DblingGraph)
-        :rtype: None
+        :param int workers: Number of threads that score candidates. When not
+            given, candidates are matched one at a time.
+        :param int processes: Number of processes that compare candidates
+            with the centroid families. Takes precedence over ``workers``.
+        :return: The number of candidates.
+        :rtype: int
+        """
+        if self.scorer is not None or (processes and processes > 1):
+            return self._match_in_processes(candidates_list, processes)
+
+        if not workers or workers < 2:
+            n = 0
+            for c in candidates_list:
+                n += 1
+                self.match_candidate(c, n)
+            return n
+
+        pending = deque()
+        n = 0
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='match') as pool:
+            for c in candidates_list:
+                n += 1
+                pending.append((n, pool.submit(self.score_candidate, c)))
+                # Wait for the oldest candidate before taking more, so it can be written without falling behind
+                while len(pending) >= workers * PIPELINE_DEPTH or (pending and pending[0][1].done()):
+                    match_num, future = pending.popleft()
+                    self.write_matches(future.result(), match_num)
+            while pending:
+                match_num, future = pending.popleft()
+                self.write_matches(future.result(), match_num)
+        return n
+
+    def _match_in_processes(self, candidates_list, processes):
+        """Match candidates, comparing them with the centroid families in a pool of processes.
+
+        Centroids are calculated in this process, since that needs the
+        candidate graphs, and are sent to the pool in batches of
+        :data:`SCORE_BATCH_SIZE`. As in :meth:`match_candidates`, only a few
+        batches per process are in flight at once, and matches are written in
+        the order of the candidates.
+
+        :param candidates_list: Iterable of candidate graphs.
+        :param int processes: Number of processes, unless the MERL has a
+            :attr:`scorer`.
+        :return: The number of candidates.
+        :rtype: int
         """
+        from merl.parallel import ParallelScorer
+
+        def write_batch(batch, future):
+            for (match_num, inode, cent), hit in zip(batch, future.result()):
+                self.write_matches(self._hydrate_matches(inode, cent.size, hit), match_num)
+
+        pending = deque()
         n = 0
-        for c in candidates_list:
-            n += 1
-            self.match_candidate(c, n)
+        candidates = iter(candidates_list)
+        with ExitStack() as stack:
+            scorer = self.scorer
+            if scorer is None:
+                with phase(self.report, 'share'):
+                    scorer = stack.enter_context(ParallelScorer(self.index, processes, self.ttl_window))
+            processes = scorer.processes
+            while True:
+                start = n
+                batch = []
+                for c in islice(candidates, SCORE_BATCH_SIZE):
+                    n += 1
+                    cent = self._calc_centroid(c)
+                    if cent is not None:
+                        # Keep only the inode, so the candidate's graph can be freed
+                        batch.append((n, self._top_inode(c), cent))
+                if n == start:
+                    break
+                pending.append((batch, scorer.submit([tuple(cent.centroid) for _, _, cent in batch])))
+                while len(pending) >= processes * PIPELINE_DEPTH or (pending and pending[0][1].done()):
+                    write_batch(*pending.popleft())
+            while pending:
+                write_batch(*pending.popleft())
+        return n
 
     def match_candidate(self, candidate, match_num=None):
-        """Find all matches for a single candidate.
+        """Find all matches for a single candidate and write them out.
 
-        Depending on how the program was invoked, this will either print the
-        results in a plain format with no structure (but that is easier to
-        read quickly) or in an XML format conforming to the MERL schema.
+        See :meth:`score_candidate` and :meth:`write_matches`.
 
         :param DblingGraph candidate: A graph that is a candidate for being an
             extension installed on the device.
@@ -135,6 +340,32 @@ class Merl:
             index, since numbering begins at 1.
         :rtype: None
         """
+        self.write_matches(self.score_candidate(candidate), match_num)
+
+    def score_candidate(self, candidate):
+        """Find the most likely extensions for a single candidate.
+
+        This doesn't write anything, so it is safe to call from several
+        threads at once.
+
+        :param DblingGraph candidate: A graph that is a candidate for being an
+            extension installed on the device.
+        :return: The candidate's matches, or `None` if its centroid couldn't be
+            calculated.
+        :rtype: CandidateMatches
+        """
+        cent = self._calc_centroid(candidate)
+        if cent is None:
+            return None
+        hit = self._rank_families(cent.centroid)
+        return self._hydrate_matches(self._top_inode(candidate), cent.size, hit)
+
+    def _calc_centroid(self, candidate):
+        """Return the candidate's centroid calculation, or `None` if it isn't valid.
+
+        :param DblingGraph candidate: The candidate graph.
+        :rtype: common.centroid.CentroidCalc
+        """
         # Iterate through the centroid families table, and get the centroid for the family
         cent = CentroidCalc(candidate)
         # if cent.size < 30:  # TODO: Remove this. There are legit extensions with only 5 nodes.
@@ -142,62 +373,100 @@ class Merl:
         #     return
 
         try:
-            cent.do_calc()
+            with phase(self.report, 'centroid'):
+                cent.do_calc()
         except (ValueError, ZeroDivisionError):
             logging.warning('Invalid candidate for centroid calculation. Skipping...', exc_info=1)
-            return
-        # Select only the rows that have the same value for the ttl_files column
-        s = select(self._centroid_select_fields).where(self._cent_fam.c.ttl_files == cent.centroid[-1])
-        hit = {}
+            if self.report is not None:
+                self.report.count('invalid_candidates')
+            return None
+        return cent
+
+    def _rank_families(self, centroid):
+        """Find the families most likely to match a centroid.
+
+        :param tuple centroid: The candidate's centroid.
+        :return: The distance from the centroid to each of the (up to)
+            :data:`MAX_FAMILY_MATCHES` most likely families, keyed by the
+            family's key from the index.
+        :rtype: dict
+        """
+        # Keep only the most likely families in a min-heap of (confidence, pk, distance), so the least likely one is
+        # always at the top, ready to be replaced
+        top_fams = []
+
+        # Only the families that have the same value (or close to it) for the ttl_files column. They're ranked as
+        # they're generated, so only the heap is ever held in memory.
+        ttl_files = centroid[-1]
+        num_families = 0
+        with phase(self.report, 'families'):
+            for pk, row_cent, fam_size in self.index.families(ttl_files, self.ttl_window):
+                num_families += 1
+                # Calculate the distance between the candidate and the centroid
+                dist = centroid_difference(centroid, row_cent, self.index.norm_vec)
+                count_delta = ttl_files - row_cent[-1]
+                conf = calc_confidence(dist, fam_size, count_delta=count_delta)
+                if count_delta:
+                    # Add the penalty to the distance, so the confidence hydrate_hits() calculates from it includes it
+                    dist += TTL_FILES_PENALTY * abs(count_delta) / CONFIDENCE_DELTA
+
+                # Once the heap is full, each family pushes out the least likely of the stored hits (maybe itself)
+                if len(top_fams) < MAX_FAMILY_MATCHES:
+                    heappush(top_fams, (conf, pk, dist))
+                else:
+                    heappushpop(top_fams, (conf, pk, dist))
+        if self.report is not None:
+            self.report.count('families_compared', num_families)
+        return {pk: dist for conf, pk, dist in top_fams}
+
+    def _hydrate_matches(self, inode, size, hit):
+        """Look up the extensions in the hit families and return the candidate's matches.
+
+        :param inode: Inode of the top directory of the candidate.
+        :param int size: Number of vertices in the candidate.
+        :param dict hit: The hit families, as returned by
+            :meth:`_rank_families`.
+        :rtype: CandidateMatches
+        """
+        # After iterating, get the data on all the extensions that are part of the top hit families. Only a few are
+        # listed in a MERL file, but all of them are shown in the plain output (unless limited by top_k).
+        limit = self.top_k
+        if not self.plain_output:
+            limit = MAX_CANDIDATE_TAGS if limit is None else min(limit, MAX_CANDIDATE_TAGS)
+        with phase(self.report, 'hydrate'):
+            sorted_hits = self.hydrate_hits(hit, limit)
+        if self.report is not None:
+            self.report.count('candidates')
+        return CandidateMatches(inode, size, sorted_hits)
+
+    @staticmethod
+    def _top_inode(candidate):
+        """Return the inode of the top directory of a candidate graph."""
+        top = get_tree_top(candidate)
+        return candidate.vp['inode'][top]
+
+    def write_matches(self, matches, match_num=None):
+        """Write the matches for a single candidate to the output.
 
-        for fam in self._db_conn.execute(s):
-            # Calculate the distance between the candidate and the centroid
-            row_cent = tuple([fam[x] for x in self._cent_cols])
-            dist = centroid_difference(cent.centroid, row_cent, self._norm_vec)
-            pk = fam[self._cent_fam.c.pk]
-
-            # # If the distance is less than the max stored hits, add it, remove the one it bested
-            # if len(hit) < MAX_FAMILY_MATCHES:
-            hit[pk] = dist
-            # else:
-            #     for h in hit:
-            #         if dist < hit[h]:
-            #             hit.pop(h)
-            #             hit[pk] = dist
-            #             break
-
-        # After iterating, get the data on all the extensions that are part of the top hit families
-        hit_entries = []
-        for h in hit:
-            fam_size = self._db_conn.execute(select([self._cent_fam.c.distinct_id_members]).
-                                             where(self._cent_fam.c.pk == h)).fetchone()[0]
-            conf = calc_confidence(hit[h], fam_size)
-            # print(fam_size, end=' ')
-
-            s_hits = select([self._extension.c.ext_id,
-                             self._extension.c.version,
-                             # self._extension.c.name,
-                             # self._extension.c.vendor,
-                             ]).\
-                where(self._extension.c.centroid_group == h)
-            for ext in self._db_conn.execute(s_hits):
-                # TODO: Complete this entry information
-                # To do that, we need to parse the manifest files for all the extensions and add the extension name and
-                # vendor to the database.
-                entry = dict(ext_id=ext[self._extension.c.ext_id],
-                             ext_ver=ext[self._extension.c.version],
-                             # ext_name='Name unavailable',  # ext[self._extension.c.name],
-                             # ext_vendor='Vendor unavailable',  # ext[self._extension.c.vendor],
-                             confidence=conf)
-                hit_entries.append(entry)
+        Depending on how the program was invoked, this will either print the
+        results in a plain format with no structure (but that is easier to
+        read quickly) or in an XML format conforming to the MERL schema.
 
-        sorted_hits = sorted(hit_entries, key=itemgetter('confidence'), reverse=True)
+        :param CandidateMatches matches: The candidate's matches, as returned
+            by :meth:`score_candidate`. Nothing is written when `None`.
+        :param int match_num: Number indicating which number of candidate this
+            is in a set of candidates. This value has no effect when
+            ``self.plain_output`` is `False`.
+        :rtype: None
+        """
+        if matches is None:
+            return
 
         if self.plain_output:
             _n = ''
             if match_num is not None:
                 _n = ' (%d)' % match_num
-            logging.debug(('Calculated the matches for a candidate graph with %d vertices.' % cent.size) + _n)
+            logging.debug(('Calculated the matches for a candidate graph with %d vertices.' % matches.size) + _n)
 
             if match_num is not None:
                 print('\nC%d Candidate Matches' % match_num, file=self.output_file)
@@ -206,7 +475,7 @@ class Merl:
                 print('\nCandidate Matches', file=self.output_file)
                 print('-----------------\n', file=self.output_file)
             n = 0
-            for ent in sorted_hits:
+            for ent in matches.hits:
                 n += 1
                 print('#%d' % n, file=self.output_file)
                 for k in ent:
@@ -215,23 +484,33 @@ class Merl:
 
         else:
             candidate_tags = []
-            n = 0
-            for ent in sorted_hits:
+            for ent in matches.hits:
                 # Use list comprehension to make a tag for each of the keys in the entry and set the tag's value to the
                 # entry's value for that key. Then expand the list so each tag is its own parameter to tag() for the
                 # "candidate" tag.
-                n += 1
                 candidate_tags.append(self.tag(
                     'candidate',
                     *[self.tag(k, v) for k, v in ent.items()]
                 ))
-                if n <= MAX_CANDIDATE_TAGS:
-                    break
 
-            top = get_tree_top(candidate)
-            inode = candidate.vp['inode'][top]
-            match_tag = self.tag('match', self.tag('inode', inode), *candidate_tags)
-            self._top.append(match_tag)
+            self._write(self.tag('match', self.tag('inode', matches.inode), *candidate_tags))
+
+    def hydrate_hits(self, hit, limit=None):
+        """Return the extensions in the hit families, ordered by confidence.
+
+        :param dict hit: The distance from the candidate to each family that
+            was a hit, keyed by the family's key from the index. The distance
+            includes any penalty for a different number of files.
+        :param int limit: Maximum number of extensions to return. When not
+            given, :attr:`top_k` is used, and if that isn't set either, all
+            extensions in the families are returned.
+        :return: List of dicts with the keys ``ext_id``, ``ext_ver``, and
+            ``confidence``, from most to least confident.
+        :rtype: list
+        """
+        if limit is None:
+            limit = self.top_k
+        return self.index.hydrate(hit, limit)
 
     def _make_source_tag(self, image_filename=None, mount_point=None):
         """Create the ``<source>`` tag and add it to the XML document.
@@ -253,7 +532,7 @@ class Merl:
         if mount_point is not None:
             src_tag.append(self.tag('mount_point', mount_point))
 
-        self._top.append(src_tag)
+        self._write(src_tag)
 
     def _make_creator_tag(self):
         """Create the ``<creator>`` tag and add it to the XML document.
@@ -264,7 +543,7 @@ class Merl:
         :rtype: None
         """
         sysname, nodename, release, version, machine = os.uname()
-        self._top.append(
+        self._write(
             self.tag('dfxml:creator',
                      self.tag('dfxml:program', ''),  # TODO
                      self.tag('dfxml:version', ''),  # TODO
@@ -283,31 +562,285 @@ class Merl:
                               # self.tag('dfxml:uid', str(os.getuid())),
                               self.tag('dfxml:uid', os.getuid()),
                               self.tag('dfxml:username', get_username()),
-                              # self.tag('dfxml:start_time', ),  # TODO
+                              *([] if self.report is None else
+                                [self.tag('dfxml:start_time', self.report.started.strftime(ISO_TIME))]),
                               ),
                      # self.tag('dfxml:library', ''),  # unbounded  # TODO
                      )
         )
 
+    def _make_rusage_tag(self):
+        """Create the ``<dfxml:rusage>`` tag from :attr:`report` and add it to the XML document.
+
+        :rtype: None
+        """
+        usage = self.report.rusage
+        self._write(
+            self.tag('dfxml:rusage',
+                     self.tag('dfxml:utime', usage.ru_utime),
+                     self.tag('dfxml:stime', usage.ru_stime),
+                     self.tag('dfxml:maxrss', usage.ru_maxrss),
+                     self.tag('dfxml:minflt', usage.ru_minflt),
+                     self.tag('dfxml:majflt', usage.ru_majflt),
+                     self.tag('dfxml:nswap', usage.ru_nswap),
+                     self.tag('dfxml:inblock', usage.ru_inblock),
+                     self.tag('dfxml:oublock', usage.ru_oublock),
+                     self.tag('dfxml:clocktime', self.report.to_dict()['wall_sec']),
+                     )
+        )
+
     def tag(self, tag_name, *args):
         """Create a new tag and add everything from ``args`` as its contents.
 
-        :param str tag_name: Name of the new tag.
+        :param str tag_name: Name of the new tag. Tags in a namespace other
+            than MERL's are given with the namespace's prefix, e.g.
+            ``dfxml:creator``.
         :param args: All parameters after ``tag_name`` will be appended to the
-            contents of the new tag.
+            contents of the new tag. Anything that isn't a tag is added as
+            text.
         :return: The new tag.
-        :rtype: bs4.Tag
+        :rtype: lxml.etree._Element
         """
-        new_tag = self._soup.new_tag(tag_name)
+        prefix, _, local = tag_name.rpartition(':')
+        try:
+            new_tag = etree.Element(self._clark[prefix or None] + local)
+        except KeyError:
+            raise ValueError('Unknown namespace prefix in tag name: %s' % tag_name)
         for x in args:
-            try:
+            if etree.iselement(x):
                 new_tag.append(x)
-            except AttributeError:
-                new_tag.append(str(x))
+            elif len(new_tag):
+                new_tag[-1].tail = (new_tag[-1].tail or '') + str(x)
+            else:
+                new_tag.text = (new_tag.text or '') + str(x)
         return new_tag
 
 
-def calc_confidence(distance, fam_size, delta=3):
+class DbCentroidIndex(object):
+    """Look up centroid families and their extensions in the database.
+
+    This and :class:`merl.snapshot.SnapshotCentroidIndex` are the two
+    interchangeable centroid indexes that :class:`Merl` matches candidates
+    against. Both have a ``norm_vec`` attribute and the methods
+    :meth:`warm`, :meth:`families`, :meth:`all_families`, :meth:`hydrate`,
+    and :meth:`close`.
+    """
+
+    def __init__(self, db_meta=DB_META):
+        """
+        :param db_meta: The meta object to access the DB.
+        :type db_meta: sqlalchemy.MetaData
+        """
+        self._engine = db_meta.bind
+        # Each thread gets its own connection, so candidates can be scored by several threads at once
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+        self._extension = Table('extension', db_meta)
+        self._cent_fam = Table('centroid_family', db_meta)
+        self.norm_vec = get_normalizing_vector(db_meta)
+
+        self._cent_cols = [getattr(self._cent_fam.c, USED_TO_DB[x]) for x in (USED_FIELDS + ('_c_size',))] + \
+                          [self._cent_fam.c.ttl_files]
+        self._centroid_select_fields = self._cent_cols + [self._cent_fam.c.pk, self._cent_fam.c.distinct_id_members]
+        # Families keyed by ttl_files, once they've been loaded by warm()
+        self._families = None
+
+        atexit.register(self.close)
+
+    @property
+    def _db_conn(self):
+        """The current thread's connection to the database."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or conn.closed:
+            conn = self._local.conn = self._engine.connect()
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    def close(self):
+        """Close the connections to the database."""
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
+
+    def warm(self):
+        """Load all of the centroid families from the database at once.
+
+        After this, :meth:`families` doesn't query the database, which saves
+        a query per candidate when many candidates (e.g. from a batch of
+        images) are matched against the same index.
+
+        :return: The number of families loaded.
+        :rtype: int
+        """
+        s = select(self._centroid_select_fields).where(self._cent_fam.c.ttl_files.isnot(None))
+        families = {}
+        num = 0
+        for fam in self._db_conn.execute(s):
+            families.setdefault(fam[self._cent_fam.c.ttl_files], []).append(
+                (fam[self._cent_fam.c.pk],
+                 tuple([fam[x] for x in self._cent_cols]),
+                 fam[self._cent_fam.c.distinct_id_members]))
+            num += 1
+        self._families = families
+        logging.info('Loaded %d centroid families from the DB.' % num)
+        return num
+
+    def all_families(self):
+        """Generate every centroid family, ordered by their number of files.
+
+        The families are loaded with :meth:`warm` first, if they haven't been
+        already.
+
+        :return: Generator of ``(key, centroid, family size)`` tuples, like
+            :meth:`families`.
+        :rtype: generator
+        """
+        if self._families is None:
+            self.warm()
+        for n in sorted(self._families):
+            yield from self._families[n]
+
+    def families(self, ttl_files, window=0):
+        """Generate the centroid families with the given number of files.
+
+        The families are found using the index on the ``ttl_files`` column.
+
+        :param int ttl_files: The total number of files in the centroid.
+        :param int window: Also generate the families with up to this many
+            more or fewer files.
+        :return: Generator of ``(key, centroid, family size)`` tuples. The key
+            identifies the family to :meth:`hydrate`, and the family size is
+            its number of members with distinct IDs.
+        :rtype: generator
+        """
+        if self._families is not None:
+            for n in range(int(ttl_files) - window, int(ttl_files) + window + 1):
+                yield from self._families.get(n, ())
+            return
+        if window:
+            where = self._cent_fam.c.ttl_files.between(ttl_files - window, ttl_files + window)
+        else:
+            where = self._cent_fam.c.ttl_files == ttl_files
+        s = select(self._centroid_select_fields).where(where)
+        for fam in self._db_conn.execute(s):
+            yield (fam[self._cent_fam.c.pk],
+                   tuple([fam[x] for x in self._cent_cols]),
+                   fam[self._cent_fam.c.distinct_id_members])
+
+    def hydrate(self, hit, limit=None):
+        """Return the extensions in the hit families, ordered by confidence.
+
+        All of the families are looked up with a single query (or one per
+        :data:`HYDRATE_CHUNK_SIZE` families) that joins each family with its
+        member extensions. The database orders the rows by confidence, so when
+        there is a ``limit``, no more than ``limit`` rows are requested per
+        query, and reading a query's rows stops as soon as they can't beat the
+        extensions already kept. The kept extensions are in a bounded heap, so
+        only ``limit`` of them are held at a time.
+
+        :param dict hit: The distance from the candidate to each family that
+            was a hit, keyed by the family's primary key.
+        :param int limit: Maximum number of extensions to return, or `None`
+            for all of them.
+        :return: List of dicts with the keys ``ext_id``, ``ext_ver``, and
+            ``confidence``, from most to least confident.
+        :rtype: list
+        """
+        ext = self._extension
+        fam = self._cent_fam
+        pks = list(hit)
+        # Min-heap of (confidence, sequence number, entry). The sequence number keeps ties in the order they were read.
+        top_hits = []
+        seq = 0
+        for i in range(0, len(pks), HYDRATE_CHUNK_SIZE):
+            chunk = pks[i:i+HYDRATE_CHUNK_SIZE]
+            # Have the DB calculate the confidence for ordering the rows. See calc_confidence().
+            dist = case({pk: hit[pk] for pk in chunk}, value=fam.c.pk)
+            confidence = func.exp(-CONFIDENCE_DELTA * dist) / fam.c.distinct_id_members
+            s = select([ext.c.ext_id, ext.c.version, fam.c.pk, fam.c.distinct_id_members]).\
+                select_from(ext.join(fam, ext.c.centroid_group == fam.c.pk)).\
+                where(fam.c.pk.in_(chunk)).\
+                order_by(confidence.desc())
+            if limit is not None:
+                s = s.limit(limit)
+
+            result = self._db_conn.execute(s)
+            for row in result:
+                conf = calc_confidence(hit[row[fam.c.pk]], row[fam.c.distinct_id_members])
+                if limit is not None and len(top_hits) >= limit and conf <= top_hits[0][0]:
+                    # The rest of the rows are even less likely
+                    break
+                # TODO: Complete this entry information
+                # To do that, we need to parse the manifest files for all the extensions and add the extension name and
+                # vendor to the database.
+                entry = dict(ext_id=row[ext.c.ext_id],
+                             ext_ver=row[ext.c.version],
+                             # ext_name='Name unavailable',  # row[ext.c.name],
+                             # ext_vendor='Vendor unavailable',  # row[ext.c.vendor],
+                             confidence=conf)
+                seq -= 1
+                if limit is not None and len(top_hits) >= limit:
+                    heapreplace(top_hits, (conf, seq, entry))
+                else:
+                    heappush(top_hits, (conf, seq, entry))
+            result.close()
+
+        return [entry for conf, seq, entry in sorted(top_hits, reverse=True)]
+
+
+def open_index(snapshot=None):
+    """Return the centroid index to match candidates against.
+
+    :param str snapshot: Path to a snapshot file created by
+        :func:`merl.snapshot.export_snapshot`. When not given, the index is
+        the database.
+    :rtype: DbCentroidIndex or merl.snapshot.SnapshotCentroidIndex
+    """
+    if snapshot is not None:
+        from merl.snapshot import SnapshotCentroidIndex
+        return SnapshotCentroidIndex(snapshot)
+    return DbCentroidIndex()
+
+
+class _TextWriter(object):
+    """Adapts a text stream to accept the UTF-8 bytes written by lxml."""
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, data):
+        self._stream.write(data.decode('utf-8'))
+
+
+def validate_nsmap(nsmap):
+    """Check the prefixes and URIs of the namespaces for the MERL file.
+
+    This is done once, so creating tags only requires a dict lookup to resolve
+    their prefixes.
+
+    :param dict nsmap: Namespace URIs keyed by their prefixes. The default
+        namespace has the prefix `None`.
+    :return: The namespaces in Clark notation (``{uri}``), keyed by prefix.
+    :rtype: dict
+    :raises ValueError: If a prefix isn't a valid XML name, a URI is empty, or
+        a URI is used more than once.
+    """
+    if len(set(nsmap.values())) != len(nsmap):
+        raise ValueError('Each namespace URI may only be given one prefix.')
+    clark = {}
+    for prefix, uri in nsmap.items():
+        if prefix is not None and not re.match(r'^[A-Za-z_][\w.-]*$', prefix):
+            raise ValueError('Invalid namespace prefix: %r' % prefix)
+        if not uri:
+            raise ValueError('Namespace URI for prefix %r is empty.' % prefix)
+        clark[prefix] = '{%s}' % uri
+    return clark
+
+
+def calc_confidence(distance, fam_size, delta=CONFIDENCE_DELTA, count_delta=0, penalty=TTL_FILES_PENALTY):
     """Return the confidence level given the parameters.
 
     For an explanation on what this is doing, see the `paper on dbling
@@ -322,10 +855,15 @@ def calc_confidence(distance, fam_size, delta=3):
         drops as the distance between a candidate graph and an extension's
         centroid increases. This is ``δ`` in the paper.
     :type delta: int or float
+    :param int count_delta: The difference between the total number of files
+        in the candidate graph and in the extension's centroid.
+    :param penalty: How much the confidence drops for each file of
+        difference. Has no effect when ``count_delta`` is 0.
+    :type penalty: int or float
     :return: Confidence level, where 1 is 100% confident.
     :rtype: float
     """
-    return (e ** (-1 * delta * distance)) / fam_size
+    return (e ** (-1 * (delta * distance + penalty * abs(count_delta)))) / fam_size
 
 
 def get_username():
@@ -336,7 +874,7 @@ def get_username():
     """
     try:
         return os.getlogin()
-    except FileNotFoundError:
+    except OSError:  # Includes FileNotFoundError, and ENXIO when there's no controlling terminal
         pass
     try:
         return pwd.getpwuid(os.getuid()).pw_name
@@ -0,0 +1,237 @@
+# *-* coding: utf-8 *-*
+"""Score candidates in several processes against a shared copy of the centroid families.
+
+Scoring a candidate means comparing its centroid with the centroid of every
+family that has (about) the same number of files. For large images, this is
+where most of the matching time goes, and since it's pure computation, threads
+don't help. :class:`ParallelScorer` loads all of the families from a centroid
+index once into a :class:`CentroidTable` in shared memory, and worker
+processes score batches of candidate centroids against it without copying it.
+
+The worker processes are started with :data:`START_METHOD` instead of being
+forked, since the scorer is usually shared by threads that hold open DB
+connections and locks, which a forked process would inherit.
+
+Typical usage, which is what :meth:`merl.Merl.match_candidates` does when
+given a number of ``processes``:
+
+>>> with ParallelScorer(index, processes=4) as scorer:
+...     future = scorer.submit([cent.centroid for cent in batch])
+...     for hit in future.result():
+...         print(index.hydrate(hit))
+"""
+
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from merl import MAX_FAMILY_MATCHES, CONFIDENCE_DELTA, TTL_FILES_PENALTY
+
+__all__ = ['CentroidTable', 'ParallelScorer', 'score_centroids']
+
+#: Arrays in the shared table are aligned to this many bytes
+ALIGNMENT = 64
+
+#: How worker processes are started, see :mod:`multiprocessing`
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+#: The table attached by the current worker process
+_worker_table = None
+
+
+class CentroidTable(object):
+    """The centroid families of an index as arrays in shared memory.
+
+    The families are sorted by their total number of files (``ttl_files``),
+    so the ones for a candidate can be found with a binary search. The table
+    is created once by the main process, and attached to by name in each
+    worker process, see :meth:`attach`.
+    """
+
+    #: The arrays in the table, with their dtypes
+    ARRAYS = (('ttl_files', np.int64),
+              ('keys', np.int64),
+              ('centroids', np.float64),
+              ('fam_size', np.float64))
+
+    def __init__(self, shm, layout, norm_vec, owner=False):
+        """
+        :param SharedMemory shm: The shared memory the arrays are in.
+        :param dict layout: The ``(shape, offset)`` of each array, keyed by
+            name.
+        :param tuple norm_vec: The normalizing vector of the index.
+        :param bool owner: Whether this process created the shared memory and
+            should free it when the table is closed.
+        """
+        self._shm = shm
+        self._owner = owner
+        self.layout = layout
+        self.norm_vec = tuple(norm_vec)
+        for name, dtype in self.ARRAYS:
+            shape, offset = layout[name]
+            setattr(self, name, np.ndarray(tuple(shape), dtype=dtype, buffer=shm.buf, offset=offset))
+
+    @classmethod
+    def from_index(cls, index):
+        """Copy the centroid families of an index into a new table.
+
+        :param index: The centroid index to copy the families from.
+        :type index: merl.DbCentroidIndex or merl.snapshot.SnapshotCentroidIndex
+        :rtype: CentroidTable
+        """
+        keys = []
+        cents = []
+        sizes = []
+        for key, cent, fam_size in index.all_families():
+            keys.append(key)
+            cents.append([np.nan if x is None else x for x in cent])
+            # Families whose distinct members haven't been counted yet are treated as having a single member
+            sizes.append(fam_size or 1)
+        width = len(index.norm_vec)
+        arrays = dict(centroids=np.array(cents, dtype=np.float64).reshape(len(keys), width),
+                      keys=np.array(keys, dtype=np.int64),
+                      fam_size=np.array(sizes, dtype=np.float64))
+        arrays['ttl_files'] = arrays['centroids'][:, -1].astype(np.int64)
+
+        layout = {}
+        offset = 0
+        for name, dtype in cls.ARRAYS:
+            layout[name] = (arrays[name].shape, offset)
+            offset = -(-(offset + arrays[name].nbytes) // ALIGNMENT) * ALIGNMENT
+        shm = SharedMemory(create=True, size=max(offset, 1))
+        table = cls(shm, layout, index.norm_vec, owner=True)
+        for name, dtype in cls.ARRAYS:
+            getattr(table, name)[...] = arrays[name]
+        logging.debug('Copied %d centroid families to shared memory %s (%d bytes)' % (len(keys), shm.name, offset))
+        return table
+
+    @property
+    def spec(self):
+        """What a worker process needs to :meth:`attach` to the table."""
+        return self._shm.name, self.layout, self.norm_vec
+
+    @classmethod
+    def attach(cls, name, layout, norm_vec):
+        """Attach to a table created by another process.
+
+        :param str name: Name of the table's shared memory.
+        :param dict layout: The ``(shape, offset)`` of each array.
+        :param tuple norm_vec: The normalizing vector of the index.
+        :rtype: CentroidTable
+        """
+        # Worker processes share the resource tracker of the process that created the memory, so it is still freed
+        # only once, when the creator closes the table
+        return cls(SharedMemory(name=name), layout, norm_vec)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def close(self):
+        """Detach from the shared memory, and free it if this process created it.
+
+        :rtype: None
+        """
+        for name, dtype in self.ARRAYS:
+            setattr(self, name, None)
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+            self._owner = False
+
+
+def score_centroids(table, centroids, window=0, max_matches=MAX_FAMILY_MATCHES):
+    """Find the most likely families for each centroid.
+
+    This is the vectorized equivalent of the family search in
+    :meth:`merl.Merl.score_candidate`: the distance to each family within
+    ``window`` files of the centroid is calculated at once, penalized for the
+    difference in the number of files, and the ``max_matches`` families with
+    the highest confidence are kept.
+
+    :param CentroidTable table: The centroid families.
+    :param list centroids: The centroids to score, each a tuple like
+        :attr:`common.centroid.CentroidCalc.centroid`.
+    :param int window: Also consider the families with up to this many more
+        or fewer files.
+    :param int max_matches: Maximum number of families kept per centroid.
+    :return: For each centroid, a dict of the distance to each family that was
+        a hit, keyed by the family's key in the index.
+    :rtype: list(dict)
+    """
+    # Make sure the ttl_files field of the normalizing vector is 1, like centroid_difference() does
+    norm = np.array(table.norm_vec[:-1] + (1,), dtype=np.float64)
+    hits = []
+    for cent in centroids:
+        ttl_files = int(cent[-1])
+        lo, hi = np.searchsorted(table.ttl_files, [ttl_files - window, ttl_files + window + 1])
+        cent = np.asarray(cent, dtype=np.float64)
+        dist = np.sqrt(np.sum(((cent - table.centroids[lo:hi]) / norm) ** 2, axis=1))
+        dist += TTL_FILES_PENALTY * np.abs(ttl_files - table.ttl_files[lo:hi]) / CONFIDENCE_DELTA
+        conf = np.exp(-CONFIDENCE_DELTA * dist) / table.fam_size[lo:hi]
+
+        # Families with missing centroid values can't be compared
+        rows = np.flatnonzero(~np.isnan(conf))
+        if len(rows) > max_matches:
+            rows = rows[np.argpartition(-conf[rows], max_matches - 1)[:max_matches]]
+        hits.append(dict(zip(table.keys[lo + rows].tolist(), dist[rows].tolist())))
+    return hits
+
+
+def _attach_worker(spec):
+    global _worker_table
+    _worker_table = CentroidTable.attach(*spec)
+
+
+def _score_batch(centroids, window, max_matches):
+    return score_centroids(_worker_table, centroids, window, max_matches)
+
+
+class ParallelScorer(object):
+    """A pool of processes that score candidate centroids against a shared :class:`CentroidTable`.
+
+    It's safe to submit centroids from several threads, so one scorer can be
+    shared by all the inputs of a batch, see :func:`profiler.profile.go_batch`.
+    """
+
+    def __init__(self, index, processes, window=0, max_matches=MAX_FAMILY_MATCHES):
+        """
+        :param index: The centroid index to load the families from.
+        :type index: merl.DbCentroidIndex or merl.snapshot.SnapshotCentroidIndex
+        :param int processes: Number of worker processes.
+        :param int window: Also consider the families with up to this many
+            more or fewer files than each centroid.
+        :param int max_matches: Maximum number of families kept per centroid.
+        """
+        self.processes = processes
+        self.window = window
+        self.max_matches = max_matches
+        self.table = CentroidTable.from_index(index)
+        self._pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context(START_METHOD),
+                                         initializer=_attach_worker, initargs=(self.table.spec,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, centroids):
+        """Score a batch of centroids in one of the worker processes.
+
+        :param list centroids: The centroids to score.
+        :return: A future whose result is the list of hits for the centroids,
+            as returned by :func:`score_centroids`.
+        :rtype: concurrent.futures.Future
+        """
+        return self._pool.submit(_score_batch, centroids, self.window, self.max_matches)
+
+    def close(self):
+        """Stop the worker processes and free the shared table.
+
+        :rtype: None
+        """
+        self._pool.shutdown()
+        self.table.close()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# *-* coding: utf-8 *-*
+"""Export centroid families to a snapshot file for matching without a database.
+
+A snapshot holds everything :class:`~merl.Merl` needs to match candidates:
+the centroid of each family, the IDs and versions of each family's member
+extensions, and the normalizing vector. It is a single file of numpy arrays
+that is memory mapped when loaded, so profiling can be done on a workstation
+with no access to the crawler's database.
+
+Command line::
+
+ Usage: snapshot.py [-v] SNAPSHOT_FILE
+
+ Options:
+  -v   Verbose mode. Changes logging mode from INFO to DEBUG.
+
+Run it from the top directory of the repository as ``python3 -m merl.snapshot``.
+
+The file format is an 8 byte magic string, the length of a JSON header as an
+unsigned 64 bit integer, the header, and then the arrays. The header gives
+the ``dtype``, ``shape``, and byte ``offset`` of each array, which are all
+aligned to :data:`ALIGNMENT` bytes.
+"""
+
+import json
+import logging
+from datetime import datetime, timezone
+
+import numpy as np
+from sqlalchemy import Table, select
+
+from common.centroid import get_normalizing_vector, USED_FIELDS, USED_TO_DB, DB_META, ISO_TIME
+from merl import CONFIDENCE_DELTA
+
+MAGIC = b'DBLSNAP\x01'
+ALIGNMENT = 64
+FORMAT_VERSION = 1
+
+#: Lengths of the extension ID and version strings, from the columns of the extension table
+EXT_ID_LEN = 32
+VERSION_LEN = 23
+
+
+def export_snapshot(file_path, db_meta=DB_META):
+    """Save the centroid families and their members in the DB to a snapshot.
+
+    Families are sorted by their total number of files (``ttl_files``) so the
+    families for a candidate can be found with a binary search.
+
+    :param str file_path: Path of the snapshot file to create. Any existing
+        file is overwritten.
+    :param db_meta: The meta object to access the DB.
+    :type db_meta: sqlalchemy.MetaData
+    :return: The number of families and member extensions in the snapshot.
+    :rtype: tuple(int, int)
+    """
+    db_conn = db_meta.bind.connect()
+    extension = Table('extension', db_meta)
+    cent_fam = Table('centroid_family', db_meta)
+    cent_cols = [getattr(cent_fam.c, USED_TO_DB[x]) for x in (USED_FIELDS + ('_c_size',))] + [cent_fam.c.ttl_files]
+
+    logging.info('Reading centroid families from the DB.')
+    s = select(cent_cols + [cent_fam.c.pk, cent_fam.c.distinct_id_members]).\
+        where(cent_fam.c.ttl_files.isnot(None)).\
+        order_by(cent_fam.c.ttl_files, cent_fam.c.pk)
+    rows = db_conn.execute(s).fetchall()
+    num_cols = len(cent_cols)
+    centroids = np.array([[np.nan if r[i] is None else r[i] for i in range(num_cols)] for r in rows],
+                         dtype=np.float64).reshape(len(rows), num_cols)
+    pk = np.array([r[num_cols] for r in rows], dtype=np.int64)
+    # Families whose distinct members haven't been counted yet are treated as having a single member
+    fam_size = np.array([r[num_cols+1] or 1 for r in rows], dtype=np.int64)
+    ttl_files = centroids[:, -1].astype(np.int64)
+
+    logging.info('Reading the members of %d centroid families from the DB.' % len(pk))
+    s = select([extension.c.centroid_group, extension.c.ext_id, extension.c.version]).\
+        where(extension.c.centroid_group.isnot(None)).\
+        order_by(extension.c.centroid_group, extension.c.ext_id, extension.c.version)
+    rows = db_conn.execute(s).fetchall()
+    db_conn.close()
+    groups = np.array([r[0] for r in rows], dtype=np.int64)
+    ext_ids = np.array([(r[1] or '').encode('utf-8') for r in rows], dtype='S%d' % EXT_ID_LEN)
+    versions = np.array([(r[2] or '').encode('utf-8') for r in rows], dtype='S%d' % VERSION_LEN)
+
+    # Find each member's family, then put the members in the same order as the families
+    by_pk = np.argsort(pk)
+    pos = np.searchsorted(pk[by_pk], groups)
+    found = pos < len(pk)
+    found[found] = pk[by_pk[pos[found]]] == groups[found]
+    fam_idx = by_pk[pos[found]]
+    order = np.argsort(fam_idx, kind='stable')
+    ext_ids = ext_ids[found][order]
+    versions = versions[found][order]
+    member_offsets = np.concatenate(([0], np.cumsum(np.bincount(fam_idx, minlength=len(pk))))).astype(np.int64)
+
+    norm_vec = np.array(get_normalizing_vector(db_meta), dtype=np.float64)
+
+    arrays = dict(ttl_files=ttl_files,
+                  pk=pk,
+                  centroids=centroids,
+                  fam_size=fam_size,
+                  member_offsets=member_offsets,
+                  ext_ids=ext_ids,
+                  versions=versions,
+                  norm_vec=norm_vec)
+    _write_arrays(file_path, arrays)
+    logging.info('Saved %d centroid families with %d members to snapshot: %s' % (len(pk), len(ext_ids), file_path))
+    return len(pk), len(ext_ids)
+
+
+def _write_arrays(file_path, arrays):
+    """Write the arrays to a snapshot file.
+
+    :param str file_path: Path of the snapshot file to create.
+    :param dict arrays: The arrays to save, keyed by name.
+    :rtype: None
+    """
+    # The header's size depends on the offsets, so lay out the arrays assuming a generous header size first
+    header = {'format': FORMAT_VERSION,
+              'created': datetime.now(timezone.utc).strftime(ISO_TIME),
+              'arrays': {}}
+    head_room = len(json.dumps(header).encode('utf-8')) + 128 * len(arrays)
+    offset = _align(len(MAGIC) + 8 + head_room)
+    for name, arr in arrays.items():
+        header['arrays'][name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+        offset = _align(offset + arr.nbytes)
+    head = json.dumps(header).encode('utf-8')
+    assert len(head) <= head_room
+
+    with open(file_path, 'wb') as fout:
+        fout.write(MAGIC)
+        fout.write(np.uint64(len(head)).tobytes())
+        fout.write(head)
+        for name, arr in arrays.items():
+            fout.seek(header['arrays'][name]['offset'])
+            fout.write(np.ascontiguousarray(arr).tobytes())
+        fout.truncate(offset)
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+class SnapshotCentroidIndex(object):
+    """Look up centroid families and their extensions in a snapshot file.
+
+    The whole file is memory mapped once, and each array is a view into the
+    map, so loading a snapshot takes constant time and pages are only read
+    from disk as they're needed. Families are identified by their row in the
+    snapshot. See :class:`merl.DbCentroidIndex` for the database equivalent.
+    """
+
+    def __init__(self, file_path):
+        """
+        :param str file_path: Path to a snapshot file created by
+            :func:`export_snapshot`.
+        :raises ValueError: If the file isn't a snapshot or its format is
+            unsupported.
+        """
+        self.file_path = file_path
+        self._mm = np.memmap(file_path, dtype=np.uint8, mode='r')
+        if self._mm[:len(MAGIC)].tobytes() != MAGIC:
+            raise ValueError('Not a centroid snapshot file: %s' % file_path)
+        head_len = int(self._mm[len(MAGIC):len(MAGIC)+8].view(np.uint64)[0])
+        start = len(MAGIC) + 8
+        self.header = json.loads(self._mm[start:start+head_len].tobytes().decode('utf-8'))
+        if self.header['format'] != FORMAT_VERSION:
+            raise ValueError('Unsupported snapshot format %s in %s' % (self.header['format'], file_path))
+
+        for name, info in self.header['arrays'].items():
+            arr = np.ndarray(tuple(info['shape']), dtype=np.dtype(info['dtype']), buffer=self._mm,
+                             offset=info['offset'])
+            setattr(self, name, arr)
+        self.norm_vec = tuple(self.norm_vec.tolist())
+        logging.debug('Loaded snapshot with %d centroid families created %s' %
+                      (len(self.pk), self.header['created']))
+
+    def __len__(self):
+        return len(self.pk)
+
+    def close(self):
+        """Release the memory map. Nothing to do, since numpy unmaps it when it's no longer used."""
+        pass
+
+    def warm(self):
+        """Read the centroids of all the families into memory.
+
+        The members of the families are still only read from the file when
+        they're needed.
+
+        :return: The number of families.
+        :rtype: int
+        """
+        for name in ('ttl_files', 'pk', 'centroids', 'fam_size', 'member_offsets'):
+            setattr(self, name, np.array(getattr(self, name)))
+        return len(self.pk)
+
+    def family_rows(self, ttl_files, window=0):
+        """Return the range of rows of the families with the given number of files.
+
+        :param int ttl_files: The total number of files in the centroid.
+        :param int window: Also include the families with up to this many
+            more or fewer files.
+        :rtype: tuple(int, int)
+        """
+        lo, hi = np.searchsorted(self.ttl_files, [ttl_files - window, ttl_files + window + 1])
+        return int(lo), int(hi)
+
+    def families(self, ttl_files, window=0):
+        """Generate the centroid families with the given number of files.
+
+        :param int ttl_files: The total number of files in the centroid.
+        :param int window: Also generate the families with up to this many
+            more or fewer files.
+        :return: Generator of ``(row, centroid, family size)`` tuples.
+        :rtype: generator
+        """
+        lo, hi = self.family_rows(ttl_files, window)
+        for i, cent, n in zip(range(lo, hi), self.centroids[lo:hi].tolist(), self.fam_size[lo:hi].tolist()):
+            yield i, tuple(cent), n
+
+    def all_families(self):
+        """Generate every centroid family, ordered by their number of files.
+
+        :return: Generator of ``(row, centroid, family size)`` tuples.
+        :rtype: generator
+        """
+        for i, cent, n in zip(range(len(self.pk)), self.centroids.tolist(), self.fam_size.tolist()):
+            yield i, tuple(cent), n
+
+    def hydrate(self, hit, limit=None):
+        """Return the extensions in the hit families, ordered by confidence.
+
+        :param dict hit: The distance from the candidate to each family that
+            was a hit, keyed by the family's row.
+        :param int limit: Maximum number of extensions to return, or `None`
+            for all of them.
+        :return: List of dicts with the keys ``ext_id``, ``ext_ver``, and
+            ``confidence``, from most to least confident.
+        :rtype: list
+        """
+        rows = np.fromiter(hit.keys(), dtype=np.int64, count=len(hit))
+        dists = np.fromiter(hit.values(), dtype=np.float64, count=len(hit))
+        confidence = np.exp(-CONFIDENCE_DELTA * dists) / self.fam_size[rows]
+
+        entries = []
+        # All members of a family have the same confidence, so take whole families until there are enough members
+        for i in np.argsort(-confidence, kind='stable'):
+            row = rows[i]
+            for m in range(self.member_offsets[row], self.member_offsets[row+1]):
+                if limit is not None and len(entries) >= limit:
+                    return entries
+                entries.append(dict(ext_id=self.ext_ids[m].decode('utf-8'),
+                                    ext_ver=self.versions[m].decode('utf-8'),
+                                    confidence=float(confidence[i])))
+        return entries
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    from profiler.graph_diff import init_logging
+
+    args = docopt(__doc__)
+    init_logging(verbose=args['-v'])
+    export_snapshot(args['SNAPSHOT_FILE'])
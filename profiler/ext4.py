@@ -0,0 +1,476 @@
+# *-* coding: utf-8 *-*
+"""Read file metadata directly from a raw ext4 (or ext2/ext3) image.
+
+This is an alternative to running ``fiwalk`` on an image and parsing the
+resulting DFXML file. The image is memory mapped, and only the inode tables
+and directory entries needed to walk the ``home/.shadow`` subtree are read, so
+going from an image to a graph doesn't require writing or parsing any XML.
+
+The records produced by :meth:`Ext4Image.iter_records` have the same keys as
+the ones produced by :func:`profiler.graph_diff.iter_dfxml_records`, and can
+be given to :meth:`profiler.graph_diff.FilesDiff.add_from_records`.
+
+Only what's needed for building graphs is supported: the superblock, group
+descriptors (32 or 64 bytes), inodes, extent trees, block maps (ext2/ext3),
+linear and hashed directories, and inline data. Journals are not replayed, so
+the image should be from a cleanly unmounted filesystem.
+"""
+
+import mmap
+import struct
+from datetime import datetime, timezone
+from os import path
+
+from common.const import ISO_TIME, TYPE_TO_NAME, FType
+from common.util import separate_mode_type
+
+SUPERBLOCK_OFFSET = 1024
+EXT4_MAGIC = 0xEF53
+EXTENT_MAGIC = 0xF30A
+XATTR_MAGIC = 0xEA020000
+ROOT_INODE = 2
+
+# Inode flags
+EXTENTS_FL = 0x80000
+INLINE_DATA_FL = 0x10000000
+
+# Feature flags
+INCOMPAT_FILETYPE = 0x2
+INCOMPAT_64BIT = 0x80
+
+#: Symlinks whose targets are shorter than this are "fast", i.e. the target is stored in i_block
+FAST_SYMLINK_MAX = 60
+
+#: File types whose i_block doesn't hold block pointers
+NO_DATA_TYPES = frozenset((FType.chr, FType.blk, FType.pip, FType.soc))
+
+#: The path of the subtree read by default, relative to the root of the filesystem
+SHADOW_PATH = 'home/.shadow'
+
+_SUPERBLOCK = struct.Struct('<11I')
+_DIRENT = struct.Struct('<IHBB')
+_EXTENT_HEADER = struct.Struct('<HHHHI')
+_EXTENT_ENTRY = struct.Struct('<IHHI')
+_EXTENT_INDEX = struct.Struct('<IIH')
+_INODE = struct.Struct('<HHIIIIIHHII')
+_XATTR_ENTRY = struct.Struct('<BBHII')
+
+
+class NotExt4Error(ValueError):
+    """The image does not contain an ext2, ext3, or ext4 filesystem."""
+    pass
+
+
+class Inode(object):
+    """The fields of an inode that are used for building graphs."""
+
+    __slots__ = ('num', 'mode', 'uid', 'gid', 'size', 'atime', 'ctime', 'mtime', 'crtime', 'nlink', 'flags',
+                 'blocks', 'block', 'raw')
+
+    def __init__(self, num, raw, inode_size):
+        """
+        :param int num: The inode number.
+        :param bytes raw: The bytes of the inode from the inode table.
+        :param int inode_size: The size of each inode in the inode table.
+        """
+        self.num = num
+        self.raw = raw
+        (self.mode, uid_lo, size_lo, self.atime, self.ctime, self.mtime, dtime, gid_lo, self.nlink, blocks_lo,
+         self.flags) = _INODE.unpack_from(raw, 0)
+        self.block = raw[0x28:0x64]
+        size_hi, = struct.unpack_from('<I', raw, 0x6C)
+        blocks_hi, = struct.unpack_from('<H', raw, 0x74)
+        self.blocks = blocks_lo | (blocks_hi << 32)
+        uid_hi, gid_hi = struct.unpack_from('<HH', raw, 0x78)
+        self.size = size_lo | (size_hi << 32)
+        self.uid = uid_lo | (uid_hi << 16)
+        self.gid = gid_lo | (gid_hi << 16)
+
+        # The creation time only exists in the extra space of large inodes
+        self.crtime = None
+        if inode_size > 128:
+            extra_isize, = struct.unpack_from('<H', raw, 0x80)
+            if 128 + extra_isize >= 0x94:
+                self.crtime, = struct.unpack_from('<I', raw, 0x90)
+
+    @property
+    def file_type(self):
+        """The type of the file, as one of the values of :class:`common.const.FType`."""
+        return separate_mode_type(self.mode)[1]
+
+    @property
+    def is_dir(self):
+        return self.file_type == 2
+
+    @property
+    def has_extents(self):
+        return bool(self.flags & EXTENTS_FL)
+
+    @property
+    def has_inline_data(self):
+        return bool(self.flags & INLINE_DATA_FL)
+
+    @property
+    def is_fast_symlink(self):
+        """Whether the inode is a symlink whose target is stored in ``i_block`` instead of a data block."""
+        if self.file_type != FType.sym or self.has_extents or self.has_inline_data:
+            return False
+        # A block of extended attributes is also counted in i_blocks, but can't make the target any longer
+        return not self.blocks or self.size < FAST_SYMLINK_MAX
+
+    @property
+    def has_data_blocks(self):
+        """Whether ``i_block`` holds the extent tree or block map of the inode's data."""
+        return not (self.has_inline_data or self.is_fast_symlink or self.file_type in NO_DATA_TYPES)
+
+
+class Ext4Image(object):
+    """A memory mapped ext2/3/4 image.
+
+    Use as a context manager, or call :meth:`close` when done::
+
+        with Ext4Image('state.img') as img:
+            for rec in img.iter_records():
+                ...
+    """
+
+    def __init__(self, image_path, offset=0):
+        """
+        :param str image_path: Path to the raw image file.
+        :param int offset: Byte offset of the filesystem in the image, e.g.
+            when the image is of an entire disk instead of a single partition.
+        :raises NotExt4Error: If the superblock doesn't have the ext4 magic
+            number.
+        """
+        self.image_path = path.abspath(image_path)
+        self._fin = open(image_path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._fin.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._fin.close()
+            raise NotExt4Error('Image is empty: %s' % image_path)
+        self._base = offset
+        self._read_superblock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Release the memory map and close the image file.
+
+        :rtype: None
+        """
+        if not self._mm.closed:
+            self._mm.close()
+            self._fin.close()
+
+    def _read_superblock(self):
+        start = self._base + SUPERBLOCK_OFFSET
+        sb = self._mm[start:start + 1024]
+        if len(sb) < 1024 or struct.unpack_from('<H', sb, 0x38)[0] != EXT4_MAGIC:
+            raise NotExt4Error('No ext2/3/4 superblock found in %s at offset %d' % (self.image_path, self._base))
+
+        fields = _SUPERBLOCK.unpack_from(sb, 0)
+        self.inodes_count = fields[0]
+        self.first_data_block = fields[5]
+        self.block_size = 1024 << fields[6]
+        self.inodes_per_group = fields[10]
+        rev_level, = struct.unpack_from('<I', sb, 0x4C)
+        self.inode_size = struct.unpack_from('<H', sb, 0x58)[0] if rev_level else 128
+        self.feature_incompat, = struct.unpack_from('<I', sb, 0x60)
+        self.desc_size = 32
+        if self.feature_incompat & INCOMPAT_64BIT:
+            self.desc_size = struct.unpack_from('<H', sb, 0xFE)[0] or 32
+        self._inode_tables = {}
+        #: Number of blocks in the image. Block numbers past the end (from corrupt or truncated images) are ignored.
+        self.num_blocks = (len(self._mm) - self._base) // self.block_size
+
+    def _in_image(self, num, count=1):
+        return 0 < num and num + count <= self.num_blocks
+
+    def block(self, num, count=1):
+        """Return the contents of ``count`` blocks starting at block ``num``.
+
+        :param int num: Block number.
+        :param int count: Number of consecutive blocks to return.
+        :rtype: bytes
+        :raises ValueError: If any of the blocks is outside of the image.
+        """
+        if not self._in_image(num, count):
+            raise ValueError('Blocks %d to %d are outside of the image' % (num, num + count - 1))
+        start = self._base + num * self.block_size
+        return self._mm[start:start + count * self.block_size]
+
+    def _inode_table(self, group):
+        """Return the block number of the inode table of a block group."""
+        try:
+            return self._inode_tables[group]
+        except KeyError:
+            pass
+        gdt = (self.first_data_block + 1) * self.block_size
+        start = self._base + gdt + group * self.desc_size
+        desc = self._mm[start:start + self.desc_size]
+        table, = struct.unpack_from('<I', desc, 0x8)
+        if self.desc_size >= 64:
+            table |= struct.unpack_from('<I', desc, 0x28)[0] << 32
+        self._inode_tables[group] = table
+        return table
+
+    def inode(self, num):
+        """Return the inode with the given number.
+
+        :param int num: The inode number. The first inode is number 1.
+        :rtype: Inode
+        """
+        if not 0 < num <= self.inodes_count:
+            raise ValueError('Invalid inode number: %d' % num)
+        group, index = divmod(num - 1, self.inodes_per_group)
+        start = self._base + self._inode_table(group) * self.block_size + index * self.inode_size
+        return Inode(num, self._mm[start:start + self.inode_size], self.inode_size)
+
+    def iter_runs(self, inode):
+        """Generate the runs of physical blocks holding an inode's data.
+
+        :param Inode inode: The inode to read.
+        :return: Generator of ``(logical block, physical block, length)``
+            tuples. Unwritten extents, holes, and runs outside of the image
+            are not included. Inodes without data blocks (see
+            :attr:`Inode.has_data_blocks`) have no runs.
+        :rtype: generator
+        """
+        if not inode.has_data_blocks:
+            return
+        if inode.has_extents:
+            yield from self._iter_extents(inode.block)
+            return
+
+        # Block map: 12 direct blocks, then single, double, and triple indirect blocks
+        ptrs = struct.unpack_from('<15I', inode.block, 0)
+        logical = 0
+        for p in ptrs[:12]:
+            if self._in_image(p):
+                yield logical, p, 1
+            logical += 1
+        per_block = self.block_size // 4
+        for depth, p in enumerate(ptrs[12:], 1):
+            span = per_block ** depth
+            if self._in_image(p):
+                yield from self._iter_indirect(p, depth, logical)
+            logical += span
+
+    def _iter_indirect(self, block_num, depth, logical):
+        ptrs = struct.unpack_from('<%dI' % (self.block_size // 4), self.block(block_num), 0)
+        span = (self.block_size // 4) ** (depth - 1)
+        for p in ptrs:
+            if self._in_image(p):
+                if depth == 1:
+                    yield logical, p, 1
+                else:
+                    yield from self._iter_indirect(p, depth - 1, logical)
+            logical += span
+
+    def _iter_extents(self, node):
+        magic, entries, _, depth, _ = _EXTENT_HEADER.unpack_from(node, 0)
+        if magic != EXTENT_MAGIC:
+            return
+        for i in range(entries):
+            off = 12 + 12 * i
+            if depth:
+                _, leaf_lo, leaf_hi = _EXTENT_INDEX.unpack_from(node, off)
+                leaf = leaf_lo | (leaf_hi << 32)
+                if self._in_image(leaf):
+                    yield from self._iter_extents(self.block(leaf))
+            else:
+                logical, length, start_hi, start_lo = _EXTENT_ENTRY.unpack_from(node, off)
+                start = start_lo | (start_hi << 32)
+                if length > 32768:
+                    # Unwritten (preallocated) extent, which reads as zeros
+                    continue
+                if self._in_image(start, length):
+                    yield logical, start, length
+
+    def read_data(self, inode):
+        """Return all of the data of a file as bytes.
+
+        :param Inode inode: The inode to read.
+        :rtype: bytes
+        """
+        if inode.has_inline_data:
+            return self._inline_data(inode)[:inode.size]
+        if inode.is_fast_symlink:
+            return inode.block[:inode.size]
+        data = bytearray(inode.size)
+        for logical, phys, length in self.iter_runs(inode):
+            start = logical * self.block_size
+            if start >= inode.size:
+                continue
+            chunk = self.block(phys, length)[:inode.size - start]
+            data[start:start + len(chunk)] = chunk
+        return bytes(data)
+
+    def _inline_data(self, inode):
+        """Return the data stored in the inode itself.
+
+        The first 60 bytes are in ``i_block``, and the rest (if any) are in the
+        value of the ``system.data`` extended attribute in the inode.
+        """
+        data = inode.block
+        if self.inode_size <= 128:
+            return data
+        extra_isize, = struct.unpack_from('<H', inode.raw, 0x80)
+        start = 128 + extra_isize
+        if start + 4 > self.inode_size or struct.unpack_from('<I', inode.raw, start)[0] != XATTR_MAGIC:
+            return data
+        entries = start + 4
+        off = entries
+        while off + _XATTR_ENTRY.size <= self.inode_size:
+            name_len, name_index, value_offs, value_inum, value_size = _XATTR_ENTRY.unpack_from(inode.raw, off)
+            if not name_len and not name_index:
+                break
+            name = inode.raw[off + 16:off + 16 + name_len]
+            if name_index == 7 and name == b'data':
+                return data + inode.raw[entries + value_offs:entries + value_offs + value_size]
+            off += (16 + name_len + 3) & ~3
+        return data
+
+    def iter_dir(self, inode):
+        """Generate the entries of a directory, excluding ``.`` and ``..``.
+
+        :param Inode inode: The directory's inode.
+        :return: Generator of ``(name, inode number, file type)`` tuples, where
+            the file type is from the directory entry (0 if the filesystem
+            doesn't store file types in directory entries).
+        :rtype: generator
+        """
+        has_ftype = bool(self.feature_incompat & INCOMPAT_FILETYPE)
+        if inode.has_inline_data:
+            # Inline directories start with the parent's inode number instead of "." and ".." entries
+            yield from self._parse_dirents(self._inline_data(inode)[4:], has_ftype)
+            return
+        for logical, phys, length in self.iter_runs(inode):
+            for i in range(length):
+                if (logical + i) * self.block_size >= inode.size:
+                    break
+                yield from self._parse_dirents(self.block(phys + i), has_ftype)
+
+    @staticmethod
+    def _parse_dirents(buf, has_ftype):
+        off = 0
+        end = len(buf)
+        while off + _DIRENT.size <= end:
+            ino, rec_len, name_len, ftype = _DIRENT.unpack_from(buf, off)
+            if rec_len < _DIRENT.size:
+                break
+            # Entries with inode 0 are unused, including the checksum at the end of each block
+            if ino and name_len:
+                name = buf[off + 8:off + 8 + name_len]
+                if name not in (b'.', b'..'):
+                    yield name.decode('utf-8', errors='replace'), ino, ftype if has_ftype else 0
+            off += rec_len
+
+    def lookup(self, file_path):
+        """Return the inode of the file at ``file_path``.
+
+        :param str file_path: Path relative to the root of the filesystem.
+        :rtype: Inode
+        :raises FileNotFoundError: If any part of the path doesn't exist.
+        """
+        inode = self.inode(ROOT_INODE)
+        for part in file_path.strip('/').split('/'):
+            if not part:
+                continue
+            for name, ino, ftype in self.iter_dir(inode):
+                if name == part:
+                    inode = self.inode(ino)
+                    break
+            else:
+                raise FileNotFoundError('%s not found in %s' % (file_path, self.image_path))
+        return inode
+
+    def make_record(self, filename, inode, parent_inode, name_type=None):
+        """Return the record describing a file, like one from a DFXML file.
+
+        :param str filename: Path of the file relative to the root of the
+            filesystem, e.g. ``home/.shadow``.
+        :param Inode inode: The file's inode.
+        :param int parent_inode: The inode number of the directory containing
+            the file.
+        :param int name_type: The file type from the directory entry. When not
+            given, the type from the inode's mode is used.
+        :rtype: dict
+        """
+        mode, meta_type = separate_mode_type(inode.mode)
+        if not name_type:
+            name_type = meta_type
+        # Fast symlinks, device files, etc. have no data blocks, so their offset is unknown, like in DFXML
+        fs_offset = '?'
+        first = min((phys for l, phys, n in self.iter_runs(inode)), default=None)
+        if first is not None:
+            fs_offset = first * self.block_size
+
+        rec = {'filename': filename,
+               'inode': inode.num,
+               'parent_inode': parent_inode,
+               'meta_type': meta_type,
+               'name_type': TYPE_TO_NAME.get(name_type, '-'),
+               'alloc': True,
+               'used': True,
+               'fs_offset': fs_offset,
+               'filesize': inode.size,
+               'mode': str(mode),
+               'uid': str(inode.uid),
+               'gid': str(inode.gid),
+               'nlink': str(inode.nlink),
+               'mtime': _iso_time(inode.mtime),
+               'ctime': _iso_time(inode.ctime),
+               'atime': _iso_time(inode.atime),
+               }
+        if inode.crtime is not None:
+            rec['crtime'] = _iso_time(inode.crtime)
+        return rec
+
+    def iter_records(self, top=SHADOW_PATH):
+        """Generate a record for each file in the ``top`` subtree.
+
+        Records are also generated for each of the directories on the way to
+        ``top`` (e.g. ``home``), so the parents of all files are known. Only
+        files that are reachable from a directory are included, i.e. only
+        allocated and used files.
+
+        :param str top: Path of the subtree to read, relative to the root of
+            the filesystem.
+        :return: Generator of records with the same keys as those from
+            :func:`profiler.graph_diff.iter_dfxml_records`.
+        :rtype: generator
+        """
+        parent = self.inode(ROOT_INODE)
+        filename = ''
+        for part in top.strip('/').split('/'):
+            for name, ino, ftype in self.iter_dir(parent):
+                if name == part:
+                    break
+            else:
+                raise FileNotFoundError('%s not found in %s' % (top, self.image_path))
+            filename = path.join(filename, part)
+            inode = self.inode(ino)
+            yield self.make_record(filename, inode, parent.num, ftype)
+            parent = inode
+
+        # Depth-first walk of the subtree, without recursion
+        stack = [(filename, parent)]
+        while stack:
+            dir_name, dir_inode = stack.pop()
+            for name, ino, ftype in self.iter_dir(dir_inode):
+                inode = self.inode(ino)
+                filename = dir_name + '/' + name
+                yield self.make_record(filename, inode, dir_inode.num, ftype)
+                if inode.is_dir:
+                    stack.append((filename, inode))
+
+
+def _iso_time(timestamp):
+    """Format a timestamp from an inode the same way DFXML does."""
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(ISO_TIME)
@@ -6,18 +6,27 @@ Command line::
  Usage: graph_diff.py [options]
 
  Options:
-  -f FILE   Save duplicate data to FILE
+  -f FILE   Save duplicate data to FILE. The format is determined by the
+            extension: .csv, .jsonl, or a text table for anything else.
+  --no-color  Don't add color to a text table of duplicates
   -d        Show only files at a depth below home >= the Extensions dir (7)
+  -n NUM    Compare only the NUM most recent images instead of all of them
+  -g FILE   Save the drawing of the graph to FILE instead of showing it
+  -t NUM    Draw only the NUM largest subtrees of the graph
+  -c NUM    Draw at most NUM children of any directory, collapsing the rest
   -v        Set logging level from INFO to DEBUG
 
 """
 
+import csv
 import json
 import logging
 import os
+from contextlib import closing
 from hashlib import sha256
 from os import path
 
+import numpy as np
 from docopt import docopt
 from lxml import etree
 
@@ -25,9 +34,26 @@ from common import clr
 from common import util
 from common.centroid import get_tree_top
 from common.const import *
-from common.graph import DblingGraph, make_graph_from_dir, get_dir_depth, graph_draw
-
-MAX_FILES = 2
+from common.graph import DblingGraph, make_graph_from_dir, get_dir_depth, graph_draw, get_child_arrays, \
+    get_bfs_levels, GraphView, label_components, ungroup_vector_property
+from profiler.ext4 import Ext4Image
+
+MAX_FILES = None  #: Maximum number of images to compare, or None for no limit
+
+#: Bounds on the width and height (in pixels) of drawings saved to a file
+MIN_DRAW_SIZE = 600
+MAX_DRAW_SIZE = 4000
+
+# Vertex fill colors (RGBA) and the shapes graph_draw accepts, in the order of their int values
+_COLORS = {'red': [0.640625, 0, 0, 0.9],
+           'blue': [0, 0, 0.640625, 0.9],
+           'purple': [0.502, 0., 0.502, 0.9],
+           'cyan': [0, 0.749, 0.749, 0.9],
+           'magenta': [0.8, 0, 0.8, 0.9],
+           'black': [0, 0, 0, 0.8]}
+_SHAPES = ('circle', 'triangle', 'square', 'pentagon', 'hexagon', 'heptagon', 'octagon', 'double_circle',
+           'double_triangle', 'double_square', 'double_pentagon', 'double_hexagon', 'double_heptagon',
+           'double_octagon', 'pie', 'none')
 
 KNOWN_EXT_DIR = None
 
@@ -35,12 +61,19 @@ INODE_ONLY = False
 HASH_LABEL = True
 
 
-class DuplicatesCompleted(Exception):
+class SkipVolume(Exception):
     pass
 
 
-class SkipVolume(Exception):
-    pass
+class VertexAttrs(object):
+    """Read-only mapping view of the properties of a single vertex."""
+
+    def __init__(self, graph, vertex):
+        self._vp = graph.vp
+        self._vertex = vertex
+
+    def __getitem__(self, key):
+        return self._vp[key][self._vertex]
 
 
 class FileObj(object):
@@ -69,6 +102,430 @@ class FileObj(object):
         return self._obj
 
 
+def iter_dfxml_records(file_path):
+    """Generate a record for each allocated and used file object in a DFXML file.
+
+    Each record is a dict with the following keys: ``filename``, ``inode``,
+    ``parent_inode``, ``meta_type``, ``name_type``, ``alloc``, ``used``,
+    ``fs_offset`` (the lowest offset of the file's byte runs, or ``"?"``),
+    ``filesize``, and whichever of ``size``, ``mode``, ``uid``, ``gid``,
+    ``nlink``, ``mtime``, ``ctime``, ``atime``, and ``crtime`` are in the
+    file object. :meth:`profiler.ext4.Ext4Image.iter_records` generates the
+    same records from a raw image.
+
+    :param str file_path: Path to the DFXML file.
+    :return: Generator of records.
+    :rtype: generator
+    """
+    ns = '{http://www.forensicswiki.org/wiki/Category:Digital_Forensics_XML}'
+
+    num_unallocated = 0
+    num_unused = 0
+
+    # Parse the file incrementally, so the first records are generated right away and the whole tree is never in memory
+    for _, element in etree.iterparse(file_path, events=('end',), tag=ns + 'fileobject'):
+        try:
+            file_obj = FileObj(element, ns)
+
+            # Get the filename
+            try:
+                filename = str(file_obj.findtext('filename'))
+            except AttributeError:
+                filename = None
+            # else:
+            #     if filename.startswith('EFI-SYSTEM'):
+            #         raise SkipVolume
+
+            # Get allocation status
+            try:
+                alloc = int(file_obj.findtext('alloc'))
+            except AttributeError:
+                try:
+                    alloc = int(file_obj.findtext('unalloc'))
+                except AttributeError:
+                    logging.critical('File object has neither an alloc or unalloc tag: %s' % filename)
+                    continue
+                else:
+                    alloc = 1 - alloc
+            alloc = bool(alloc)
+            if not alloc:
+                # TODO: Dr. Ahn wants these files to be included for some reason
+                num_unallocated += 1
+                continue
+
+            # Get used status
+            try:
+                used = int(file_obj.findtext('used'))
+            except AttributeError:
+                try:
+                    used = int(file_obj.findtext('unused'))
+                except AttributeError:
+                    logging.critical('File object has neither a used or unused tag: %s' % filename)
+                    continue
+                else:
+                    used = 1 - used
+            used = bool(used)
+            if not used:
+                num_unused += 1
+                continue
+
+            # TODO: Figure out what to do with any files that passed tests up to this point but don't have a name
+            if filename is None:
+                filename = str(etree.tostring(file_obj.find('id')))
+                print(filename)  # TODO: Remove this, replace with heuristics that determine if the vertex is worth keeping
+                continue
+
+            fs_offset = float('inf')
+            for fs in file_obj.iter_grandchild('byte_runs', 'byte_run'):
+                # Get the lowest offset of the file
+                _off = fs.get('fs_offset')
+                if _off is None:
+                    continue
+                else:
+                    _off = int(_off)
+
+                if _off < fs_offset:
+                    fs_offset = _off
+            if fs_offset == float('inf'):
+                fs_offset = '?'
+
+            filesize = '?'
+            try:
+                # Try to use the DFXML-computed length first
+                filesize = file_obj.findtext('filesize')
+            except AttributeError:
+                # Iterate through the byte runs and sum their lengths
+                _sum = 0
+                for r in file_obj.iter_grandchild('byte_runs', 'byte_run'):
+                    _sum += int(r['len'])
+                if _sum > 0:
+                    filesize = _sum
+
+            try:
+                inode_num = int(file_obj.findtext('inode'))
+                parent_obj = int(file_obj.find('parent_object').findtext(ns + 'inode'))
+                meta_type = int(file_obj.findtext('meta_type'))
+                name_type = file_obj.findtext('name_type')
+            except (AttributeError, ValueError):
+                # Files outside the subtree of interest are skipped later anyway, so don't stop for them here
+                if re.search(_GraphDiff.ex_pat_shadow, filename):
+                    raise
+                continue
+
+            rec = {'filename': filename,
+                   'inode': inode_num,
+                   'parent_inode': parent_obj,
+                   'meta_type': meta_type,
+                   'name_type': name_type,
+                   'alloc': alloc,
+                   'used': used,
+                   'fs_offset': fs_offset,
+                   'filesize': filesize,
+                   }
+
+            # Stubborn parameters
+            for k in ('size', 'mode', 'uid', 'gid', 'nlink', 'mtime', 'ctime', 'atime', 'crtime'):
+                try:
+                    rec[k] = file_obj.findtext(k)
+                except AttributeError:
+                    pass
+
+            yield rec
+
+        finally:
+            # Free the file object and the ones before it, which have all been processed
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    logging.debug("Number of unallocated files: %d" % num_unallocated)
+    logging.debug("Number of allocated but unused files: %d" % num_unused)
+
+
+class DuplicateWriter(object):
+    """Stream information about duplicate file objects to a file.
+
+    Each duplicate is a pair of entries: the file object already in the graph
+    and the one that duplicates it. Pairs are buffered and written to the file
+    in bulk every :attr:`flush_every` pairs, so the report can be written in
+    the same pass that builds the graph. The output format is determined by
+    the extension of the file:
+
+    - ``.csv``: One row per entry, with ``pair`` and ``entry`` columns
+      identifying which duplicate the row belongs to.
+    - ``.jsonl``: One JSON object per pair, with ``original`` and ``duplicate``
+      keys.
+    - Anything else: A text table, where the fields of the duplicate that
+      differ from the original are highlighted when ``color`` is `True`.
+    """
+
+    #: Fields saved for each entry and their widths in the text table
+    fields = (('inode', 6), ('parent_inode', 6), ('name_type', 2), ('type', 2), ('alloc', 2), ('used', 2),
+              ('mode', 5), ('nlink', 3), ('uid', 5), ('gid', 5), ('fs_offset', 12), ('filesize', 8), ('mtime', 20),
+              ('ctime', 20), ('atime', 20), ('crtime', 20), ('filename_id', 18), ('filename_end', 13))
+    #: Headings of the columns in the text table
+    titles = ('inode', 'pinode', 'nt', 'ty', 'al', 'ud', 'mode', 'nlk', 'uid', 'gid', 'Start', 'Length',
+              'Modified Time', 'inode Changed Time', 'Accessed Time', 'Created Time', 'Filename Hash Tail',
+              'Filename Tail')
+    flush_every = 1000  #: Number of pairs to buffer before writing to the file
+    header_every = 10  #: Number of pairs between headers in the text table
+
+    def __init__(self, file_path, color=True):
+        """
+        :param str file_path: Path to the output file. Any existing file is
+            overwritten.
+        :param bool color: Add ANSI color to the text table. Has no effect on
+            the CSV and JSONL formats.
+        """
+        self.file_path = file_path
+        self.color = color
+        self.format = 'txt'
+        if file_path.endswith('.csv'):
+            self.format = 'csv'
+        elif file_path.endswith('.jsonl'):
+            self.format = 'jsonl'
+        self.count = 0
+        self._pairs = []
+        self._fout = open(file_path, 'w', newline='', buffering=1 << 20)
+        self._names = [k for k, n in self.fields]
+
+        if self.format == 'csv':
+            self._csv = csv.writer(self._fout)
+            self._csv.writerow(['pair', 'entry'] + self._names)
+        elif self.format == 'txt':
+            self._row_fmt = ' ' + ''.join('%%%ds|' % n for k, n in self.fields)
+            header = self._row_fmt % self.titles
+            self._break = ('--   ' * (len(header) // 5 + 1))[:len(header)]
+            if color:
+                header = clr.yellow(clr.black(header, False))
+                self._break = clr.green(self._break, False)
+            self._header = header + '\n'
+            self._fout.write('\nDuplicates:')
+
+    def add(self, original, duplicate):
+        """Add a pair of duplicate entries to the report.
+
+        :param original: The attributes of the file object already in the
+            graph. Any mapping from field names to values will do.
+        :param dict duplicate: The attributes of the duplicate file object.
+        :rtype: None
+        """
+        self._pairs.append((self._values(original), self._values(duplicate)))
+        if len(self._pairs) >= self.flush_every:
+            self.flush()
+
+    def _values(self, attrs):
+        """Return the values of :attr:`fields` from ``attrs`` as a list.
+
+        Sequences of file types are joined into a single string, e.g. ``"12"``
+        for a file that was both a regular file and a directory.
+        """
+        vals = []
+        for k in self._names:
+            v = attrs[k]
+            if k == 'type':
+                v = ''.join(str(t) for t in v)
+            vals.append(v)
+        return vals
+
+    def flush(self):
+        """Write all buffered pairs to the file.
+
+        :rtype: None
+        """
+        pairs, self._pairs = self._pairs, []
+        if self.format == 'csv':
+            rows = []
+            for n, (x, y) in enumerate(pairs, self.count + 1):
+                rows.append([n, 'original'] + x)
+                rows.append([n, 'duplicate'] + y)
+            self._csv.writerows(rows)
+        elif self.format == 'jsonl':
+            self._fout.writelines(json.dumps({'original': dict(zip(self._names, x)),
+                                              'duplicate': dict(zip(self._names, y))}) + '\n'
+                                  for x, y in pairs)
+        else:
+            self._fout.writelines(self._table(pairs, self.count))
+        self.count += len(pairs)
+        self._fout.flush()
+
+    def _table(self, pairs, start):
+        """Generate the lines of the text table for ``pairs``.
+
+        :param list pairs: Pairs of lists of field values.
+        :param int start: The number of pairs written before these.
+        """
+        for n, (x, y) in enumerate(pairs, start):
+            yield '\n'
+            if not n % self.header_every:
+                yield self._header
+            x_fields = []
+            y_fields = []
+            for (k, w), xf, yf in zip(self.fields, x, y):
+                if k == 'filename_id':
+                    # Display only the last w characters of the hash
+                    xf = xf[-w:]
+                    yf = yf[-w:]
+                xf = str(xf).rjust(w)
+                yf = str(yf).rjust(w)
+                if self.color:
+                    if yf != xf:
+                        yf = clr.blue(yf)
+                    if xf.strip() == '?':
+                        xf = clr.cyan(xf, False)
+                x_fields.append(xf)
+                y_fields.append(yf)
+            yield ' %s|\n' % '|'.join(x_fields)
+            yield ' %s|\n' % '|'.join(y_fields)
+            yield self._break
+
+    def close(self):
+        """Write any buffered pairs and close the file.
+
+        :rtype: None
+        """
+        if self._fout.closed:
+            return
+        self.flush()
+        if self.format == 'txt':
+            self._fout.write('\n\n')
+        self._fout.close()
+        logging.info('Saved %d duplicates to file: %s' % (self.count, self.file_path))
+
+
+class ImageMembership(object):
+    """Track which of the ingested images each file object appears in.
+
+    Each file object (keyed by its ``filename_id``) gets a row with one bit
+    per image, stored in a fixed-width array of 64-bit words, along with a
+    signature of its metadata in each image. Images can be added at any time,
+    and all queries are answered for every row at once as array operations.
+    """
+
+    #: Number of rows to allocate at a time
+    grow_rows = 4096
+
+    def __init__(self):
+        self._rows = {}  # Maps filename_id to row number
+        self._images = {}  # Maps image ID to column (bit) number
+        self._bits = np.zeros((self.grow_rows, 1), dtype=np.uint64)
+        self._sigs = np.zeros((self.grow_rows, 0), dtype=np.int64)
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def images(self):
+        """The image IDs, in the order they were added.
+
+        :rtype: list
+        """
+        return sorted(self._images, key=self._images.get)
+
+    @property
+    def num_images(self):
+        """The number of images added so far.
+
+        :rtype: int
+        """
+        return len(self._images)
+
+    def add_image(self, image_id):
+        """Add a column for an image, if it doesn't already have one.
+
+        :param image_id: Any hashable value identifying the image.
+        :return: The column number for the image.
+        :rtype: int
+        """
+        try:
+            return self._images[image_id]
+        except KeyError:
+            pass
+        col = self._images[image_id] = len(self._images)
+        if col >= self._bits.shape[1] * 64:
+            self._bits = np.hstack((self._bits, np.zeros((len(self._bits), 1), dtype=np.uint64)))
+        self._sigs = np.hstack((self._sigs, np.zeros((len(self._sigs), 1), dtype=np.int64)))
+        return col
+
+    def add(self, filename_id, image_id, signature=0):
+        """Record that a file object appears in an image.
+
+        :param str filename_id: Hash of the file object's full path.
+        :param image_id: Any hashable value identifying the image.
+        :param int signature: Hash of the file object's metadata in this
+            image. Used to detect changes between images.
+        :return: The row number for the file object.
+        :rtype: int
+        """
+        col = self.add_image(image_id)
+        row = self._rows.get(filename_id)
+        if row is None:
+            row = self._rows[filename_id] = len(self._rows)
+            if row >= len(self._bits):
+                extra = max(self.grow_rows, len(self._bits))
+                self._bits = np.vstack((self._bits, np.zeros((extra, self._bits.shape[1]), dtype=np.uint64)))
+                self._sigs = np.vstack((self._sigs, np.zeros((extra, self._sigs.shape[1]), dtype=np.int64)))
+        self._bits[row, col >> 6] |= np.uint64(1 << (col & 63))
+        self._sigs[row, col] = signature
+        return row
+
+    def row(self, filename_id):
+        """Return the row number for a file object.
+
+        :param str filename_id: Hash of the file object's full path.
+        :rtype: int
+        :raises KeyError: When the file object hasn't been added.
+        """
+        return self._rows[filename_id]
+
+    def present(self, image_id, rows=None):
+        """Return whether each file object appears in the image.
+
+        :param image_id: ID of the image, as given to :meth:`add`.
+        :param numpy.ndarray rows: Rows to include in the result. Defaults to
+            all rows.
+        :return: Boolean array with one value per row.
+        :rtype: numpy.ndarray
+        """
+        col = self._images[image_id]
+        words = self._bits[:len(self), col >> 6]
+        mask = ((words >> np.uint64(col & 63)) & np.uint64(1)).astype(bool)
+        return mask if rows is None else mask[rows]
+
+    def counts(self, rows=None):
+        """Return the number of images each file object appears in.
+
+        :param numpy.ndarray rows: Rows to include in the result. Defaults to
+            all rows.
+        :return: Integer array with one value per row.
+        :rtype: numpy.ndarray
+        """
+        bits = self._bits[:len(self)]
+        if rows is not None:
+            bits = bits[rows]
+        return np.unpackbits(np.ascontiguousarray(bits).view(np.uint8), axis=1).sum(axis=1)
+
+    def only_in(self, image_a, image_b, rows=None):
+        """Return whether each file object is present in ``image_a`` but not
+        ``image_b``.
+
+        :rtype: numpy.ndarray
+        """
+        return self.present(image_a, rows) & ~self.present(image_b, rows)
+
+    def changed(self, image_a, image_b, rows=None):
+        """Return whether each file object is present in both images but its
+        metadata differs between them.
+
+        :rtype: numpy.ndarray
+        """
+        sigs = self._sigs[:len(self)]
+        if rows is not None:
+            sigs = sigs[rows]
+        differs = sigs[:, self._images[image_a]] != sigs[:, self._images[image_b]]
+        return self.present(image_a, rows) & self.present(image_b, rows) & differs
+
+
 class _GraphDiff(object):
 
     # Regular expressions for filtering files
@@ -77,11 +534,14 @@ class _GraphDiff(object):
     in_pat_home = re.compile('^/?home$')
     in_pat_shadow = re.compile('^/?home/\.shadow$')
 
-    def __init__(self, dupl_file=None):
+    def __init__(self, dupl_file=None, dupl_color=True):
         self.digr = DblingGraph()
         self.type_count = {}
         self.home_vertex = None
         self.dupl_file = dupl_file
+        self.dupl_color = dupl_color
+        self._dupl_writer = None
+        self.membership = ImageMembership()
         self._filter_depth = False
         self.gi = {}  # graph indexes: maps vertex "labels" to vertex objects
 
@@ -94,15 +554,54 @@ class _GraphDiff(object):
         # Queue for removing vertices
         self._to_remove = []
 
-    def deinit(self, clean=True, dup=False):
+    def deinit(self, clean=True):
+        if self._dupl_writer is not None:
+            self._dupl_writer.close()
         if clean:
             logging.info('Execution completed cleanly. Shutting down.')
-        elif dup and self.dupl_file is not None:
-            logging.info('Exiting. Duplicates written to file: %s' % self.dupl_file)
         else:
             logging.warning('Unclean shutdown. Did not finish processing the diffs.')
         logging.shutdown()  # Flush and close all handlers
 
+    def vertex_rows(self, digr=None):
+        """Return the membership row of each vertex in the graph.
+
+        :param DblingGraph digr: The graph whose vertices should be looked up.
+            Defaults to the main graph.
+        :return: Array of rows in :attr:`membership`, indexed by vertex index.
+        :rtype: numpy.ndarray
+        """
+        if digr is None:
+            digr = self.digr
+        return digr.vp['member_row'].a
+
+    def only_in(self, image_a, image_b):
+        """Return which vertices are present in ``image_a`` but not ``image_b``.
+
+        :return: Boolean array indexed by vertex index.
+        :rtype: numpy.ndarray
+        """
+        return self.membership.only_in(image_a, image_b, self.vertex_rows())
+
+    def changed(self, image_a, image_b):
+        """Return which vertices changed between ``image_a`` and ``image_b``.
+
+        :return: Boolean array indexed by vertex index.
+        :rtype: numpy.ndarray
+        """
+        return self.membership.changed(image_a, image_b, self.vertex_rows())
+
+    def log_image_diffs(self):
+        """Log how many file objects differ between each consecutive image.
+
+        :rtype: None
+        """
+        images = self.membership.images
+        for a, b in zip(images, images[1:]):
+            logging.info('Images %s -> %s:  added %d  removed %d  changed %d' %
+                         (a, b, self.membership.only_in(b, a).sum(), self.membership.only_in(a, b).sum(),
+                          self.membership.changed(a, b).sum()))
+
     def graph_copy(self):
         """Return a copy of the graph object.
 
@@ -111,96 +610,147 @@ class _GraphDiff(object):
         """
         return self.digr.copy()
 
-    def show_graph(self, digr=None):
+    def show_graph(self, digr=None, output=None, root=None, top_n=None, max_children=None):
+        """Draw the graph, either in a window or to a file.
+
+        The colors and shapes of the vertices are computed for all vertices at
+        once, and only the selected part of the graph is handed to
+        :func:`~graph_tool.draw.graph_draw`, so the cost of drawing can be
+        bounded on large images:
+
+        - Colors: purple for file objects in two or more images, red for those
+          in the first image only, blue for those in the second only, cyan for
+          unknown file types, and black for vertices marked for removal.
+        - Shapes: circles (hexagons when encrypted) for regular files,
+          triangles (double triangles when encrypted) for directories, squares
+          for anything else, and double squares for collapsed directories.
+
+        :param DblingGraph digr: The graph to draw. Defaults to the main graph.
+        :param str output: Path of the file to write the drawing to. The format
+            is determined by the extension (e.g. ``.svg``, ``.png``, ``.pdf``).
+            When not given, the graph is shown in an interactive window.
+        :param root: Draw only the subtree under this vertex (or vertex index).
+        :param int top_n: Draw only the ``top_n`` largest subtrees (weakly
+            connected components) of the graph, i.e. the biggest candidates.
+        :param int max_children: Draw at most this many children of any one
+            directory. The rest of its children and their successors are
+            collapsed into the directory, which is drawn larger.
+        :rtype: None
+        """
         # It's probably too late to call this, but it marks this function as using the extended attributes
         self.digr.init_extended_attrs()
 
-        # TODO: If this needs to support more than MAX_FILES==3, rewrite this
         if digr is None:
             digr = self.digr
 
-        num_drawn = 0.0  # To get floating point answer when dividing later
-        next_logged = 0.25
-        for vertex in digr.vertices():
-            # Reset variables, just in case
-            color = shape = None
-
-            # How many files was this a part of?
-            if len(digr.vp["src_files"][vertex]) >= 2:
-                color = [0.502, 0., 0.502, 0.9]  # 'purple'
-            elif 1 in digr.vp["src_files"][vertex] or not len(digr.vp["src_files"][vertex]):
-                color = [0.640625, 0, 0, 0.9]  # 'r'  # Red
-            elif 2 in digr.vp["src_files"][vertex]:
-                color = [0, 0, 0.640625, 0.9]  # 'b'  # Blue
-
-            # File, directory, or other? Was it encrypted or not?
-            enc = digr.vp['encrypted'][vertex]
-            for t in digr.vp['type'][vertex]:
-                # May redraw the same node multiple times, but that's better than losing data in the graph # TODO: Not true anymore
-                if t == FType.reg:
-                    if enc:
-                        shape = 'hexagon'
-                    else:
-                        shape = 'circle'
-
-                elif t == FType.dir:
-                    if enc:
-                        shape = 'double_triangle'
-                    else:
-                        shape = 'triangle'
-                else:
-                    # Unknown file types
-                    color = [0, 0.749, 0.749, 0.9]  # Cyan
-                    shape = 'square'
-                break
-
-            if not len(digr.vp['color'][vertex]):  # Only set color if we didn't already set it
-                # import pdb; pdb.set_trace()
-                digr.vp['color'][vertex] = color
-            digr.vp['shape'][vertex] = shape
-
-            if digr.vp['inode'][vertex] == KNOWN_EXT_DIR:
-                digr.vp['color'][vertex] = [0.8, 0, 0.8, 0.9]
-                digr.vp['graph_size'][vertex] = 10
-            else:
-                digr.vp['graph_size'][vertex] = 5
-
-            if not digr.vp['keeper'][vertex]:
-                digr.vp['color'][vertex] = [0, 0, 0, 0.8]
-
-            # Log progress
-            num_drawn += 1
-            if (num_drawn/digr.num_vertices()) >= next_logged:
-                per = str(int(next_logged*100)) + '%'
-                logging.debug('Drawn %s of the nodes in the graph (%d/%d)' % (per, num_drawn, digr.num_vertices()))
-                if next_logged == 0.25:
-                    next_logged = 0.5
-                elif next_logged == 0.5:
-                    next_logged = 0.75
-                elif next_logged == 0.75:
-                    next_logged = 1.0
-
-        # Continue drawing here
+        offsets, children, parents = get_child_arrays(digr)
+        num_v = len(parents)
+        types = vertex_type_array(digr)
+        encrypted = digr.vp['encrypted'].a.astype(bool)
+
+        # Choose which vertices to draw
+        selected = np.ones(num_v, dtype=bool)
+        filt, inverted = digr.get_vertex_filter()
+        if filt is not None:
+            selected = filt.a.astype(bool) != inverted
+        if root is not None:
+            in_subtree = np.zeros(num_v, dtype=bool)
+            in_subtree[np.concatenate(get_bfs_levels(offsets, children, [int(root)]))] = True
+            selected &= in_subtree
+        if top_n is not None:
+            comp, hist = label_components(digr, directed=False)
+            labels = comp.a
+            top_labels = np.argsort(hist, kind='stable')[::-1][:top_n]
+            selected &= np.isin(labels, top_labels)
+
+        collapsed = np.zeros(num_v, dtype=bool)
+        if max_children is not None:
+            # Rank each child among its siblings, then hide every vertex below a child that ranks too low
+            out_deg = np.diff(offsets)
+            rank = np.arange(len(children)) - np.repeat(offsets[:-1], out_deg)
+            in_budget = np.ones(num_v, dtype=bool)
+            in_budget[children] = rank < max_children
+            tops = np.flatnonzero(selected & ((parents < 0) | ~selected[np.maximum(parents, 0)]))
+            for lvl in get_bfs_levels(offsets, children, tops)[1:]:
+                in_budget[lvl] &= in_budget[parents[lvl]]
+            collapsed = selected & (out_deg > max_children)
+            selected &= in_budget
+
+        # How many images was each vertex a part of? Only the first two get their own colors.
+        images = self.membership.images
+        rows = self.vertex_rows(digr)
+        no_images = np.zeros(num_v, dtype=bool)
+        counts = self.membership.counts(rows) if len(self.membership) else np.zeros(num_v, dtype=int)
+        in_first = self.membership.present(images[0], rows) if images else no_images
+        in_second = self.membership.present(images[1], rows) if len(images) > 1 else no_images
+
+        colors = np.tile(_COLORS['red'], (num_v, 1))
+        colors[~in_first & (counts > 0) & in_second] = _COLORS['blue']
+        colors[counts >= 2] = _COLORS['purple']
+
+        is_reg = types == FType.reg
+        is_dir = types == FType.dir
+        unknown = ~is_reg & ~is_dir
+        colors[unknown] = _COLORS['cyan']
+
+        # Keep any colors set while building or trimming the graph (e.g. the home directory)
+        preset = digr.vp['color'].get_2d_array([0, 1, 2, 3]).T
+        has_preset = preset[:, 3] > 0
+        colors[has_preset] = preset[has_preset]
+        if KNOWN_EXT_DIR is not None:
+            colors[digr.vp['inode'].a == KNOWN_EXT_DIR] = _COLORS['magenta']
+        colors[~digr.vp['keeper'].a.astype(bool)] = _COLORS['black']
+
+        shapes = np.full(num_v, _SHAPES.index('square'))
+        shapes[is_reg] = _SHAPES.index('circle')
+        shapes[is_reg & encrypted] = _SHAPES.index('hexagon')
+        shapes[is_dir] = _SHAPES.index('triangle')
+        shapes[is_dir & encrypted] = _SHAPES.index('double_triangle')
+        shapes[collapsed] = _SHAPES.index('double_square')
+
+        sizes = np.full(num_v, 5.)
+        sizes[collapsed] = 10.
+        if KNOWN_EXT_DIR is not None:
+            sizes[digr.vp['inode'].a == KNOWN_EXT_DIR] = 10.
+
+        fill = digr.new_vertex_property('vector<float>')
+        fill.set_2d_array(colors.T)
+        shape = digr.new_vertex_property('int')
+        shape.a = shapes
+        size = digr.new_vertex_property('float')
+        size.a = sizes
         vpen = digr.new_vertex_property('float')
         vpen.a = 0.2
         epen = digr.new_edge_property('float')
         epen.a = 0.5
         marker = digr.new_edge_property('float')
         marker.a = 2.5
-        graph_draw(digr,
-                   vertex_fill_color=digr.vp['color'],
-                   vertex_shape=digr.vp['shape'],
-                   # vertex_size=self.digr.vp['graph_size'],
+
+        view = GraphView(digr, vfilt=selected)
+        num_drawn = view.num_vertices()
+        logging.debug('Drawing %d of the %d vertices in the graph.' % (num_drawn, digr.num_vertices()))
+
+        kwargs = {}
+        if output is not None:
+            side = int(min(MAX_DRAW_SIZE, max(MIN_DRAW_SIZE, 40 * num_drawn ** 0.5)))
+            kwargs = dict(output=output, output_size=(side, side), fit_view=True)
+        else:
+            kwargs = dict(display_props=[digr.vp['filename_end'],
+                                         digr.vp['inode'],
+                                         digr.vp['dir_depth'],
+                                         digr.vp['gt_min_depth']])
+        graph_draw(view,
+                   vertex_fill_color=fill,
+                   vertex_shape=shape,
+                   vertex_size=size,
                    vertex_pen_width=vpen,
                    edge_pen_width=epen,
                    edge_marker_size=marker,
-                   display_props=[digr.vp['filename_end'],
-                                  digr.vp['inode'],
-                                  digr.vp['dir_depth'],
-                                  digr.vp['gt_min_depth']],
-                   )
+                   **kwargs)
+        if output is not None:
+            logging.info('Saved drawing of %d vertices to %s' % (num_drawn, output))
 
-    def add_from_file(self, file_path, img_file_id=1):
+    def add_from_file(self, file_path, img_file_id=1, background=False):
         """Create a graph from the given DFXML file.
 
         Given the path to a DFXML file, add nodes and edges to the digraph
@@ -211,243 +761,210 @@ class _GraphDiff(object):
         :param int img_file_id: ID number for the image file being processed.
             Used to identify file objects that are common or unique to each of
             the images.
+        :param bool background: When `True`, the DFXML file is parsed in a
+            separate thread while the graph is being built. See
+            :func:`common.util.prefetch`.
+        :rtype: None
+        """
+        logging.info('Beginning import from file: %s' % file_path)
+        records = iter_dfxml_records(file_path)
+        if background:
+            records = util.prefetch(records)
+        self.add_from_records(records, img_file_id)
+
+    def add_from_image(self, image_path, img_file_id=1, offset=0, background=False):
+        """Create a graph by reading the ext4 filesystem in a raw image.
+
+        This does the same as :meth:`add_from_file`, but reads the inodes and
+        directory entries of the ``home/.shadow`` subtree directly from the
+        image instead of from a DFXML file created by ``fiwalk``.
+
+        :param str image_path: Path to the raw image file, e.g. one created by
+            ``dd``.
+        :param int img_file_id: ID number for the image file being processed.
+            Used to identify file objects that are common or unique to each of
+            the images.
+        :param int offset: Byte offset of the filesystem in the image.
+        :param bool background: When `True`, the image is read in a separate
+            thread while the graph is being built. See
+            :func:`common.util.prefetch`.
+        :rtype: None
+        """
+        logging.info('Beginning import from image: %s' % image_path)
+        with Ext4Image(image_path, offset) as img:
+            records = img.iter_records()
+            if background:
+                records = util.prefetch(records)
+            # Stop reading before the image is closed, even if building the graph fails
+            with closing(records):
+                self.add_from_records(records, img_file_id)
+
+    def add_from_records(self, records, img_file_id=1):
+        """Create a graph from records describing the file objects of an image.
+
+        Each record is a dict with the keys produced by
+        :func:`iter_dfxml_records`. Records are processed as they're
+        generated, so the full list of file objects never needs to be in
+        memory at once.
+
+        :param records: Iterable of records, one per allocated and used file
+            object. Records for files outside of ``home/.shadow`` are ignored.
+        :param int img_file_id: ID number for the image file being processed.
+            Used to identify file objects that are common or unique to each of
+            the images.
         :rtype: None
         """
         # The DFXML version of this script uses attributes the other version doesn't use
         self.digr.init_extended_attrs()
 
-        logging.info('Beginning import from file: %s' % file_path)
-        xml_tree_root = etree.parse(file_path).getroot()
-        ns = '{http://www.forensicswiki.org/wiki/Category:Digital_Forensics_XML}'
-        logging.info('DFXML converted to element tree. Importing into the graph.')
-
         # Node info storage
         inode_paths = {}
-        duplicates = []
+        if img_file_id == 1 and self.dupl_file is not None and self._dupl_writer is None:
+            self._dupl_writer = DuplicateWriter(self.dupl_file, self.dupl_color)
         self.type_count = {0: 0, 1: 0, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0, 7: 0}
 
         edges_to_add = []
         num_skipped_files = 0
         num_duplicate_parent_dirs = 0
-        num_unallocated = 0
-        num_unused = 0
-
-        for vol in xml_tree_root.iterfind(ns + 'volume'):
-            for file_obj in vol.iterfind(ns + 'fileobject'):
-                file_obj = FileObj(file_obj, ns)
-
-                # Get the filename
-                try:
-                    filename = str(file_obj.findtext('filename'))
-                except AttributeError:
-                    filename = None
-                # else:
-                #     if filename.startswith('EFI-SYSTEM'):
-                #         raise SkipVolume
-
-                # Get allocation status
-                try:
-                    alloc = int(file_obj.findtext('alloc'))
-                except AttributeError:
-                    try:
-                        alloc = int(file_obj.findtext('unalloc'))
-                    except AttributeError:
-                        logging.critical('File object has neither an alloc or unalloc tag: %s' % filename)
-                        continue
-                    else:
-                        alloc = 1 - alloc
-                alloc = bool(alloc)
-                if not alloc:
-                    # TODO: Dr. Ahn wants these files to be included for some reason
-                    num_unallocated += 1
-                    continue
 
-                # Get used status
-                try:
-                    used = int(file_obj.findtext('used'))
-                except AttributeError:
-                    try:
-                        used = int(file_obj.findtext('unused'))
-                    except AttributeError:
-                        logging.critical('File object has neither a used or unused tag: %s' % filename)
-                        continue
-                    else:
-                        used = 1 - used
-                used = bool(used)
-                if not used:
-                    num_unused += 1
-                    continue
-
-                # TODO: Figure out what to do with any files that passed tests up to this point but don't have a name
-                if filename is None:
-                    filename = str(etree.tostring(file_obj.find('id')))
-                    print(filename)  # TODO: Remove this, replace with heuristics that determine if the vertex is worth keeping
-                    continue
+        for rec in records:
+            filename = rec['filename']
 
-                # Exclude all files that end in '/.' or '/..'
-                if re.search(self.ex_pat_dot, filename):
-                    continue
-
-                skip_add_edge = False
-                is_home = False
-                if re.search(self.in_pat_home, filename):
-                    # Include 'home' and 'home/.shadow' so that other file objects can create edges with them
-                    skip_add_edge = True
-                    is_home = True
-                elif re.search(self.in_pat_shadow, filename):
-                    pass
-                elif not re.search(self.ex_pat_shadow, filename):
-                    # Exclude all files that don't start with 'home/.shadow/'
-                    continue
+            # Exclude all files that end in '/.' or '/..'
+            if re.search(self.ex_pat_dot, filename):
+                continue
 
-                # Extract all pertinent information
-                inode_num = int(file_obj.findtext('inode'))
-                basename = path.basename(filename)
-                parent_obj = int(file_obj.find('parent_object').findtext(ns + 'inode'))
-                meta_type = int(file_obj.findtext('meta_type'))
-                self.type_count[meta_type] += 1
-                encrypted = bool(re.search(ENC_PAT, filename))
-                filename_id = sha256(filename.encode('utf-8')).hexdigest()
+            skip_add_edge = False
+            is_home = False
+            if re.search(self.in_pat_home, filename):
+                # Include 'home' and 'home/.shadow' so that other file objects can create edges with them
+                skip_add_edge = True
+                is_home = True
+            elif re.search(self.in_pat_shadow, filename):
+                pass
+            elif not re.search(self.ex_pat_shadow, filename):
+                # Exclude all files that don't start with 'home/.shadow/'
+                continue
 
-                # Coerce the parent object to be a directory if it isn't
-                try:
-                    if self.digr.vp['type'][parent_obj][0] != 2:
-                        self.digr.vp['type'][parent_obj][0] = 2
-                        logging.debug('Coerced inode %d to have file type 2 (dir)' % self.digr.vp['inode'][parent_obj])
-                except ValueError:
-                    # The listed parent inode must not exist in the graph
-                    pass
+            # Extract all pertinent information
+            inode_num = rec['inode']
+            basename = path.basename(filename)
+            parent_obj = rec['parent_inode']
+            meta_type = rec['meta_type']
+            self.type_count[meta_type] += 1
+            encrypted = bool(re.search(ENC_PAT, filename))
+            filename_id = sha256(filename.encode('utf-8')).hexdigest()
+
+            # Coerce the parent object to be a directory if it isn't
+            try:
+                if self.digr.vp['type'][parent_obj][0] != 2:
+                    self.digr.vp['type'][parent_obj][0] = 2
+                    logging.debug('Coerced inode %d to have file type 2 (dir)' % self.digr.vp['inode'][parent_obj])
+            except ValueError:
+                # The listed parent inode must not exist in the graph
+                pass
 
-                # Get depth from /home
-                dir_depth = get_dir_depth(filename)
-                # Files of interest to us should be in the .../vault/user/ dir and have a depth of at least 7
-                # (when we're filtering, that is)
-                gt_min_depth = bool(re.match(IN_PAT_VAULT, filename)) and dir_depth >= MIN_DEPTH
-
-                fs_offset = float('inf')
-                for fs in file_obj.iter_grandchild('byte_runs', 'byte_run'):
-                    # Get the lowest offset of the file
-                    _off = fs.get('fs_offset')
-                    if _off is None:
-                        continue
-                    else:
-                        _off = int(_off)
-
-                    if _off < fs_offset:
-                        fs_offset = _off
-                if fs_offset == float('inf'):
-                    fs_offset = '?'
-
-                filesize = '?'
-                try:
-                    # Try to use the DFXML-computed length first
-                    filesize = file_obj.findtext('filesize')
-                except AttributeError:
-                    # Iterate through the byte runs and sum their lengths
-                    _sum = 0
-                    for r in file_obj.iter_grandchild('byte_runs', 'byte_run'):
-                        _sum += int(r['len'])
-                    if _sum > 0:
-                        filesize = _sum
-
-                attrs = {"inode": inode_num,
-                         "parent_inode": parent_obj,
-                         # "filename": filename,
-                         "filename_id": filename_id,
-                         "filename_end": path.basename(filename[-13:]),
-                         "name_type": file_obj.findtext('name_type'),
-                         "type": (meta_type,),  # Needs to be hashable for Graphviz to not choke
-                         "alloc": alloc,
-                         "used": used,
-                         "fs_offset": str(fs_offset),
-                         "filesize": str(filesize),
-                         "src_files": (img_file_id,),  # Needs to be hashable for Graphviz to not choke
-                         "encrypted": encrypted,
-                         "eval": EVAL_NONE,  # Used for trimming the graph
-                         "dir_depth": dir_depth,
-                         "gt_min_depth": gt_min_depth,
-                         }
-
-                # Stubborn parameters
-                for k in ("size",
-                          "mode",
-                          "uid",
-                          "gid",
-                          "nlink",
-                          "mtime",
-                          "ctime",
-                          "atime",
-                          "crtime"):
+            # Get depth from /home
+            dir_depth = get_dir_depth(filename)
+            # Files of interest to us should be in the .../vault/user/ dir and have a depth of at least 7
+            # (when we're filtering, that is)
+            gt_min_depth = bool(re.match(IN_PAT_VAULT, filename)) and dir_depth >= MIN_DEPTH
+
+            attrs = {"inode": inode_num,
+                     "parent_inode": parent_obj,
+                     # "filename": filename,
+                     "filename_id": filename_id,
+                     "filename_end": path.basename(filename[-13:]),
+                     "name_type": rec['name_type'],
+                     "type": (meta_type,),  # Needs to be hashable for Graphviz to not choke
+                     "alloc": rec['alloc'],
+                     "used": rec['used'],
+                     "fs_offset": str(rec['fs_offset']),
+                     "filesize": str(rec['filesize']),
+                     "encrypted": encrypted,
+                     "eval": EVAL_NONE,  # Used for trimming the graph
+                     "dir_depth": dir_depth,
+                     "gt_min_depth": gt_min_depth,
+                     }
+
+            # Stubborn parameters
+            for k in ("size",
+                      "mode",
+                      "uid",
+                      "gid",
+                      "nlink",
+                      "mtime",
+                      "ctime",
+                      "atime",
+                      "crtime"):
+                attrs[k] = rec.get(k, '?')
+
+            # Store information about the node
+            try:
+                _id = attrs[self._id]
+            except KeyError:
+                _id = basename
+
+            # Record that the file object is part of this image, along with a signature to detect changes
+            signature = hash(tuple(attrs[k] for k in ('type', 'filesize', 'size', 'mode', 'uid', 'gid', 'nlink',
+                                                      'mtime', 'ctime', 'crtime')))
+            attrs['member_row'] = self.membership.add(_id, img_file_id, signature)
+
+            if inode_num in inode_paths and inode_paths[inode_num] != _id:
+                num_duplicate_parent_dirs += 1
+                dup_ver = self.gi[inode_paths[inode_num]]
+                # If the depth of the new vertex is lower (closer to /home), replace the old one
+                if attrs['dir_depth'] < self.digr.vp['dir_depth'][dup_ver]:
+                    # Mark the duplicate vertex for removal later
+                    # vertices_to_remove.append(dup_ver)
+                    # Remove the edge from the "to add" list of the old vertex
                     try:
-                        attrs[k] = file_obj.findtext(k)
-                    except AttributeError:
-                        attrs[k] = '?'
+                        edges_to_add.remove((self.digr.vp['parent_inode'][dup_ver], int(dup_ver)))
+                    except ValueError:
+                        # There was no matching entry in the "to add" list
+                        pass
+                        # edges_to_remove.append((self.digr.vp['parent_inode'][dup_ver], int(dup_ver)))
+                        # print('%s was not in the list of edges to add' % ((self.digr.vp['parent_inode'][dup_ver], int(dup_ver)),))
+                    edges_to_add.append((parent_obj, int(dup_ver)))
+                    for a in attrs:
+                        if a == 'type':
+                            self.digr.vp[a][dup_ver] = (attrs[a])
+                        else:
+                            self.digr.vp[a][dup_ver] = attrs[a]
+                    inode_paths[inode_num] = _id
+                    self.gi[_id] = dup_ver
+                    continue
 
-                # Store information about the node
-                try:
-                    _id = attrs[self._id]
-                except KeyError:
-                    _id = basename
-
-                if inode_num in inode_paths and inode_paths[inode_num] != _id:
-                    num_duplicate_parent_dirs += 1
-                    dup_ver = self.gi[inode_paths[inode_num]]
-                    # If the depth of the new vertex is lower (closer to /home), replace the old one
-                    if attrs['dir_depth'] < self.digr.vp['dir_depth'][dup_ver]:
-                        # Mark the duplicate vertex for removal later
-                        # vertices_to_remove.append(dup_ver)
-                        # Remove the edge from the "to add" list of the old vertex
-                        try:
-                            edges_to_add.remove((self.digr.vp['parent_inode'][dup_ver], int(dup_ver)))
-                        except ValueError:
-                            # There was no matching entry in the "to add" list
-                            pass
-                            # edges_to_remove.append((self.digr.vp['parent_inode'][dup_ver], int(dup_ver)))
-                            # print('%s was not in the list of edges to add' % ((self.digr.vp['parent_inode'][dup_ver], int(dup_ver)),))
-                        edges_to_add.append((parent_obj, int(dup_ver)))
-                        for a in attrs:
-                            if a in ('type', 'src_files'):
-                                self.digr.vp[a][dup_ver] = (attrs[a])
-                            else:
-                                self.digr.vp[a][dup_ver] = attrs[a]
-                        inode_paths[inode_num] = _id
-                        self.gi[_id] = dup_ver
-                        continue
+            else:
+                inode_paths[inode_num] = _id
+
+            # Make sure we don't try to double-add a node in the digraph
+            if _id in self.gi.keys():
+                num_skipped_files += 1
+                dup_ver = self.gi[_id]
+                self.digr.vp["type"][dup_ver].append(meta_type)
+                if img_file_id == 1 and self._dupl_writer is not None:
+                    # Save information on the duplicates, reading the original's values from the graph
+                    self._dupl_writer.add(VertexAttrs(self.digr, dup_ver), attrs)
+                continue
 
+            # Add node and edge to the graph
+            vertex = self.digr.add_vertex()
+            self.gi[_id] = vertex
+            for a in attrs:
+                if a == 'type':
+                    self.digr.vp[a][vertex] = (attrs[a],)
                 else:
-                    inode_paths[inode_num] = _id
+                    self.digr.vp[a][vertex] = attrs[a]
 
-                # Make sure we don't try to double-add a node in the digraph
-                if _id in self.gi.keys():
-                    num_skipped_files += 1
-                    dup_ver = self.gi[_id]
-                    self.digr.vp["type"][dup_ver].append(meta_type)
-                    if img_file_id not in self.digr.vp["src_files"][dup_ver]:
-                        self.digr.vp["src_files"][dup_ver].append(img_file_id)
-                    if img_file_id == 1:
-                        # Save information on the duplicates for printing later
-                        duplicates.append((_id, attrs))
-                    continue
-
-                # Add node and edge to the graph
-                vertex = self.digr.add_vertex()
-                self.gi[_id] = vertex
-                for a in attrs:
-                    if a in ('type', 'src_files'):
-                        self.digr.vp[a][vertex] = (attrs[a],)
-                    else:
-                        self.digr.vp[a][vertex] = attrs[a]
-
-                if is_home:
-                    self.home_vertex = vertex
-                    self.digr.vp['color'][vertex] = [0, 0.8, 0, 0.9]
-                if not skip_add_edge:
-                    edges_to_add.append((parent_obj, int(vertex)))
+            if is_home:
+                self.home_vertex = vertex
+                self.digr.vp['color'][vertex] = [0, 0.8, 0, 0.9]
+            if not skip_add_edge:
+                edges_to_add.append((parent_obj, int(vertex)))
 
         logging.info("Done importing.")
         logging.debug("Number of skipped (duplicate) files: %d" % num_skipped_files)
-        logging.debug("Number of unallocated files: %d" % num_unallocated)
-        logging.debug("Number of allocated but unused files: %d" % num_unused)
         logging.debug("Number of duplicate parent directory entries: %d" % num_duplicate_parent_dirs)
         logging.debug("File count by type: %s" % self.type_count)
         type_sum = 0
@@ -455,8 +972,8 @@ class _GraphDiff(object):
             type_sum += self.type_count[i]
         logging.info("Total imported file objects: %d" % type_sum)
 
-        if img_file_id == 1 and self.dupl_file is not None:
-            self._save_duplicate_info(duplicates)
+        if self._dupl_writer is not None:
+            self._dupl_writer.flush()
 
         for u, v in edges_to_add:
             if INODE_ONLY:
@@ -489,92 +1006,15 @@ class _GraphDiff(object):
         for v in self.digr.vertices():
             self.digr.vp['keeper'][v] = True
 
-    def _save_duplicate_info(self, duplicates):
-        """
-        Create a file containing information about the duplicates in the DFXML
-        that was processes. Output file's path should have been passed to the
-        class constructor on instantiation.
-
-        :param duplicates: List of 2-tuples: (original vertex index, attribute
-            dict of the duplicate)
-        :type duplicates: list
-        :return: None
-        :rtype: None
-        """
-        # It's probably too late to call this, but it marks this function as using the extended attributes
-        self.digr.init_extended_attrs()
-
-        dstring = ' '
-        d_fields = (('inode', '6'), ('parent_inode', '6'), ('name_type', '2'), ('type', '2'), ('alloc', '2'),
-                    ('used', '2'), ('mode', '5'), ('nlink', '3'), ('uid', '5'), ('gid', '5'), ('fs_offset', '12'),
-                    ('filesize', '8'), ('mtime', '20'), ('ctime', '20'), ('atime', '20'), ('crtime', '20'),
-                    ('filename_id', '18'), ('filename_end', '13'))
-        for k, n in d_fields:
-            dstring += '% ' + n + 's|'
-        header = dstring % ("inode", "pinode", "nt", "ty", "al", "ud", "mode", "nlk", "uid", "gid", "Start",
-                            "Length", "Modified Time", "inode Changed Time", "Accessed Time", "Created Time",
-                            "Filename Hash Tail", "Filename Tail")
-        break_str = clr.green(('--   ' * ((len(header) / 5) + 1))[:len(header)], False)
-        header = clr.yellow(clr.black(header, False)) + '\n'
-        line_count = 0
-
-        with open(self.dupl_file, 'w') as dout:
-            dout.write("\nDuplicates:"),
-            for x, y in duplicates:
-                dout.write('\n')
-                if not line_count % 10:
-                    dout.write(header)
-                line_count += 1
-
-                x_fields = []
-                y_fields = []
-                for k, n in d_fields:
-                    if k == 'filename_id':
-                        # Display only the last n characters of the hash
-                        xf = self.digr.vp[k][self.gi[x]][0-int(n):]
-                        yf = y[k][0-int(n):]
-                    else:
-                        xf = self.digr.vp[k][self.gi[x]]
-                        yf = y[k]
-                        if k == 'type':
-                            if len(xf) > 2:
-                                xf = '!' + str(xf[0])
-                            elif len(xf) == 2:
-                                xf = str(xf[0]) + str(xf[1])
-                            else:
-                                xf = xf[0]
-
-                            if len(yf) > 2:
-                                yf = '!' + str(yf[0])
-                            elif len(yf) == 2:
-                                yf = str(yf[0]) + str(yf[1])
-                            else:
-                                yf = yf[0]
-
-                    if xf == '?':
-                        xf = clr.cyan(('% ' + n + 's') % '?', False)
-
-                    x_fields.append(xf)
-
-                    if xf == yf:
-                        y_fields.append(yf)
-                    else:
-                        if y[k] == '?':
-                            y_fields.append(clr.blue(' ' * (int(n) - 1) + clr.cyan('?', False)))
-                        else:
-                            y_fields.append(clr.blue(('% ' + n + 's') % yf))
-
-                dout.write(dstring % tuple(x_fields) + '\n')
-                dout.write(dstring % tuple(y_fields) + '\n')
-                dout.write(break_str)
-            dout.write('\n\n')
-        raise DuplicatesCompleted
-
     def trim_unuseful(self, filter_depth=False):
         """Remove unuseful vertices from the graph.
 
-        This is the entry point to the recursive method _check_eval() that
-        starts the process with all the child vertices of "home".
+        This is the entry point to the :meth:`_check_eval` method that starts
+        the process with all the child vertices of "home". The parent/child
+        arrays and the directory mask are built once and shared by every call.
+        The minimum depth and orphan filters are then applied to all vertices
+        at once as boolean array operations, and the graph is purged a single
+        time.
 
         :param filter_depth: If True, all nodes with a depth < MIN_DEPTH will
             also be removed from the graph.
@@ -588,104 +1028,111 @@ class _GraphDiff(object):
         self._filter_depth = filter_depth
 
         deg_before = self.digr.num_vertices()
-        trim_stats = {'min_depth': 0,
-                      'no_parent': 0}
+
+        offsets, children, parents = get_child_arrays(self.digr)
+        is_dir = vertex_type_array(self.digr) == FType.dir
 
         for n in self.home_vertex.out_neighbours():
             # This should only have one item (.shadow), but just in case...
-            self._check_eval(n)
+            self._check_eval(n, offsets, children, parents, is_dir)
 
-        # This isn't very efficient, but we need to remove all vertices with no in-neighbors
-        for v in self.digr.vertices():
-            # if v in self._to_remove:
-            if not self.digr.vp['keeper'][v]:
-                continue
-            if filter_depth and not self.digr.vp['gt_min_depth'][v]:
-                self.digr.vp['keeper'][v] = False
-                self._to_remove.append(v)
-                trim_stats['min_depth'] += 1
-            elif v == self.home_vertex:
-                continue
-            elif not v.in_degree() and not v.out_degree():
-                self.digr.vp['keeper'][v] = False
-                self._to_remove.append(v)
-                trim_stats['no_parent'] += 1
-        # print(self.home_vertex in self._to_remove)
+        num_v = len(parents)
+        out_deg = np.diff(offsets)
+        in_deg = np.bincount(children, minlength=num_v)
+        keeper = self.digr.vp['keeper'].a.astype(bool)
 
-        # for v in self._to_remove:
-        #     self.digr.vp['color'][v] = [0, 0, 0, 0.8]
-        #     self.digr.vp['keeper'][v] = False
+        below_min = np.zeros(num_v, dtype=bool)
+        if filter_depth:
+            below_min = keeper & ~self.digr.vp['gt_min_depth'].a.astype(bool)
+            keeper &= ~below_min
+
+        no_parent = keeper & (in_deg == 0) & (out_deg == 0)
+        no_parent[int(self.home_vertex)] = False
+        keeper &= ~no_parent
 
         if filter_depth:
-            # Using an actual filter is faster, but I couldn't get the stupid thing to work right.
-            self.digr.clear_filters()  # Clear any previously set vertex filters
-            # self.digr.set_vertex_filter(self.digr.vp['gt_min_depth'])
-            self.digr.set_vertex_filter(self.digr.vp['keeper'])
-            self.digr.purge_vertices()
+            # Get the straggler vertices, i.e. those whose neighbors are all about to be removed
+            sources = np.repeat(np.arange(num_v), out_deg)
+            live = keeper[sources] & keeper[children]
+            live_deg = np.bincount(sources[live], minlength=num_v) + np.bincount(children[live], minlength=num_v)
+            keeper &= live_deg > 0
+
+        self.digr.vp['keeper'].a = keeper
 
-            # Get the straggler vertices
-            for v in self.digr.vertices():
-                if not v.in_degree() and not v.out_degree():
-                    self.digr.vp['keeper'][v] = False
+        if filter_depth:
+            self.digr.clear_filters()  # Clear any previously set vertex filters
             self.digr.set_vertex_filter(self.digr.vp['keeper'])
             self.digr.purge_vertices()
-            # self.digr.clear_filters()  # Clear any previously set vertex filters
 
             logging.debug('Graph now has %s objects' % self.digr.num_vertices())
 
         deg_diff = deg_before - self.digr.num_vertices()
 
         logging.info('Finished trimming %d unuseful nodes from the graph.' % deg_diff)
-        logging.debug('Below min depth:  %d    No parent node:  %d' % (trim_stats['min_depth'], trim_stats['no_parent']))
+        logging.debug('Below min depth:  %d    No parent node:  %d' % (below_min.sum(), no_parent.sum()))
 
-    def _check_eval(self, vertex):
+    def _check_eval(self, vertex, offsets, children, parents, is_dir):
         raise NotImplementedError
 
 
 class ColorDiff(_GraphDiff):
 
-    def __init__(self, dupl_file=None):
-        super().__init__(dupl_file=dupl_file)
+    def __init__(self, dupl_file=None, dupl_color=True):
+        super().__init__(dupl_file=dupl_file, dupl_color=dupl_color)
         logging.info('DFXML ' + clr.black(clr.red('C', False) +
                                           clr.green('O', False) +
                                           clr.magenta('L', False) +
                                           clr.yellow('O', False) +
                                           clr.cyan('R', False)) + ' Diff initialized.')
 
-    def _check_eval(self, vertex):
+    def _check_eval(self, vertex, offsets, children, parents, is_dir):
         """
-        Recursively search successor vertices, evaluating their usefulness. A
-        vertex is useful if:
+        Search successor vertices, evaluating their usefulness. A vertex is
+        useful if:
 
         1. Any of its children are useful, or
-        2. It was listed in fewer than the max number of files (it changed at
-           some point)
+        2. It was listed in fewer than the number of images ingested (it
+           changed at some point)
 
-        :param vertex: The vertex object to evaluate.
+        The children of a vertex that is useful by itself are not evaluated.
+
+        :param vertex: The vertex object at the top of the subtree.
         :type vertex: Vertex
+        :param offsets: Child offsets from :func:`~common.graph.get_child_arrays`.
+        :type offsets: numpy.ndarray
+        :param children: Children from :func:`~common.graph.get_child_arrays`.
+        :type children: numpy.ndarray
+        :param parents: Parents from :func:`~common.graph.get_child_arrays`.
+        :type parents: numpy.ndarray
+        :param is_dir: Whether each vertex is a directory. Not used here.
+        :type is_dir: numpy.ndarray
         :return: True (useful, keep) or False (not useful, delete)
         :rtype: bool
         """
-        # Check if this node has already been evaluated
-        if self.digr.vp["eval"][vertex] != EVAL_NONE:
-            # logging.debug('Skipping eval of node: %s' % self.digr.vp[self._id][vertex])
-            return self.digr.vp["eval"][vertex]
-
-        # If this node is useful by itself, no need to check its children
-        if len(self.digr.vp["src_files"][vertex]) < MAX_FILES:
-            # logging.debug('Skipping eval of child nodes of node: %s' % self.digr.vp[self._id][vertex])
-            self.digr.vp["eval"][vertex] = EVAL_TRUE
-            return True
+        levels = get_bfs_levels(offsets, children, [int(vertex)])
+        num_v = len(parents)
+        changed = self.membership.counts(self.vertex_rows()) < self.membership.num_images
 
-        any_children_true = False
-        for c in vertex.out_neighbours():
-            _e = self._check_eval(c)
-            if not _e:
-                self._to_remove.append(c)
-            any_children_true = any_children_true or _e
+        # A vertex is only evaluated if none of its predecessors in the subtree were useful by themselves
+        evaluated = np.zeros(num_v, dtype=bool)
+        evaluated[levels[0]] = True
+        for lvl in levels[1:]:
+            evaluated[lvl] = evaluated[parents[lvl]] & ~changed[parents[lvl]]
 
-        self.digr.vp["eval"][vertex] = any_children_true
-        return any_children_true
+        useful = np.zeros(num_v, dtype=bool)
+        any_children_true = np.zeros(num_v, dtype=bool)
+        for i, lvl in reversed(list(enumerate(levels))):
+            useful[lvl] = changed[lvl] | any_children_true[lvl]
+            if i:
+                any_children_true[parents[lvl[useful[lvl]]]] = True
+
+        subtree = np.concatenate(levels)
+        subtree = subtree[evaluated[subtree]]
+        successors = subtree[1:]
+        self._to_remove.extend(successors[~useful[successors]].tolist())
+        self.digr.vp['eval'].a[subtree] = useful[subtree]
+
+        return bool(useful[int(vertex)])
 
 
 class FilesDiff(_GraphDiff):
@@ -695,8 +1142,8 @@ class FilesDiff(_GraphDiff):
         super().__init__()
         logging.info('DFXML Files Diff initialized.')
 
-    def _check_eval(self, vertex, force_false=False):
-        """Recursively search successor vertices, evaluating their usefulness.
+    def _check_eval(self, vertex, offsets, children, parents, is_dir):
+        """Evaluate the usefulness of a vertex and all of its successors.
 
         A vertex is useful if:
 
@@ -710,85 +1157,89 @@ class FilesDiff(_GraphDiff):
               ``<Extension ID>`` directory and has only non-empty directory
               successors
 
-        When this recursive method is followed directly by another pass over
-        the vertices to remove all that are not of minimum depth, the
-        subgraphs that remain are prime candidates for extension directories.
-
-        :param Vertex vertex: The vertex object to evaluate.
-        :param bool force_false: Useful for when a vertex is found that
-            violates a required condition, mark all successor vertices to the
-            given vertex for deletion.
+        A vertex that violates one of the required conditions is marked for
+        deletion, and all of its successors are marked as not useful.
+
+        When this method is followed directly by another pass over the
+        vertices to remove all that are not of minimum depth, the subgraphs
+        that remain are prime candidates for extension directories.
+
+        Rather than recursing, the subtree is split into levels (see
+        :func:`~common.graph.get_bfs_levels`). The violations are pushed down
+        the levels first, then the usefulness of each level is computed from
+        the one below it, so no vertex is visited more than twice and the
+        depth of the tree has no effect on the call stack.
+
+        :param Vertex vertex: The vertex object at the top of the subtree.
+        :param numpy.ndarray offsets: Child offsets from
+            :func:`~common.graph.get_child_arrays`.
+        :param numpy.ndarray children: Children from
+            :func:`~common.graph.get_child_arrays`.
+        :param numpy.ndarray parents: Parents from
+            :func:`~common.graph.get_child_arrays`.
+        :param numpy.ndarray is_dir: Whether each vertex is a directory, by
+            its first file type.
         :return: `True` (useful, keep) or `False` (not useful, delete)
         :rtype: bool
         """
         # It's probably too late to call this, but it marks this function as using the extended attributes
         self.digr.init_extended_attrs()
 
-        # Check if this node has already been evaluated
-        if self.digr.vp["eval"][vertex] != EVAL_NONE:
-            # logging.debug('Skipping eval of node: %s' % self.digr.vp[self._id][vertex])
-            return self.digr.vp["eval"][vertex]
-
-        if force_false:
-            return self._force_false(vertex)
-
-        # If this is at the same depth as the Extensions dir, it should be an encrypted directory
-        if self.digr.vp['dir_depth'][vertex] == (FILTERED_MIN_DEPTH - 2) and \
-                (not vertex_is_dir(vertex, self.digr) or not self.digr.vp['encrypted'][vertex]):
-            self.check_warn_removal(vertex, 'not an encrypted dir at Extensions dir level')
-            return self._force_false(vertex)
-
-        # If this is at the same depth as the Extensions dir, it should have only dir children and grandchildren
-        if self.digr.vp['dir_depth'][vertex] == FILTERED_MIN_DEPTH - 2:
-            self.digr.vp['color'][vertex] = [0.8, 0.8, 0, 0.9]
-            all_dir_children = vertex.out_degree() > 0
-            for c in vertex.out_neighbours():  # Check children
-                # break
-                if not vertex_is_dir(c, self.digr):
-                    all_dir_children = False
-                    self.check_warn_removal(vertex, 'non-dir child vertex at Extension dir level')
-                    break
-
-                for gc in c.out_neighbours():  # Check grandchildren
-                    depth_differs_by_two = (self.digr.vp['dir_depth'][gc] - self.digr.vp['dir_depth'][vertex]) == 2
-                    if not depth_differs_by_two:
-                        self._force_false(gc)
-                        continue
-
-                if not all_dir_children:
-                    break
-            if not all_dir_children:
-                return self._force_false(vertex)
-
-        # If this is at the same depth as the Extension ID dir, it should have only dir children
-        if self.digr.vp['dir_depth'][vertex] == FILTERED_MIN_DEPTH - 1:
-            all_dir_children = vertex.out_degree() > 0
-            for c in vertex.out_neighbours():
-                if not vertex_is_dir(c, self.digr):
-                    all_dir_children = False
-                    break
-            if not all_dir_children:
-                return self._force_false(vertex)
-
-        any_children_true = vertex.out_degree() == 0  # Leaf nodes should be True by default, others False
-        for c in vertex.out_neighbours():
-            _e = self._check_eval(c)
-            if not _e:
-                self._to_remove.append(c)
-                self.digr.vp['keeper'][c] = False
-            any_children_true = any_children_true or _e
-
-        self.digr.vp["eval"][vertex] = any_children_true
-        if self._filter_depth:
-            any_children_true = any_children_true and self.digr.vp['dir_depth'][vertex] >= MIN_DEPTH
-        return any_children_true
-
-    def _force_false(self, vertex):
-        self.digr.vp['eval'][vertex] = EVAL_FALSE
-        self._to_remove += list(vertex.out_neighbours())
-        for c in vertex.out_neighbours():
-            self._check_eval(c, force_false=True)
-        return False
+        levels = get_bfs_levels(offsets, children, [int(vertex)])
+        num_v = len(parents)
+        ext_depth = FILTERED_MIN_DEPTH - 2
+        ext_id_depth = FILTERED_MIN_DEPTH - 1
+
+        depth = self.digr.vp['dir_depth'].a.astype(np.int64)
+        encrypted = self.digr.vp['encrypted'].a.astype(bool)
+        out_deg = np.diff(offsets)
+        has_parent = parents >= 0
+
+        # At the depth of the Extensions or Extension ID dirs, vertices should have only (and at least one) dir children
+        non_dir_children = np.bincount(parents[has_parent & ~is_dir], minlength=num_v)
+        bad_children = (out_deg == 0) | (non_dir_children > 0)
+        violation = (depth == ext_depth) & (~is_dir | ~encrypted | bad_children)
+        violation |= (depth == ext_id_depth) & bad_children
+
+        # Grandchildren of the Extensions dir should be exactly two levels below it
+        grandparents = np.where(has_parent, parents[parents], -1)
+        has_gp = has_parent & (grandparents >= 0)
+        gp = grandparents[has_gp]
+        violation[has_gp] |= (depth[gp] == ext_depth) & (depth[has_gp] - depth[gp] != 2)
+
+        if KNOWN_EXT_DIR is not None:
+            inodes = self.digr.vp['inode'].a
+            for v in np.flatnonzero(violation & (inodes == KNOWN_EXT_DIR)):
+                self.check_warn_removal(self.digr.vertex(v), 'violates the Extensions dir level requirements')
+
+        # Violations are inherited by all successors
+        forced_false = violation
+        for lvl in levels[1:]:
+            forced_false[lvl] |= forced_false[parents[lvl]]
+
+        useful = np.zeros(num_v, dtype=bool)
+        keep = np.zeros(num_v, dtype=bool)
+        any_children_true = np.zeros(num_v, dtype=bool)
+        for i, lvl in reversed(list(enumerate(levels))):
+            # Leaf nodes should be True by default, others only if they have a useful child
+            useful[lvl] = ~forced_false[lvl] & ((out_deg[lvl] == 0) | any_children_true[lvl])
+            keep[lvl] = useful[lvl]
+            if self._filter_depth:
+                keep[lvl] &= depth[lvl] >= MIN_DEPTH
+            if i:
+                any_children_true[parents[lvl[keep[lvl]]]] = True
+
+        # Only vertices whose parent evaluated its children are removed. The successors of a violating vertex are
+        # just marked as not useful.
+        subtree = np.concatenate(levels)
+        successors = subtree[1:]
+        self.digr.vp['eval'].a[subtree] = useful[subtree]
+        self.digr.vp['keeper'].a[successors[~keep[successors] & ~forced_false[parents[successors]]]] = False
+
+        for v in subtree[depth[subtree] == ext_depth]:
+            self.digr.vp['color'][self.digr.vertex(v)] = [0.8, 0.8, 0, 0.9]
+
+        return bool(keep[int(vertex)])
 
     def check_warn_removal(self, vertex, msg, v_prop='inode', warn_list=(KNOWN_EXT_DIR,)):
         if self.digr.vp[v_prop][vertex] in warn_list or not len(warn_list):
@@ -818,6 +1269,20 @@ def vertex_is_dir(vertex, graph, strict=False):
     return False
 
 
+def vertex_type_array(graph):
+    """Return the (first) file type of each vertex in the graph.
+
+    :param graph: The graph whose vertex types should be returned.
+    :type graph: common.graph.DblingGraph
+    :return: Integer array indexed by vertex index. Vertices with no type
+        have the value of :attr:`FType.unk`.
+    :rtype: numpy.ndarray
+    """
+    # Ungrouping pads the vectors that are too short with zeros (FType.unk), so leave the graph's own vectors alone
+    first, = ungroup_vector_property(graph.vp['type'].copy(), [0])
+    return first.a.astype(np.int64)
+
+
 #: A dummy path that makes it easier to calculate the minimum depth we should
 #: look for without making errors.
 FILTERED_MIN_DEPTH = get_dir_depth('/home/.shadow/<user ID>/vault/user/<encrypted Extensions>/'
@@ -852,9 +1317,11 @@ def init_logging(log_file=None, verbose=False):
 
 def main(args):
     # Set min depth
-    global MIN_DEPTH
+    global MIN_DEPTH, MAX_FILES
     if args['-d']:
         MIN_DEPTH = FILTERED_MIN_DEPTH
+    if args['-n'] is not None:
+        MAX_FILES = int(args['-n'])
 
     try:
         img_dir = os.environ['DBLING_IMGS']
@@ -872,7 +1339,7 @@ def main(args):
     init_logging(verbose=args['-v'])
 
     # Instantiate the diff object and process the files
-    diff = ColorDiff(dupl_file=args['-f'])
+    diff = ColorDiff(dupl_file=args['-f'], dupl_color=not args['--no-color'])
     for i in imgs:
         i_pth = path.join(img_dir, i)
         # For info on what this does and what it means, see:
@@ -889,23 +1356,23 @@ def main(args):
             continue
 
         to_compare.append(path.join(img_dir, i))
-        if len(to_compare) == MAX_FILES:
+        if MAX_FILES is not None and len(to_compare) == MAX_FILES:
             break
 
     to_compare.sort()
     for i, n in zip(to_compare, range(len(to_compare))):
         try:
             diff.add_from_file(i, n+1)
-        except DuplicatesCompleted:
-            diff.deinit(False, dup=True)
-            return
         except Exception:
             diff.deinit(False)
             raise
 
     try:
+        diff.log_image_diffs()
         diff.trim_unuseful(filter_depth=args['-d'])
-        diff.show_graph()
+        diff.show_graph(output=args['-g'],
+                        top_n=None if args['-t'] is None else int(args['-t']),
+                        max_children=None if args['-c'] is None else int(args['-c']))
     except Exception:
         diff.deinit(False)
         raise
@@ -917,4 +1384,3 @@ else:
     # This file was imported, so do all the necessary configuration
     # crx_crawler.MIN_DEPTH = FILTERED_MIN_DEPTH
     MIN_DEPTH = FILTERED_MIN_DEPTH
-    MAX_FILES = 1
@@ -6,13 +6,51 @@ Command line::
 
  Usage: profile.py [options] -d DFXML_FILE
         profile.py [options] -m MOUNT_POINT
+        profile.py [options] -i IMAGE
+        profile.py [options] -b OUT_DIR INPUT...
 
  Options:
   -v   Verbose mode. Changes logging mode from INFO to DEBUG.
   -g   Show graph before searching for matches.
+  -G FILE   Save a drawing of the graph to FILE (e.g. graph.svg or graph.png)
+            instead of showing it in a window.
   -o MERL   Output results to the file MERL.
   --plain   Output results in a plain format instead of XML.
-
+  -s SNAPSHOT  Match candidates against the centroid SNAPSHOT file instead
+               of the database. Snapshots are created with:
+               python3 -m merl.snapshot SNAPSHOT
+  -w N      Also match candidates with centroid families that have up to N
+            more or fewer files, with a lower confidence. [default: 0]
+  --rusage  Add the resource usage of the run to the end of the MERL file.
+  --pipeline  Overlap the stages of profiling: the input is read in a
+              separate thread while the graph is built, and candidates are
+              matched by a pool of threads as they are extracted, with their
+              matches written as soon as they're ready.
+  -j N      Number of threads that match candidates in pipeline mode.
+            [default: 4]
+  -p N      Number of processes that compare candidates with the centroid
+            families, which are loaded once into shared memory. By default,
+            candidates are compared in the main process.
+  -b OUT_DIR  Batch mode. Profile every INPUT, saving the results for each
+              one to its own file in OUT_DIR.
+  -P N      Number of inputs profiled at once in batch mode. [default: 2]
+
+
+An IMAGE is a raw (e.g. ``dd``) image of an ext4 filesystem, which is read
+directly, without needing to be mounted or converted to DFXML first.
+
+In batch mode, each INPUT can be a DFXML file (ending in ``.xml``), a raw
+image, a mount point (a directory with a ``home`` directory in it), or a
+directory of DFXML files. The centroid index is loaded once and shared by all
+of the inputs, so batches of many images don't pay for connecting to the DB
+and loading the centroids for each image. So are the processes started with
+-p, and their shared copy of the centroids.
+
+A JSON report of the time spent in each phase of profiling, the peak memory
+usage, the number of vertices and candidates, and the number and latency of
+DB queries is saved next to each output file, with ``.report.json`` added to
+its name. In batch mode, ``batch.report.json`` in OUT_DIR covers the whole
+batch.
 
 As a reminder, the command to mount an image is::
 
@@ -20,29 +58,39 @@ As a reminder, the command to mount an image is::
 """
 import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from os import geteuid, seteuid
-from os.path import abspath, dirname, join
+from os import geteuid, seteuid, listdir, makedirs
+from os.path import abspath, basename, dirname, isdir, join, splitext
 
+import numpy as np
 from docopt import docopt
-from graph_tool.topology import shortest_distance
 
 try:
-    from merl import Merl
+    from merl import Merl, open_index
 except ImportError:
     sys.path.append(join(dirname(abspath(__file__)), '..'))
-    from merl import Merl
+    from merl import Merl, open_index
+from common.centroid import DB_META
+from common.graph import DblingGraph, GraphView, label_components
+from common.instrument import RunReport, REPORT_EXT, phase
+from merl.parallel import ParallelScorer
 from profiler.graph_diff import FilesDiff, init_logging
 
-
-MAX_DIST = 2**31 - 1  # 2147483647  # Assumes the distance PropertyMap will be of type int32
+#: The kinds of inputs that can be profiled
+DFXML = 'dfxml'
+MOUNT = 'mount'
+IMAGE = 'image'
+#: Extension of the DFXML files that are profiled from a directory in batch mode
+DFXML_EXT = '.xml'
 
 
-def go(start, mounted=False, verbose=False, show_graph=False, output_file=None, plain=False):
+def go(start, mounted=False, verbose=False, show_graph=False, output_file=None, plain=False, graph_file=None,
+       image=False, snapshot=None, pipeline=False, workers=4, ttl_window=0, rusage=False, processes=None):
     """Initiate the test.
 
-    :param str start: Either the path to the mount point of the image or the
-        path to the DFXML file of the image.
+    :param str start: Either the path to the mount point of the image, the
+        path to the DFXML file of the image, or the path to the raw image.
     :param bool mounted: Flag indicating if ``start`` is mounted, which is
         triggered when the ``-m`` option is given. Flag is `False` when the
         ``-d`` option is given.
@@ -53,48 +101,58 @@ def go(start, mounted=False, verbose=False, show_graph=False, output_file=None,
     :param str output_file: Path to a file where the results are saved.
     :param bool plain: When set (using the ``--plain`` option), the results
         saved to ``output_file`` will not be in a MERL (XML) format.
+    :param str graph_file: Path to a file where a drawing of the graph is
+        saved, without opening a window. Set with the ``-G`` option.
+    :param bool image: Flag indicating if ``start`` is a raw ext4 image,
+        which is triggered when the ``-i`` option is given.
+    :param str snapshot: Path to a centroid snapshot file to use instead of
+        the database. Set with the ``-s`` option.
+    :param bool pipeline: When set (using the ``--pipeline`` option), the
+        input is parsed in the background while the graph is built, and
+        candidates are matched by ``workers`` threads as they are extracted
+        instead of after all of them have been extracted.
+    :param int workers: Number of threads that match candidates in pipeline
+        mode. Set with the ``-j`` option.
+    :param int ttl_window: Also match candidates with the centroid families
+        that have up to this many more or fewer files. Set with the ``-w``
+        option.
+    :param bool rusage: Add the resource usage of the run to the end of the
+        MERL. Set with the ``--rusage`` option.
+    :param int processes: Number of processes that compare candidates with
+        the centroid families. Set with the ``-p`` option.
     :rtype: None
     """
     init_logging(verbose=verbose)
+    report = RunReport(start)
+    if snapshot is None:
+        report.watch_db(DB_META.bind)
     file_needs_closing = False
     if plain and output_file is None:
         output_file = 'profile_{}.{}'.format(datetime.now().strftime('%Y-%m-%d_%H-%M-%S'),
                                              'txt' if plain else 'merl')
         print('No output file specified for {} format. Saving to {}'.
               format('plain' if plain else 'MERL', output_file))
-        output_file = open(output_file)
+        output_file = open(output_file, 'w')
         file_needs_closing = True
-    merl = Merl(out_fp=output_file, plain_output=plain)
-    graph = FilesDiff()
-    if mounted:
-        try:
-            euid = geteuid()
-            if euid != 0:
-                seteuid(0)
-        except PermissionError:
-            msg = 'Must have root privileges to read from a mount point.'
-            logging.critical(msg)
-            print('\n%s\n' % msg)
-            raise
-        graph.add_from_mount(start)
-    else:
-        graph.add_from_file(start)
-    graph.trim_unuseful(True)
-    if show_graph:
-        graph.show_graph()
+    merl = Merl(out_fp=output_file, plain_output=plain, snapshot=snapshot, ttl_window=ttl_window, report=report)
+    kind = MOUNT if mounted else IMAGE if image else DFXML
+    if kind == MOUNT:
+        become_root()
+    graph = build_graph(start, kind, pipeline, report)
+    if show_graph or graph_file is not None:
+        graph.show_graph(output=graph_file)
     # return
-    candidates = extract_candidates(graph.graph_copy())
-    # for c in candidates:
-    #     graph.show_graph(c)
-
-    logging.info('Searching the DB for matches for each candidate graph. (%d)' % len(candidates))
-    merl.match_candidates(candidates)
+    match_graph(graph, merl, pipeline, workers, report, processes)
 
     # Save XML to file, but only if the user didn't request output in a plain format
     if output_file is not None and not plain:
-        merl.save_merl()
+        merl.save_merl(rusage)
 
     merl.close_db()
+    report.close()
+    out_name = getattr(output_file, 'name', None)
+    if isinstance(out_name, str):
+        report.save(out_name + REPORT_EXT)
 
     if file_needs_closing:
         output_file.close()
@@ -102,6 +160,249 @@ def go(start, mounted=False, verbose=False, show_graph=False, output_file=None,
     logging.info('Search complete. Exiting.')
 
 
+def go_batch(inputs, out_dir, verbose=False, plain=False, snapshot=None, pipeline=False, workers=4, jobs=2,
+             ttl_window=0, rusage=False, processes=None):
+    """Profile a batch of inputs, each with its own output file.
+
+    The centroid index is opened and warmed up once, then shared by all of
+    the inputs, ``jobs`` of which are profiled at a time. So is the pool of
+    ``processes`` that compare candidates with the centroid families, and
+    its copy of the families. An input that fails is logged and doesn't stop
+    the others.
+
+    :param list inputs: Paths to DFXML files, raw images, mount points, and
+        directories of DFXML files. See :func:`find_inputs`.
+    :param str out_dir: Directory where the output files are saved. Each is
+        named after its input. Created if it doesn't exist.
+    :param bool verbose: Flag that changes the logging mode from ``INFO`` to
+        ``DEBUG``.
+    :param bool plain: When set, the results are not in a MERL (XML) format.
+    :param str snapshot: Path to a centroid snapshot file to use instead of
+        the database.
+    :param bool pipeline: Overlap the stages of profiling each input. See
+        :func:`go`.
+    :param int workers: Number of threads that match candidates for each
+        input in pipeline mode.
+    :param int jobs: Number of inputs profiled at once.
+    :param int ttl_window: Also match candidates with the centroid families
+        that have up to this many more or fewer files.
+    :param bool rusage: Add the resource usage of the run to the end of each
+        MERL.
+    :param int processes: Number of processes that compare the candidates of
+        all the inputs with the centroid families.
+    :return: The number of inputs that couldn't be profiled.
+    :rtype: int
+    """
+    init_logging(verbose=verbose)
+    # The DB queries of all the inputs are mixed together, so they're only reported for the whole batch
+    batch_report = RunReport(out_dir)
+    if snapshot is None:
+        batch_report.watch_db(DB_META.bind)
+    sources = find_inputs(inputs)
+    if any(kind == MOUNT for _, kind in sources):
+        become_root()
+    makedirs(out_dir, exist_ok=True)
+
+    index = open_index(snapshot)
+    with batch_report.phase('warm'):
+        index.warm()
+    scorer = None
+    if processes and processes > 1:
+        with batch_report.phase('share'):
+            scorer = ParallelScorer(index, processes, ttl_window)
+    logging.info('Profiling %d inputs, %d at a time.' % (len(sources), jobs))
+
+    out_paths = set()
+    failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='profile') as pool:
+            futures = {}
+            for source, kind in sources:
+                out_path = _output_path(out_dir, source, 'txt' if plain else 'merl', out_paths)
+                futures[pool.submit(profile_one, source, kind, out_path, index, plain, pipeline, workers,
+                                    ttl_window, rusage, scorer)] = source
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    logging.error('Failed to profile %s' % futures[future], exc_info=1)
+                    failed += 1
+    finally:
+        if scorer is not None:
+            scorer.close()
+
+    index.close()
+    batch_report.count('inputs', len(sources))
+    batch_report.count('failed', failed)
+    batch_report.close()
+    batch_report.save(join(out_dir, 'batch' + REPORT_EXT))
+    logging.info('Batch complete. Profiled %d of %d inputs.' % (len(sources) - failed, len(sources)))
+    return failed
+
+
+def profile_one(source, kind, out_path, index, plain=False, pipeline=False, workers=4, ttl_window=0, rusage=False,
+                scorer=None):
+    """Profile a single input and save the results to a file.
+
+    :param str source: Path to the input.
+    :param str kind: What the input is: :data:`DFXML`, :data:`MOUNT`, or
+        :data:`IMAGE`.
+    :param str out_path: Path to the file where the results are saved.
+    :param index: The centroid index to match candidates against. It is not
+        closed, so it can be shared with other inputs.
+    :type index: merl.DbCentroidIndex or merl.snapshot.SnapshotCentroidIndex
+    :param bool plain: When set, the results are not in a MERL (XML) format.
+    :param bool pipeline: Overlap the stages of profiling. See :func:`go`.
+    :param int workers: Number of threads that match candidates in pipeline
+        mode.
+    :param int ttl_window: Also match candidates with the centroid families
+        that have up to this many more or fewer files.
+    :param bool rusage: Add the resource usage of the run to the end of the
+        MERL.
+    :param scorer: When given, candidates are compared with the centroid
+        families in its processes. It is not closed, so it can be shared with
+        other inputs.
+    :type scorer: merl.parallel.ParallelScorer
+    :rtype: None
+    """
+    logging.info('Profiling %s: %s' % (kind, source))
+    report = RunReport(source)
+    with open(out_path, 'w') as fout:
+        merl = Merl(src_image_filename=None if kind == MOUNT else source,
+                    src_mount_point=source if kind == MOUNT else None,
+                    out_fp=fout, plain_output=plain, index=index, ttl_window=ttl_window, report=report,
+                    scorer=scorer)
+        graph = build_graph(source, kind, pipeline, report)
+        match_graph(graph, merl, pipeline, workers, report)
+        if not plain:
+            merl.save_merl(rusage)
+    report.save(out_path + REPORT_EXT)
+    logging.info('Saved the results for %s to %s' % (source, out_path))
+
+
+def find_inputs(inputs):
+    """Return the inputs to profile in batch mode and what kind each is.
+
+    A directory is a mount point when it has a ``home`` directory in it.
+    Otherwise, the DFXML files in it are profiled. Files ending in
+    :data:`DFXML_EXT` are DFXML files, and any other file is a raw image.
+
+    :param list inputs: Paths to DFXML files, raw images, mount points, and
+        directories of DFXML files.
+    :return: List of ``(path, kind)`` tuples, where ``kind`` is one of
+        :data:`DFXML`, :data:`MOUNT`, or :data:`IMAGE`.
+    :rtype: list
+    """
+    sources = []
+    for src in inputs:
+        if isdir(src):
+            if isdir(join(src, 'home')):
+                sources.append((src, MOUNT))
+            else:
+                sources.extend((join(src, f), DFXML) for f in sorted(listdir(src)) if f.endswith(DFXML_EXT))
+        elif src.endswith(DFXML_EXT):
+            sources.append((src, DFXML))
+        else:
+            sources.append((src, IMAGE))
+    return sources
+
+
+def _output_path(out_dir, source, ext, taken):
+    """Return a path in ``out_dir`` for the output of ``source`` that isn't in ``taken``, and add it to ``taken``."""
+    name = splitext(basename(source.rstrip('/')))[0] or 'root'
+    out_path = join(out_dir, '%s.%s' % (name, ext))
+    n = 1
+    while out_path in taken:
+        n += 1
+        out_path = join(out_dir, '%s_%d.%s' % (name, n, ext))
+    taken.add(out_path)
+    return out_path
+
+
+def become_root():
+    """Switch the effective user to root, which is needed to read from mount points.
+
+    :rtype: None
+    :raises PermissionError: When the process doesn't have root privileges.
+    """
+    try:
+        euid = geteuid()
+        if euid != 0:
+            seteuid(0)
+    except PermissionError:
+        msg = 'Must have root privileges to read from a mount point.'
+        logging.critical(msg)
+        print('\n%s\n' % msg)
+        raise
+
+
+def build_graph(start, kind=DFXML, pipeline=False, report=None):
+    """Build the graph of an input's file objects and trim it down to the candidates.
+
+    :param str start: Path to the input.
+    :param str kind: What the input is: :data:`DFXML`, :data:`MOUNT`, or
+        :data:`IMAGE`.
+    :param bool pipeline: When set, the input is read in the background
+        while the graph is built.
+    :param report: When given, the time spent building and trimming the
+        graph, and its number of vertices, are added to the report.
+    :type report: common.instrument.RunReport
+    :return: The trimmed graph.
+    :rtype: profiler.graph_diff.FilesDiff
+    """
+    graph = FilesDiff()
+    with phase(report, 'ingest'):
+        if kind == MOUNT:
+            graph.add_from_mount(start)
+        elif kind == IMAGE:
+            graph.add_from_image(start, background=pipeline)
+        else:
+            graph.add_from_file(start, background=pipeline)
+    if report is not None:
+        report.count('vertices_ingested', graph.digr.num_vertices())
+    with phase(report, 'trim'):
+        graph.trim_unuseful(True)
+    if report is not None:
+        report.count('vertices_trimmed', graph.digr.num_vertices())
+    return graph
+
+
+def match_graph(graph, merl, pipeline=False, workers=4, report=None, processes=None):
+    """Find the matches for each candidate in the graph and add them to the MERL.
+
+    :param graph: The trimmed graph.
+    :type graph: profiler.graph_diff.FilesDiff
+    :param merl.Merl merl: Where the matches are written.
+    :param bool pipeline: When set, candidates are matched by ``workers``
+        threads as they are extracted.
+    :param int workers: Number of threads that match candidates in pipeline
+        mode.
+    :param report: When given, the time spent extracting and matching the
+        candidates is added to the report. In pipeline mode, extracting is
+        included in matching.
+    :type report: common.instrument.RunReport
+    :param int processes: Number of processes that compare candidates with
+        the centroid families. Takes precedence over ``workers``, and is
+        ignored if the MERL has its own :attr:`~merl.Merl.scorer`.
+    :rtype: None
+    """
+    if pipeline:
+        # Trimming needs the whole graph, but from here on each candidate is matched as soon as it's extracted
+        logging.info('Searching the DB for matches for each candidate graph as it is extracted.')
+        with phase(report, 'match'):
+            num = merl.match_candidates(iter_candidates(graph.digr), workers=workers, processes=processes)
+        logging.info('Matched %d candidate graphs.' % num)
+    else:
+        with phase(report, 'extract'):
+            candidates = extract_candidates(graph.digr)
+        # for c in candidates:
+        #     graph.show_graph(c)
+
+        logging.info('Searching the DB for matches for each candidate graph. (%d)' % len(candidates))
+        with phase(report, 'match'):
+            merl.match_candidates(candidates, processes=processes)
+
+
 def extract_candidates(orig_graph):
     """
     Return a list of graph objects, each a candidate graph.
@@ -111,67 +412,69 @@ def extract_candidates(orig_graph):
     :return: List of candidate graph objects.
     :rtype: list
     """
-    candidates = []
-    # Stop iterating when we've emptied the original graph
-    while orig_graph.num_vertices() > 0:
-        sub_graph = orig_graph.copy()
-
-        sg_vertices = get_subtree_vertices(sub_graph)
-
-        # Remove all vertices in the subgraph from the original graph
-        rm_list = []
-        for v in orig_graph.vertices():
-            if v in sg_vertices:
-                rm_list.append(v)
-        orig_graph.remove_vertex(rm_list)
-
-        # Remove all vertices not in the list
-        rm_list = []
-        for v in sub_graph.vertices():
-            if v not in sg_vertices:
-                rm_list.append(v)
-        sub_graph.remove_vertex(rm_list)
-
-        # Add the subgraph to the list of candidates
-        if sub_graph.num_vertices():
-            # Must have at least one vertex to be of interest to us
-            candidates.append(sub_graph)
-            if not len(candidates) % 5:
-                logging.debug('Extracted candidate graph %d' % len(candidates))
+    return list(iter_candidates(orig_graph))
 
-    return candidates
 
-
-def get_subtree_vertices(g):
-    """
-    Return a list of all vertices connected to node.
-
-    :param g: The graph from which to extract a subgraph.
-    :type g: common.graph.DblingGraph
-    :return: The list of all vertices in a subgraph of g.
-    :rtype: list
+def iter_candidates(orig_graph):
     """
+    Generate a graph object for each candidate graph in ``orig_graph``.
 
-    # Get the shortest distance from the first vertex in the graph and everything else
-    dist = shortest_distance(g, g.vertex(0), directed=False)
+    Candidates are the weakly connected components of the graph. All vertices
+    are labeled with their component in a single pass, and each candidate is
+    copied out of the original graph through a view filtered to just that
+    component. The original graph is not modified.
 
-    l = []
-    for i, v in enumerate(dist.a):
-        # If the calculated distance is the max, assume it is infinite (not reachable), i.e. not part of the same
-        # subgraph.
-        if v < MAX_DIST:
-            l.append(g.vertex(i))
+    :param orig_graph: The original graph made from the DFXML.
+    :type orig_graph: common.graph.DblingGraph
+    :return: Generator of candidate graph objects, in the order of the lowest
+        vertex index in each candidate.
+    :rtype: generator
+    """
+    comp, hist = label_components(orig_graph, directed=False)
+    labels = comp.a
+
+    # Group the vertex indexes by component so each component's vertices can be found without searching
+    order = np.argsort(labels, kind='stable')
+    bounds = np.concatenate(([0], np.cumsum(hist)))
+
+    # Reuse one filter for all the views, setting and then clearing only the current component's vertices
+    vfilt = orig_graph.new_vertex_property('bool')
+    n = 0
+    for label in range(len(hist)):
+        members = order[bounds[label]:bounds[label+1]]
+        if not len(members):
+            # Must have at least one vertex to be of interest to us
+            continue
+        vfilt.a[members] = True
+        sub_graph = DblingGraph(g=GraphView(orig_graph, vfilt=vfilt), prune=True)
+        vfilt.a[members] = False
 
-    return l
+        n += 1
+        if not n % 5:
+            logging.debug('Extracted candidate graph %d' % n)
+        yield sub_graph
 
 
 if __name__ == '__main__':
     args = docopt(__doc__)
+    if args['-b'] is not None:
+        sys.exit(1 if go_batch(args['INPUT'], args['-b'], verbose=args['-v'], plain=args['--plain'],
+                               snapshot=args['-s'], pipeline=args['--pipeline'], workers=int(args['-j']),
+                               jobs=int(args['-P']), ttl_window=int(args['-w']), rusage=args['--rusage'],
+                               processes=args['-p'] and int(args['-p'])) else 0)
     params = dict(
-        start=args['MOUNT_POINT'] if args['-m'] else args['DFXML_FILE'] if args['-d'] else None,
+        start=args['MOUNT_POINT'] if args['-m'] else args['DFXML_FILE'] if args['-d'] else args['IMAGE'],
         mounted=args['-m'],
+        image=args['-i'],
+        snapshot=args['-s'],
+        pipeline=args['--pipeline'],
+        workers=int(args['-j']),
+        ttl_window=int(args['-w']),
+        rusage=args['--rusage'],
+        processes=args['-p'] and int(args['-p']),
         verbose=args['-v'],
         show_graph=args['-g'],
+        graph_file=args['-G'],
         plain=args['--plain']
     )
 
@@ -0,0 +1,76 @@
+# *-* coding: utf-8 *-*
+"""Tests for :class:`crawl.crx_store.CrxStore`, with the index kept in a dict instead of the database."""
+
+import shutil
+import tempfile
+import unittest
+from os import path
+from unittest import mock
+
+from crawl.crx_store import CrxStore, InvalidCrx
+
+CRX_ID = 'a' * 32
+
+
+class CrxStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.index = {}
+
+        def add(crx_id, version, digest, size, dt_stored):
+            self.index[crx_id, version] = digest
+
+        patches = (
+            mock.patch('crawl.crx_store.db_store_lookup', lambda crx_id, version: self.index.get((crx_id, version))),
+            mock.patch('crawl.crx_store.db_store_add', add),
+        )
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.store = CrxStore(self.root)
+
+    def write(self, file_path, data):
+        with open(file_path, 'wb') as fout:
+            fout.write(data)
+
+    def read(self, file_path):
+        with open(file_path, 'rb') as fin:
+            return fin.read()
+
+    def test_claims_are_private(self):
+        first = self.store.claim_part(CRX_ID, '1.0')
+        second = self.store.claim_part(CRX_ID, '1.0')
+        self.assertNotEqual(first, second)
+
+    def test_released_part_is_claimed_once(self):
+        part_path = self.store.claim_part(CRX_ID, '1.0')
+        self.write(part_path, b'Cr24 partial')
+        self.store.release_part(part_path)
+        self.assertFalse(path.exists(part_path))
+
+        resumed = self.store.claim_part(CRX_ID, '1.0')
+        self.assertEqual(self.read(resumed), b'Cr24 partial')
+        self.assertFalse(path.exists(self.store.claim_part(CRX_ID, '1.0')))
+
+    def test_put(self):
+        part_path = self.store.claim_part(CRX_ID, '1.0')
+        self.write(part_path, b'Cr24 complete')
+        full_path = self.store.put(part_path, CRX_ID, '1.0')
+        self.assertEqual(self.read(full_path), b'Cr24 complete')
+        self.assertEqual(self.store.lookup(CRX_ID, '1.0'), full_path)
+        self.assertFalse(path.exists(part_path))
+
+    def test_put_rejects_other_files(self):
+        for data in (b'<html></html>', b''):
+            part_path = self.store.claim_part(CRX_ID, '1.0')
+            self.write(part_path, data)
+            with self.assertRaises(InvalidCrx):
+                self.store.put(part_path, CRX_ID, '1.0')
+        self.assertEqual(self.index, {})
+        self.assertFalse(path.exists(self.store.objects_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+# *-* coding: utf-8 *-*
+"""Tests for :mod:`profiler.ext4`, using small images made with ``mkfs.ext4 -d``."""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from os import path
+
+from common.const import FType
+from profiler.ext4 import Ext4Image
+
+HAVE_E2FSPROGS = shutil.which('mkfs.ext4') and shutil.which('debugfs')
+
+FAST_TARGET = 't' * 55  # Just fits in i_block
+SLOW_TARGET = 's' * 200
+BIG_DATA = bytes(range(256)) * 80  # More than 12 blocks of 1 KiB, so ext2 needs an indirect block
+MTIME = 1000000000
+
+
+def make_image(image_path, features=None):
+    """Make an image with a ``home/.shadow`` subtree of every kind of file the reader handles."""
+    src = tempfile.mkdtemp()
+    try:
+        top = path.join(src, 'home', '.shadow', 'user')
+        os.makedirs(path.join(top, 'dir'))
+        with open(path.join(top, 'dir', 'file.txt'), 'w') as fout:
+            fout.write('hello\n')
+        os.utime(path.join(top, 'dir', 'file.txt'), (MTIME, MTIME))
+        with open(path.join(top, 'big.bin'), 'wb') as fout:
+            fout.write(BIG_DATA)
+        os.symlink('short', path.join(top, 'fast'))
+        os.symlink(FAST_TARGET, path.join(top, 'fast55'))
+        os.symlink(SLOW_TARGET, path.join(top, 'slow'))
+
+        cmd = ['mkfs.ext4', '-q', '-F', '-b', '1024', '-d', src]
+        if features:
+            cmd += ['-O', features]
+        subprocess.run(cmd + [image_path, '4M'], check=True, stdout=subprocess.DEVNULL)
+    finally:
+        shutil.rmtree(src)
+
+    # debugfs doesn't need root to make device nodes, unlike mknod
+    requests = 'cd /home/.shadow/user\nmknod chr c 1 3\nmknod fifo p\n'
+    subprocess.run(['debugfs', '-w', '-f', '-', image_path], input=requests.encode(), check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+@unittest.skipUnless(HAVE_E2FSPROGS, 'e2fsprogs is not installed')
+class Ext4ImageTest(unittest.TestCase):
+
+    #: Features given to mkfs.ext4 with -O
+    features = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.image_path = path.join(cls.tmp_dir, 'test.img')
+        make_image(cls.image_path, cls.features)
+        cls.img = Ext4Image(cls.image_path)
+        cls.records = {rec['filename']: rec for rec in cls.img.iter_records()}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.img.close()
+        shutil.rmtree(cls.tmp_dir)
+
+    def rec(self, name):
+        return self.records['home/.shadow/user/' + name]
+
+    def data(self, name):
+        return self.img.read_data(self.img.lookup('home/.shadow/user/' + name))
+
+    def test_all_files_found(self):
+        expected = {'home', 'home/.shadow', 'home/.shadow/user'}
+        expected |= {'home/.shadow/user/' + name for name in
+                     ('dir', 'dir/file.txt', 'big.bin', 'fast', 'fast55', 'slow', 'chr', 'fifo')}
+        self.assertEqual(set(self.records), expected)
+
+    def test_types(self):
+        for name, ftype in (('dir', FType.dir), ('dir/file.txt', FType.reg), ('fast55', FType.sym),
+                            ('slow', FType.sym), ('chr', FType.chr), ('fifo', FType.pip)):
+            self.assertEqual(self.rec(name)['meta_type'], ftype, name)
+
+    def test_parents(self):
+        self.assertEqual(self.rec('dir/file.txt')['parent_inode'], self.rec('dir')['inode'])
+
+    def test_regular_files(self):
+        self.assertEqual(self.data('dir/file.txt'), b'hello\n')
+        self.assertEqual(self.data('big.bin'), BIG_DATA)
+        self.assertEqual(self.rec('big.bin')['filesize'], len(BIG_DATA))
+        self.assertIsInstance(self.rec('big.bin')['fs_offset'], int)
+
+    def test_times(self):
+        self.assertEqual(self.rec('dir/file.txt')['mtime'], '2001-09-09T01:46:40Z')
+
+    def test_directories(self):
+        self.assertIsInstance(self.rec('dir')['fs_offset'], int)
+
+    def test_fast_symlinks(self):
+        for name, target in (('fast', 'short'), ('fast55', FAST_TARGET)):
+            self.assertTrue(self.img.lookup('home/.shadow/user/' + name).is_fast_symlink, name)
+            self.assertEqual(self.rec(name)['fs_offset'], '?', name)
+            self.assertEqual(self.data(name), target.encode(), name)
+
+    def test_slow_symlink(self):
+        self.assertFalse(self.img.lookup('home/.shadow/user/slow').is_fast_symlink)
+        self.assertIsInstance(self.rec('slow')['fs_offset'], int)
+        self.assertEqual(self.data('slow'), SLOW_TARGET.encode())
+
+    def test_special_files_have_no_offset(self):
+        for name in ('chr', 'fifo'):
+            self.assertEqual(self.rec(name)['fs_offset'], '?', name)
+            self.assertEqual(list(self.img.iter_runs(self.img.lookup('home/.shadow/user/' + name))), [], name)
+
+    def test_blocks_outside_image(self):
+        with self.assertRaises(ValueError):
+            self.img.block(self.img.num_blocks)
+
+
+class Ext2ImageTest(Ext4ImageTest):
+    """The same files, with block maps instead of extents."""
+
+    features = '^extents,^flex_bg,^64bit,^metadata_csum'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,268 @@
+# *-* coding: utf-8 *-*
+"""Tests for :class:`crawl.webstore_iface.CrxDownloader`, against a local stand-in for the Web Store."""
+
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from collections import Counter
+from os import path
+from unittest import mock
+
+import requests
+from aiohttp import web
+from munch import Munch
+from requests import ConnectionError
+from requests.exceptions import HTTPError
+
+from crawl.rate_limit import CRX, MemoryBucketStore, RateLimiter
+from crawl.throttle import HostThrottle, HostThrottled
+from crawl.webstore_iface import CRX_CHUNK_SIZE, CrxDownloader, ExtensionUnavailable, save_crx
+
+CRX_ID = 'a' * 32
+# Cut in half, on a chunk boundary, since the blocking download only keeps whole chunks when the connection drops
+CRX_DATA = b'Cr24' + os.urandom(4 * CRX_CHUNK_SIZE - 4)
+HALF = len(CRX_DATA) // 2
+
+
+class StandInStore:
+    """An :mod:`aiohttp.web` server, in its own thread, that answers like the Web Store.
+
+    ``/detail/<id>`` redirects like the Web Store's detail page unless the ID
+    starts with ``b``, or fails if it starts with ``c``. ``/dl/<behavior>/<id>`` redirects to the CRX, which
+    fails in the way named by ``behavior``. Each request's path is counted
+    in :attr:`hits`, and the ``Range`` header of each CRX request is added
+    to :attr:`ranges`.
+    """
+
+    def __init__(self):
+        self.hits = Counter()
+        self.ranges = []
+        self._loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._started.wait()
+        self.url = 'http://127.0.0.1:{}'.format(self.port)
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._serve())
+        self._started.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+
+    async def _serve(self):
+        app = web.Application()
+        app.router.add_get('/detail/{id}', self.detail)
+        app.router.add_get('/detail/{id}/name', self.ok)
+        app.router.add_get('/dl/{behavior}/{id}', self.download)
+        app.router.add_get('/files/{behavior}/{id}/extension_1_2.crx', self.crx)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    async def detail(self, request):
+        self.hits[request.path] += 1
+        if request.match_info['id'].startswith('b'):
+            return web.Response(text='Not found')
+        if request.match_info['id'].startswith('c'):
+            raise web.HTTPServiceUnavailable()
+        raise web.HTTPFound(request.path + '/name')
+
+    async def ok(self, request):
+        return web.Response(text='Detail page')
+
+    async def download(self, request):
+        self.hits[request.path] += 1
+        raise web.HTTPFound('/files/{behavior}/{id}/extension_1_2.crx'.format(**request.match_info))
+
+    async def crx(self, request):
+        self.hits[request.path] += 1
+        self.ranges.append(request.headers.get('Range'))
+        behavior = request.match_info['behavior']
+        if behavior == 'missing':
+            raise web.HTTPNotFound()
+        if behavior == 'flaky' and self.hits[request.path] < 3:
+            raise web.HTTPServiceUnavailable()
+        if behavior == 'html':
+            return web.Response(text='<html></html>')
+        if behavior == 'resume' and 'Range' in request.headers:
+            start = int(request.headers['Range'][len('bytes='):-1])
+            return web.Response(status=206, body=CRX_DATA[start:], headers={
+                'Content-Range': 'bytes {}-{}/{}'.format(start, len(CRX_DATA) - 1, len(CRX_DATA))})
+        if behavior == 'cut' or (behavior == 'resume' and self.hits[request.path] == 1):
+            # Send part of the CRX and hang up
+            resp = web.StreamResponse(headers={'Content-Length': str(len(CRX_DATA))})
+            await resp.prepare(request)
+            await resp.write(CRX_DATA[:HALF])
+            # Give the client time to read it, since the bytes still buffered when the connection drops are lost
+            await asyncio.sleep(0.05)
+            request.transport.close()
+            return resp
+        return web.Response(body=CRX_DATA)
+
+
+class CrxDownloaderTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StandInStore()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.save_path = tempfile.mkdtemp()
+        self.index = {}
+        self.server.hits.clear()
+        self.server.ranges.clear()
+
+        def add(crx_id, version, digest, size, dt_stored):
+            self.index[crx_id, version] = digest
+
+        patches = (
+            mock.patch('crawl.webstore_iface.CRX_URL', self.server.url + '/detail/%s'),
+            mock.patch('crawl.webstore_iface.LIMITER', RateLimiter(MemoryBucketStore(), limits={})),
+            mock.patch('crawl.webstore_iface.HOSTS', HostThrottle()),
+            mock.patch('crawl.throttle.backoff_delay', lambda attempt: 0.0),
+            mock.patch('crawl.crx_store.db_store_lookup', lambda crx_id, version: self.index.get((crx_id, version))),
+            mock.patch('crawl.crx_store.db_store_add', add),
+        )
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+        self.downloader = CrxDownloader(connections=4)
+        self.addCleanup(self.downloader.close)
+        self.addCleanup(shutil.rmtree, self.save_path)
+
+    def save(self, behavior, crx_id=CRX_ID, checked_version=None):
+        download_url = self.server.url + '/dl/' + behavior + '/{}'
+        crx_obj = Munch(id=crx_id, checked_version=checked_version)
+        return self.downloader.save_crx(crx_obj, download_url, self.save_path)
+
+    def crx_hits(self, behavior, crx_id=CRX_ID):
+        return self.server.hits['/files/{}/{}/extension_1_2.crx'.format(behavior, crx_id)]
+
+    def partial_files(self):
+        incoming = path.join(self.save_path, 'incoming')
+        return os.listdir(incoming) if path.isdir(incoming) else []
+
+    def assertNoPartialFiles(self):
+        self.assertEqual(self.partial_files(), [])
+
+    def assertStored(self, crx_obj):
+        with open(crx_obj.full_path, 'rb') as fin:
+            self.assertEqual(fin.read(), CRX_DATA)
+        self.assertIn((crx_obj.id, crx_obj.version), self.index)
+
+    def test_save(self):
+        crx_obj = self.save('ok')
+        self.assertEqual(crx_obj.version, '1.2')
+        self.assertStored(crx_obj)
+        self.assertNoPartialFiles()
+
+    def test_already_saved(self):
+        self.save('ok')
+        with self.assertRaises(FileExistsError):
+            self.save('ok')
+
+    def test_no_redirect(self):
+        crx_id = 'b' * 32
+        with self.assertRaises(ExtensionUnavailable):
+            self.save('ok', crx_id)
+        self.assertEqual(self.server.hits['/detail/' + crx_id], 1)
+        self.assertNoPartialFiles()
+
+    def test_detail_page_error(self):
+        with self.assertRaises(HTTPError) as cm:
+            self.save('ok', 'c' * 32)
+        self.assertEqual(cm.exception.response.status_code, 503)
+        self.assertEqual(self.index, {})
+
+    def test_detail_page_down(self):
+        # Nothing listens on port 1
+        with mock.patch('crawl.webstore_iface.CRX_URL', 'http://127.0.0.1:1/detail/%s'):
+            with self.assertRaises(ConnectionError):
+                self.save('ok')
+        self.assertEqual(self.index, {})
+
+    def test_checked_version_skips_detail_page(self):
+        crx_id = 'b' * 32
+        crx_obj = self.save('ok', crx_id, checked_version='1.2')
+        self.assertEqual(crx_obj.version, '1.2')
+        self.assertEqual(self.server.hits['/detail/' + crx_id], 0)
+
+    def test_client_error_not_retried(self):
+        with self.assertRaises(HTTPError) as cm:
+            self.save('missing')
+        self.assertEqual(cm.exception.response.status_code, 404)
+        self.assertEqual(self.crx_hits('missing'), 1)
+
+    def test_server_error_retried(self):
+        crx_obj = self.save('flaky')
+        self.assertEqual(self.crx_hits('flaky'), 3)
+        self.assertStored(crx_obj)
+
+    def test_rate_limited(self):
+        # One CRX request every 1000 seconds, so the retry has to wait too long
+        limiter = RateLimiter(MemoryBucketStore(), limits={(None, CRX): (0.001, 1)})
+        with mock.patch('crawl.webstore_iface.LIMITER', limiter):
+            with self.assertRaises(HostThrottled):
+                self.save('flaky')
+        self.assertEqual(self.crx_hits('flaky'), 1)
+
+    def test_resume(self):
+        crx_obj = self.save('resume')
+        self.assertEqual(self.server.ranges, [None, 'bytes={}-'.format(HALF)])
+        self.assertStored(crx_obj)
+        self.assertNoPartialFiles()
+
+    def test_interrupted_download_kept(self):
+        with self.assertRaises(ConnectionError):
+            self.save('cut')
+        self.assertGreater(self.crx_hits('cut'), 1)
+        self.assertEqual(self.index, {})
+        self.assertEqual(self.partial_files(), [CRX_ID + '_1.2.crx.part'])
+
+        # A retry of the task knows the version from the update check, so it picks up where the last one stopped
+        self.server.ranges.clear()
+        crx_obj = self.save('resume', checked_version='1.2')
+        self.assertEqual(self.server.ranges, ['bytes={}-'.format(HALF)])
+        self.assertStored(crx_obj)
+        self.assertNoPartialFiles()
+
+    def test_not_a_crx(self):
+        with self.assertRaises(ConnectionError):
+            self.save('html')
+        self.assertEqual(self.index, {})
+        self.assertNoPartialFiles()
+
+
+class SessionSaveCrxTest(CrxDownloaderTest):
+    """The same downloads, with the blocking version of :func:`~crawl.webstore_iface.save_crx`."""
+
+    def setUp(self):
+        super().setUp()
+        self.session = requests.Session()
+        self.addCleanup(self.session.close)
+
+    def save(self, behavior, crx_id=CRX_ID, checked_version=None):
+        download_url = self.server.url + '/dl/' + behavior + '/{}'
+        crx_obj = Munch(id=crx_id, checked_version=checked_version)
+        return save_crx(crx_obj, download_url, self.save_path, session=self.session)
+
+
+if __name__ == '__main__':
+    unittest.main()